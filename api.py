@@ -1,20 +1,57 @@
-from flask import Flask, request, jsonify
-from computer_vision_service import ComputerVisionService
+from flask import Flask, Response, request, jsonify
+from job_manager import JobManager, JobQueueFullError, DuplicateJobError
+from model_registry import MODEL_REGISTRY
+from stage_metrics import STAGE_METRICS
 from util import ResponseStatus
 
 app = Flask(__name__)
 
+# Job Manager - queues uploaded videos and analyzes them on a bounded pool of workers, so requests return right away.
+# Created by init_app, so the worker processes that analyze video segments, which import this module again, load no
+# models and start no jobs of their own.
+job_manager = None
+
+
+def init_app():
+    global job_manager
+
+    # Load and warm up all models once, before the first upload arrives.
+    MODEL_REGISTRY.warm_up()
+    job_manager = JobManager()
+    return app
+
+
 @app.route('/video/upload', methods=['POST'])
 def process_video():
     try:
         data = request.json
-        cv_service = ComputerVisionService(data)
-        cv_service.start()
-        return jsonify({'message': 'Video processing complete'}), ResponseStatus.OK.value
+        job = job_manager.submit(data)
+        return jsonify({'message': 'Video processing started', 'jobId': job.job_id}), ResponseStatus.PROCESSING.value
+    except JobQueueFullError as e:
+        return jsonify({'error': str(e)}), ResponseStatus.UNAVAILABLE.value
+    except DuplicateJobError as e:
+        return jsonify({'error': str(e)}), ResponseStatus.CONFLICT.value
     except Exception as e:
         print(e)
         return jsonify({'error': str(e)}), ResponseStatus.ERROR.value
 
 
+@app.route('/video/<job_id>/status', methods=['GET'])
+def video_status(job_id):
+    job = job_manager.get_job(job_id)
+    if job is None:
+        return jsonify({'error': f'Unknown jobId: {job_id}'}), ResponseStatus.NOT_FOUND.value
+    return jsonify(job.to_dict()), ResponseStatus.OK.value
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+
+    # Stage timing histograms of all jobs, and the processing rate of the running ones, in Prometheus text format.
+    lines = STAGE_METRICS.render() + job_manager.render_metrics()
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+# A WSGI server runs the app from "api:init_app()".
 if __name__ == '__main__':
-    app.run(port=6000)
+    init_app().run(port=6000)
@@ -0,0 +1,215 @@
+"""
+Benchmarks the video analysis on synthetic store videos, offline and on the CPU.
+
+Each run renders (or reuses) a synthetic video of people crossing the counting line, at a given resolution and crowd
+density, and analyzes it end to end the way a job does - only reports and heatmaps are kept on disk instead of being
+sent to the server. By default the models are replaced with deterministic stubs, so the timings are those of the code
+around inference: tracking logic, heatmaps, rendering, encoding and saving. With --real the weights under weights/ are
+used instead. Run from the repository root, the same way the server runs, so the weights paths resolve:
+
+    python benchmarks/run_benchmarks.py --output before.json
+    python benchmarks/run_benchmarks.py --output after.json --compare before.json
+    python benchmarks/run_benchmarks.py --real --resolutions 1280x720 --densities 8 --output real.json
+
+The results hold the frame rate of every run, the time spent in each analysis stage, and the counts of the run, so two
+commits are compared on the same videos. A run whose frame rate dropped by more than the tolerance fails the
+comparison.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+# Benchmarks run on the CPU, whatever accelerators the machine has, so results are comparable between machines.
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import ultralytics
+
+import computer_vision_service
+import video_analyzer
+from data_provider import DataProvider
+from model_registry import MODEL_REGISTRY
+from stage_metrics import STAGE_METRICS
+from stub_models import install_stub_models
+from synthetic_video import Scenario, write_video
+from util import export_to_local_csv, export_to_local_txt, HeatmapType, LOCAL_VIDEO_ROOTS
+
+DEFAULT_RESOLUTIONS = "640x360,1280x720,1920x1080"
+DEFAULT_DENSITIES = "2,8,24"
+
+
+class OfflineDataProvider(DataProvider):
+    """
+    Data provider that keeps the reports and heatmaps on disk, with no upload and no request to the server.
+    """
+
+    def provide_heatmap(self, annotated_heatmap, clean_heatmap):
+        self.local_save_heatmap(annotated_heatmap, HeatmapType.ANNOTATED.value)
+        self.local_save_heatmap(clean_heatmap, HeatmapType.CLEAN.value)
+
+    def provide_metrics(self, url):
+        export_to_local_csv(self.reports, self.base_dir)
+        export_to_local_txt(self.reports, self.base_dir)
+
+
+def parse_resolutions(value):
+    return [tuple(int(side) for side in resolution.lower().split("x")) for resolution in value.split(",")]
+
+
+def run_once(scenario, video_path, job_id, payload):
+    data = {"jobId": job_id, "url": video_path, "date": "2024-01-01", "start": "10:00:00", "end": "10:00:00",
+            "length": scenario.frames / scenario.fps, **payload}
+    service = computer_vision_service.ComputerVisionService(data)
+
+    start = time.perf_counter()
+    service.start()
+    seconds = time.perf_counter() - start
+
+    analyzer = service.video_analyzer
+    return seconds, analyzer.object_tracker.object_counter.classwise_counts, len(service.data_provider.reports)
+
+
+def stage_summary(job_id):
+
+    # Mean and total time of each stage, and the bucket bound under which 95% of its calls ended.
+    metrics = STAGE_METRICS.get_job(job_id)
+    summary = {}
+    for stage, histogram in metrics.histograms.items():
+        if histogram.count == 0:
+            continue
+        cumulative, p95 = 0, float("inf")
+        for bound, bucket_count in zip(metrics.buckets + (float("inf"),), histogram.bucket_counts):
+            cumulative += bucket_count
+            if cumulative >= 0.95 * histogram.count:
+                p95 = bound
+                break
+        summary[stage] = {"calls": histogram.count, "total_s": round(histogram.sum, 4),
+                          "mean_ms": round(1000 * histogram.sum / histogram.count, 4),
+                          "p95_le_ms": None if p95 == float("inf") else 1000 * p95}
+    return summary
+
+
+def run_benchmark(scenario, video_path, mode, payload, repeat, pipelined):
+    name = f"{mode}-{scenario.name}-{'pipelined' if pipelined else 'serial'}"
+    print(f"Running {name}")
+
+    video_analyzer.PIPELINED_ANALYSIS = pipelined
+    if mode == "stub":
+        install_stub_models(scenario)
+
+    wall_times, stages, counts, reports = [], [], None, 0
+    for attempt in range(repeat):
+        job_id = f"bench-{name}-{attempt}"
+        seconds, counts, reports = run_once(scenario, video_path, job_id, payload)
+        wall_times.append(seconds)
+        stages.append(stage_summary(job_id))
+        STAGE_METRICS.forget(job_id)
+
+    # Stage times are those of the median run.
+    seconds = statistics.median_low(wall_times)
+    return {"name": name, "mode": mode, "width": scenario.width, "height": scenario.height,
+            "density": scenario.density, "frames": scenario.frames, "seed": scenario.seed,
+            "pipelined": pipelined, "payload": payload, "wall_times_s": [round(t, 4) for t in wall_times],
+            "fps": round(scenario.frames / seconds, 3), "counts": counts, "reports": reports,
+            "stages": stages[wall_times.index(seconds)]}
+
+
+def get_environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except Exception as e:
+        print(e)
+        commit = None
+    return {"commit": commit, "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(), "platform": platform.platform(), "processor": platform.processor(),
+            "cpu_count": os.cpu_count(), "ultralytics": ultralytics.__version__}
+
+
+def run_key(run):
+    return run["name"], json.dumps(run["payload"], sort_keys=True)
+
+
+def compare(results, baseline_path, tolerance):
+
+    # Runs are matched by name and payload, so only runs of the same scenario, mode and job options are compared.
+    with open(baseline_path) as file:
+        baseline = {run_key(run): run for run in json.load(file)["runs"]}
+
+    regressions = []
+    for run in results["runs"]:
+        previous = baseline.get(run_key(run))
+        if previous is None:
+            continue
+        change = run["fps"] / previous["fps"] - 1
+        same_counts = run["counts"] == previous["counts"]
+        print(f"{run['name']}: {previous['fps']:.1f} -> {run['fps']:.1f} fps ({change:+.1%})"
+              f"{'' if same_counts else ', counts differ'}")
+        if change < -tolerance:
+            regressions.append(run["name"])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--resolutions", default=DEFAULT_RESOLUTIONS, help="Comma separated WxH frame sizes")
+    parser.add_argument("--densities", default=DEFAULT_DENSITIES,
+                        help="Comma separated average numbers of people in the frame")
+    parser.add_argument("--frames", type=int, default=300, help="Frames of each synthetic video")
+    parser.add_argument("--fps", type=int, default=15, help="Frame rate of the synthetic videos")
+    parser.add_argument("--seed", type=int, default=0, help="Seed the scenarios are drawn with")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs of each benchmark, the median one is reported")
+    parser.add_argument("--real", action="store_true", help="Run with the weights instead of the stub models")
+    parser.add_argument("--serial", action="store_true", help="Run the analysis stages one after the other")
+    parser.add_argument("--headless", action="store_true", help="Skip rendering and encoding the output video")
+    parser.add_argument("--payload", default="{}", help="JSON of more job payload fields, e.g. '{\"motionGate\": false}'")
+    parser.add_argument("--videos", default=os.path.join(REPO_ROOT, "benchmarks", "videos"),
+                        help="Directory the synthetic videos are cached in")
+    parser.add_argument("--output", help="JSON file the results are written to")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Relative frame rate drop from the compared results that fails the comparison")
+    args = parser.parse_args()
+
+    # Reports and heatmaps are kept on disk only, and the synthetic videos are opened in place.
+    computer_vision_service.DataProvider = OfflineDataProvider
+    LOCAL_VIDEO_ROOTS.append(args.videos)
+
+    mode = "real" if args.real else "stub"
+    if args.real:
+        MODEL_REGISTRY.warm_up()
+    payload = {"headless": args.headless, **json.loads(args.payload)}
+
+    results = {"environment": get_environment(), "runs": []}
+    for width, height in parse_resolutions(args.resolutions):
+        for density in (int(density) for density in args.densities.split(",")):
+            scenario = Scenario(width, height, density, args.frames, args.fps, args.seed)
+            video_path = write_video(scenario, args.videos)
+            results["runs"].append(run_benchmark(scenario, video_path, mode, payload, args.repeat,
+                                                 not args.serial))
+
+    for run in results["runs"]:
+        print(f"{run['name']}: {run['fps']:.1f} fps")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        if regressions:
+            print(f"Frame rate dropped by more than {args.tolerance:.0%} in: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
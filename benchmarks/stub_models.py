@@ -0,0 +1,109 @@
+"""
+Stub models for the benchmarks, with deterministic outputs and next to no inference cost.
+
+The stubs stand in for the YOLO models in the process-wide registry, so the analysis runs unchanged around them and the
+benchmarks time the code that is not inference - tracking logic, heatmaps, rendering, encoding and saving. The detector
+reads the frame index from the barcode of a synthetic video and returns the boxes of its scenario, and the classifiers
+derive their probabilities from the pixels of the crop.
+"""
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from ultralytics.engine.results import Results
+
+from model_registry import MODEL_REGISTRY
+from synthetic_video import read_barcode
+from util import WeightsPath
+
+# Input size the stub classifiers report, as the real ones are trained with it.
+STUB_CLASSIFIER_SIZE = 224
+
+# Confidences of the stub classifications - every third crop is classified with low confidence, so the re-classification
+# paths are exercised as well.
+STUB_HIGH_CONF = 0.9
+STUB_LOW_CONF = 0.5
+
+
+class StubModel:
+    """
+    Attributes of a YOLO model that the registry and the analysis read, shared by the stub detector and classifiers.
+    """
+
+    def __init__(self, names, task, image_size):
+
+        # Class names and task, as YOLO models have them.
+        self.names = names
+        self.task = task
+
+        # Overrides and callbacks are copied into each view the registry lends out.
+        self.overrides = {"imgsz": image_size}
+        self.callbacks = {}
+
+        # The registry reads the input size from the predictor's arguments.
+        self.predictor = SimpleNamespace(args=SimpleNamespace(imgsz=image_size))
+
+
+class StubDetector(StubModel):
+    """
+    Person tracker that returns the boxes and ids of a synthetic scenario, for the frame its barcode names.
+    """
+
+    def __init__(self, scenario):
+        super().__init__({0: "person"}, "detect", 640)
+
+        # Scenario the synthetic video was rendered from.
+        self.scenario = scenario
+
+    def track(self, source, **kwargs):
+        return [self.result(source, with_ids=True)]
+
+    def predict(self, source, **kwargs):
+        frames = source if isinstance(source, list) else [source]
+        return [self.result(frame, with_ids=False) for frame in frames]
+
+    def result(self, frame, with_ids):
+        boxes, ids = self.scenario.boxes_at(read_barcode(frame))
+
+        # Rows of x1, y1, x2, y2, [id,] conf, cls - the layout of tracked and plain YOLO boxes.
+        columns = [boxes]
+        if with_ids:
+            columns.append(np.asarray(ids, dtype=np.float32).reshape(-1, 1))
+        columns += [np.full((len(boxes), 1), 0.9, dtype=np.float32), np.zeros((len(boxes), 1), dtype=np.float32)]
+        data = torch.from_numpy(np.concatenate(columns, axis=1))
+        return Results(frame, path="", names=self.names, boxes=data)
+
+
+class StubClassifier(StubModel):
+    """
+    Classifier that picks a class from the mean of the crop, so a crop is always classified the same way.
+    """
+
+    def __init__(self, names):
+        super().__init__(names, "classify", STUB_CLASSIFIER_SIZE)
+
+    def __call__(self, source, **kwargs):
+        crops = source if isinstance(source, list) else [source]
+        return [self.result(crop) for crop in crops]
+
+    def predict(self, source, **kwargs):
+        return self(source, **kwargs)
+
+    def result(self, crop):
+        value = int(crop.mean())
+        top1 = value % len(self.names)
+        conf = STUB_LOW_CONF if value % 3 == 0 else STUB_HIGH_CONF
+
+        # The rest of the probability is spread over the other classes.
+        probs = torch.full((len(self.names),), (1 - conf) / max(1, len(self.names) - 1))
+        probs[top1] = conf
+        return Results(crop, path="", names=self.names, probs=probs)
+
+
+def install_stub_models(scenario):
+
+    # Registered as the loaded models, so every job borrows the stubs instead of loading the weights.
+    MODEL_REGISTRY.models[WeightsPath.PERSON_TRACKER] = StubDetector(scenario)
+    MODEL_REGISTRY.models[WeightsPath.AGE_CLASSIFIER] = StubClassifier({0: "adult", 1: "children", 2: "elder",
+                                                                        3: "young"})
+    MODEL_REGISTRY.models[WeightsPath.GENDER_CLASSIFIER] = StubClassifier({0: "female", 1: "male"})
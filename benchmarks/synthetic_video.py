@@ -0,0 +1,161 @@
+"""
+Synthetic store videos for the benchmarks.
+
+A scenario is a seeded set of people walking through the frame - most of them cross the counting line the service
+draws at a third of the height from the bottom, some walk along the store without crossing it. The video is rendered
+from the scenario, and the index of each frame is drawn into it as a barcode, so the stub detector can return the
+boxes of the exact frame it is given, whatever frames the analysis skips.
+"""
+import os
+
+import cv2
+import numpy as np
+
+# Number of bits of the frame index barcode, and the side in pixels of each of its blocks.
+BARCODE_BITS = 20
+BARCODE_BLOCK = 12
+
+# Height of a person, as a fraction of the frame height, and the width of a person as a fraction of its height.
+PERSON_HEIGHT = 0.25
+PERSON_ASPECT_RATIO = 0.4
+
+# Seconds it takes a person to walk across the whole frame height.
+CROSSING_SECONDS = 6.0
+
+# Shares of the people that walk in across the line, walk out across it, and walk along the store.
+ENTERING_SHARE = 0.7
+LEAVING_SHARE = 0.2
+
+
+class Scenario:
+    """
+    People of a synthetic video, as straight walks at constant speed.
+
+    The density is the average number of people in the frame. People arrive uniformly over the video, and some are
+    already walking when it starts, so the first frames have the same density as the rest.
+    """
+
+    def __init__(self, width, height, density, frames, fps=15, seed=0):
+
+        # Frame size and length of the video.
+        self.width = width
+        self.height = height
+        self.frames = frames
+        self.fps = fps
+        self.density = density
+        self.seed = seed
+
+        # Counting line, as ComputerVisionService draws it.
+        self.line_y = height - int(height / 3)
+
+        # Box size of every person.
+        self.box_h = int(height * PERSON_HEIGHT)
+        self.box_w = int(self.box_h * PERSON_ASPECT_RATIO)
+
+        # Frames a walk across the whole frame lasts, which is how long a person is in view.
+        rng = np.random.default_rng(seed)
+        duration = CROSSING_SECONDS * fps
+        count = max(1, int(round(density * (frames + duration) / duration)))
+
+        # Frame each person starts walking on, where it starts and how many pixels it moves per frame.
+        self.spawn = np.sort(rng.uniform(-duration, frames, count))
+        kinds = rng.choice(3, count, p=[ENTERING_SHARE, LEAVING_SHARE, 1 - ENTERING_SHARE - LEAVING_SHARE])
+        speed = (height + self.box_h) / duration * rng.uniform(0.8, 1.25, count)
+        self.start = np.zeros((count, 2), dtype=np.float32)
+        self.velocity = np.zeros((count, 2), dtype=np.float32)
+
+        # People walking in come from below the frame and walk up, people walking out the other way around.
+        vertical = kinds < 2
+        self.start[vertical, 0] = rng.uniform(0, width - self.box_w, vertical.sum())
+        self.start[kinds == 0, 1] = height
+        self.start[kinds == 1, 1] = -self.box_h
+        self.velocity[kinds == 0, 1] = -speed[kinds == 0]
+        self.velocity[kinds == 1, 1] = speed[kinds == 1]
+
+        # People walking along the store stay above the line.
+        along = kinds == 2
+        self.start[along, 0] = -self.box_w
+        self.start[along, 1] = rng.uniform(0, max(1, self.line_y - self.box_h * 1.5), along.sum())
+        self.velocity[along, 0] = (width + self.box_w) / duration * rng.uniform(0.8, 1.25, along.sum())
+
+        # Color of each person, and the kind of its walk - 0 in, 1 out, 2 along the store.
+        self.colors = rng.integers(40, 256, (count, 3))
+        self.kinds = kinds
+
+    @property
+    def name(self):
+        return f"{self.width}x{self.height}-d{self.density}-f{self.frames}-s{self.seed}"
+
+    def boxes_at(self, index):
+
+        # Boxes of the people in view on the given frame, clipped to the frame, with their ids - 1-based, as tracker ids
+        # are.
+        position = self.start + self.velocity * (index - self.spawn)[:, None]
+        boxes = np.concatenate([position, position + (self.box_w, self.box_h)], axis=1)
+        boxes = np.clip(boxes, 0, (self.width, self.height, self.width, self.height))
+        visible = ((self.spawn <= index) & (boxes[:, 2] - boxes[:, 0] >= self.box_w / 4) &
+                   (boxes[:, 3] - boxes[:, 1] >= self.box_h / 4))
+        return boxes[visible].astype(np.float32), (np.flatnonzero(visible) + 1).tolist()
+
+    def render_background(self):
+
+        # Static floor with a texture, so frames differ only where people walk, and crops are not flat.
+        rng = np.random.default_rng(self.seed)
+        noise = rng.integers(0, 256, (self.height // 8 + 1, self.width // 8 + 1, 3), dtype=np.uint8)
+        background = cv2.resize(noise, (self.width, self.height), interpolation=cv2.INTER_LINEAR)
+        background = cv2.addWeighted(background, 0.3, np.full_like(background, 110), 0.7, 0)
+        for x in range(0, self.width, max(1, self.width // 12)):
+            cv2.line(background, (x, 0), (x, self.height), (80, 80, 80), 1)
+        return background
+
+    def render(self, index, background):
+        frame = background.copy()
+        boxes, ids = self.boxes_at(index)
+        for (x1, y1, x2, y2), track_id in zip(boxes.astype(int), ids):
+            color = tuple(int(c) for c in self.colors[track_id - 1])
+            cv2.rectangle(frame, (x1, y1), (x2, y2), color, -1)
+
+            # Stripes give the person edges, so its crops pass the sharpness check of the classification gate.
+            for y in range(y1, y2, 6):
+                cv2.line(frame, (x1, y), (x2, y), (color[2], color[0], color[1]), 2)
+        draw_barcode(frame, index)
+        return frame
+
+
+def draw_barcode(frame, index):
+
+    # A row of black and white blocks, most significant bit first, on the top left corner of the frame.
+    for bit in range(BARCODE_BITS):
+        value = 255 if (index >> (BARCODE_BITS - 1 - bit)) & 1 else 0
+        frame[:BARCODE_BLOCK, bit * BARCODE_BLOCK:(bit + 1) * BARCODE_BLOCK] = value
+
+
+def read_barcode(frame):
+
+    # The center of each block is read, as the video codec blurs its edges.
+    margin = BARCODE_BLOCK // 4
+    index = 0
+    for bit in range(BARCODE_BITS):
+        block = frame[margin:BARCODE_BLOCK - margin,
+                      bit * BARCODE_BLOCK + margin:(bit + 1) * BARCODE_BLOCK - margin]
+        index = (index << 1) | int(block.mean() > 127)
+    return index
+
+
+def write_video(scenario, directory):
+
+    # Videos are cached by their scenario, so repeated runs compare the same input.
+    path = os.path.join(directory, f"{scenario.name}.mp4")
+    if os.path.isfile(path):
+        return path
+
+    os.makedirs(directory, exist_ok=True)
+    partial_path = path + ".part.mp4"
+    writer = cv2.VideoWriter(partial_path, cv2.VideoWriter.fourcc(*"mp4v"), scenario.fps,
+                             (scenario.width, scenario.height))
+    background = scenario.render_background()
+    for index in range(scenario.frames):
+        writer.write(scenario.render(index, background))
+    writer.release()
+    os.replace(partial_path, path)
+    return path
@@ -0,0 +1,51 @@
+from crop_quality import crop_quality, is_good_crop
+from util import crop_box, CLASSIFICATION_DEADLINE
+
+
+class ClassificationGate:
+    """
+    Postpones the classification of a new client until a crop good enough to classify shows up.
+
+    Tiny, truncated or blurred crops are classified with low confidence, and would then be re-classified again and again.
+    While a client waits, the best of its crops is kept, and it is classified once the deadline passed, or the client
+    left before a good crop showed up.
+    """
+
+    def __init__(self, deadline=CLASSIFICATION_DEADLINE):
+
+        # Number of frames a client waits for a good crop.
+        self.deadline = deadline
+
+        # Waiting clients by track id, as [frames waited, best score, best crop].
+        self.postponed = {}
+
+    def offer(self, track_id, im0, box):
+
+        # Returns the crop to classify the client with now, or None if it keeps waiting.
+        crop = crop_box(im0, box)
+        if is_good_crop(crop, box, im0.shape):
+            self.postponed.pop(track_id, None)
+            return crop
+
+        waiting = self.postponed.setdefault(track_id, [0, -1.0, None])
+        waiting[0] += 1
+        if crop.size:
+            score = crop_quality(crop, box)
+            if score > waiting[1]:
+                waiting[1], waiting[2] = score, crop.copy()
+
+        if waiting[0] >= self.deadline and waiting[2] is not None:
+            return self.release(track_id)
+        return None
+
+    def is_postponed(self, track_id):
+        return track_id in self.postponed
+
+    def release(self, track_id):
+
+        # Best crop of a waiting client, to be classified now.
+        waiting = self.postponed.pop(track_id, None)
+        return None if waiting is None else waiting[2]
+
+    def forget(self, track_id):
+        self.postponed.pop(track_id, None)
@@ -1,7 +1,8 @@
 from classifiers.base_classifier import BaseClassifier
-from util import WeightsPath
+from util import WeightsPath, ClassifierType
 
 
 class AgeClassifier(BaseClassifier):
-    def __init__(self):
-        super().__init__(WeightsPath.AGE_CLASSIFIER)
+    def __init__(self, debug_crop_writer=None, detection_recorder=None):
+        super().__init__(WeightsPath.AGE_CLASSIFIER, ClassifierType.AGE.value, debug_crop_writer,
+                         detection_recorder)
@@ -1,36 +1,111 @@
-import random
 from collections import defaultdict
 
-from ultralytics import YOLO
-from util import box_to_image
+import numpy as np
+
+from model_registry import MODEL_REGISTRY
+from util import crop_to_image, MAX_CLASSIFICATION_BATCH, LOW_CONF
 
 
 class BaseClassifier:
 
-    def __init__(self, weight_path):
+    def __init__(self, weight_path, classification_type, debug_crop_writer=None, detection_recorder=None):
+
+        # YOLO Model that will be used in order to classify customers, borrowed from the process-wide registry. A
+        # classifier with no weights runs no model.
+        self.model = None if weight_path is None else MODEL_REGISTRY.borrow(weight_path)
+
+        # Native input size of the model - crops are resized to it once, when they are cut out of the frame.
+        self.image_size = None if weight_path is None else MODEL_REGISTRY.get_image_size(weight_path)
 
-        # YOLO Model that will be used in order to track customers.
-        self.model = YOLO(weight_path.value)
+        # Type of classification, used to sort the locally saved crops.
+        self.classification_type = classification_type
 
         # Will obtain the classification results.
         self.data = defaultdict()
 
-    def classify(self, im0, track_id, box, classification_type):
+        # Crops waiting for the next batch, by track id. A newer crop of the same track replaces the older one.
+        self.pending = {}
+
+        # Saves a sample of the classified crops for debugging, in the background.
+        self.debug_crop_writer = debug_crop_writer
+
+        # Records the classification results, when the job's detections are recorded.
+        self.detection_recorder = detection_recorder
+        if detection_recorder is not None and self.image_size is not None:
+            detection_recorder.set_image_size(classification_type, self.image_size)
+
+    def request_classification(self, track_id, crop):
+        self.pending[track_id] = crop
+
+    def classify_pending(self):
+        if not self.pending:
+            return
+
+        track_ids, crops = list(self.pending.keys()), list(self.pending.values())
+        self.pending = {}
+
+        # Run YOLO Classifier once on each batch of crops.
+        for start in range(0, len(crops), MAX_CLASSIFICATION_BATCH):
+            results = self.model(crops[start:start + MAX_CLASSIFICATION_BATCH], verbose=False)
+            for track_id, crop, res in zip(track_ids[start:start + MAX_CLASSIFICATION_BATCH],
+                                           crops[start:start + MAX_CLASSIFICATION_BATCH], results):
+                self.save_result(track_id, res, crop)
 
-        # Run YOLO Classifier on the bounding box.
-        res = self.model(box_to_image(im0, box))
+    def classify_votes(self, requests):
+
+        # Classify several crops of each track, in batches, and vote by averaging the class probabilities of the crops
+        # of each track.
+        items = [(track_id, crop_to_image(crop, self.image_size))
+                 for track_id, crops in requests.items() for crop in crops]
+        probs, names = defaultdict(list), None
+        for start in range(0, len(items), MAX_CLASSIFICATION_BATCH):
+            batch = items[start:start + MAX_CLASSIFICATION_BATCH]
+            results = self.model([crop for _, crop in batch], verbose=False)
+            for (track_id, _), res in zip(batch, results):
+                probs[track_id].append(res.probs.data.cpu().numpy())
+                names = res.names
+
+        first_crops = {}
+        for track_id, crop in items:
+            first_crops.setdefault(track_id, crop)
+
+        for track_id, track_probs in probs.items():
+            mean_probs = np.mean(track_probs, axis=0)
+            top1 = int(mean_probs.argmax())
+            res_val, res_conf = names[top1].lower(), float(mean_probs[top1])
+            if self.debug_crop_writer is not None:
+                self.debug_crop_writer.submit(self.classification_type, res_val, track_id, res_conf,
+                                              first_crops[track_id])
+            self.set_result(track_id, res_val, res_conf)
+
+    def save_result(self, track_id, res, crop=None):
 
         # Extract the prediction.
-        res_val = res[0].names[res[0].probs.top1].lower()
+        res_val = res.names[res.probs.top1].lower()
 
         # Extract the confidence of the prediction,
-        res_conf = res[0].probs.top1conf
+        res_conf = res.probs.top1conf
 
         # Local save for internal debugging.
-        res[0].save(f"./logs/classifications/{classification_type}/{res_val}/{track_id}_{random.random()}.jpg")
+        if self.debug_crop_writer is not None and crop is not None:
+            self.debug_crop_writer.submit(self.classification_type, res_val, track_id, float(res_conf), crop)
 
         # Save this ID classification.
+        self.set_result(track_id, res_val, res_conf)
+
+    def set_result(self, track_id, res_val, res_conf):
         self.data[track_id] = (res_val, res_conf)
+        if self.detection_recorder is not None:
+            self.detection_recorder.record_classification(self.classification_type, track_id, res_val, float(res_conf))
+
+    def is_low_confidence(self, track_id):
+
+        # Only a result that was already given can be low confidence - a pending classification is not re-evaluated.
+        data = self.data.get(track_id)
+        return data is not None and data[1] < LOW_CONF and track_id not in self.pending
+
+    def has_pending(self, track_id):
+        return track_id in self.pending
 
     def get_track_id_data(self, track_id):
         data = self.data.get(track_id, "Not Detected")
@@ -49,3 +124,4 @@ class BaseClassifier:
     def remove_id(self, track_id):
         if (self.data.get(track_id, None) is not None):
             self.data.pop(track_id)
+        self.pending.pop(track_id, None)
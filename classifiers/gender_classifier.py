@@ -1,7 +1,8 @@
 from classifiers.base_classifier import BaseClassifier
-from util import WeightsPath
+from util import WeightsPath, ClassifierType
 
 
 class GenderClassifier(BaseClassifier):
-    def __init__(self):
-        super().__init__(WeightsPath.GENDER_CLASSIFIER)
+    def __init__(self, debug_crop_writer=None, detection_recorder=None):
+        super().__init__(WeightsPath.GENDER_CLASSIFIER, ClassifierType.GENDER.value, debug_crop_writer,
+                         detection_recorder)
@@ -0,0 +1,29 @@
+from classifiers.base_classifier import BaseClassifier
+
+
+class ReplayClassifier(BaseClassifier):
+    """
+    Classifier of a replayed job - runs no model and cuts no crop, each track gets the results recorded for it, on the
+    frames they were recorded on.
+    """
+
+    def __init__(self, detection_replay, classification_type, debug_crop_writer=None, detection_recorder=None):
+        super().__init__(None, classification_type, debug_crop_writer, detection_recorder)
+
+        # Record the results are taken from, and the input size of the recorded classifier, kept in a new record.
+        self.detection_replay = detection_replay
+        self.image_size = detection_replay.get_image_size(classification_type)
+        if detection_recorder is not None:
+            detection_recorder.set_image_size(classification_type, self.image_size)
+
+    def replay(self, frame):
+        for track_id, label, conf in self.detection_replay.get_classifications(self.classification_type, frame):
+            self.set_result(track_id, label, conf)
+
+    def classify_pending(self):
+
+        # Nothing is requested in a replay, the results are given by replay.
+        self.pending = {}
+
+    def classify_votes(self, requests):
+        pass
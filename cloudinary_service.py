@@ -6,7 +6,8 @@ import cloudinary.uploader
 import cloudinary.api
 from ultralytics.utils import LOGGER
 import cv2
-from util import DOWNLOADED_VID_PATH
+from progressive_capture import ProgressiveCapture
+from util import DOWNLOADED_VID_PATH, DOWNLOAD_CHUNK_SIZE, DOWNLOAD_TIMEOUT
 
 config = cloudinary.config(secure=True)
 
@@ -36,17 +37,20 @@ class CloudinaryService:
 
         return srcURL
 
-    def download_video(self, url, base_dir):
+    def download_video(self, url, base_dir, progressive=False):
 
         save_path = base_dir + "/" + DOWNLOADED_VID_PATH
         # Fetch video from URL
-        response = requests.get(url, stream=True)
+        response = requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
         if response.status_code == 200:
-            print("Successfully saved data")
+
+            # Progressive download - the video is decoded from the file while the rest of it is still written.
+            if progressive:
+                return ProgressiveCapture(save_path, lambda stop_event: save_response(response, save_path, stop_event))
 
             # Save video to a temporary file
-            with open(save_path, "wb") as video_file:
-                video_file.write(response.content)
+            save_response(response, save_path)
+            print("Successfully saved data")
 
             # Load the video using OpenCV
             video_capture = cv2.VideoCapture(save_path)
@@ -57,7 +61,20 @@ class CloudinaryService:
 
             return video_capture
         elif response.status_code == 404:
+            response.close()
             raise Exception("Failed to save data. URL not found.")
         else:
+            response.close()
             raise Exception(f"Failed to fetch data. HTTP Status Code: {response.status_code}")
 
+
+def save_response(response, save_path, stop_event=None):
+
+    # Write the response body to the file chunk by chunk, so only a single chunk is held in memory. Each chunk is
+    # flushed, to be visible to a decoder reading the file while it is written.
+    with response, open(save_path, "wb") as video_file:
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            if stop_event is not None and stop_event.is_set():
+                return
+            video_file.write(chunk)
+            video_file.flush()
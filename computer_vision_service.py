@@ -1,22 +1,26 @@
 from data_provider import DataProvider
 from cloudinary_service import CloudinaryService
+from detection_record import ReplayCapture
 from video_analyzer import VideoAnalyzer
+from segment_analysis import ParallelVideoAnalyzer, plan_segments
 from util import WeightsPath
 from video_manager import VideoManager
 
 
 class ComputerVisionService:
-    def __init__(self, data):
+    def __init__(self, data, detection_replay_path=None):
 
-        # Video Manager - will be responsible to handle all metadata regarding the video.
+        # Video Manager - will be responsible to handle all metadata regarding the video. A job replayed from the
+        # detections of an earlier one is only started by the replay tool, the server never replays.
         self.video_manager = VideoManager()
+        self.video_manager.set_detection_replay_path(detection_replay_path)
 
         # Data Provider - will handle data flow in the program, from local saving to triggering API calls. Dynamically
         # injected with video uploading and downloading service - Cloudinary. If we we're to try different logic, We
         # would have just created VideoUploadDownload interface that CloudinaryService would've implemented, and the
         # different services that we would try, would just implement this interface and this code remains the same.
         # Open for extension, but close for modification.
-        self.data_provider = DataProvider(CloudinaryService(), self.video_manager)
+        self.data_provider = DataProvider(CloudinaryService(), self.video_manager, data.get("jobId"))
 
         # Data given by the server through the API call. Consist of jobId and a download link for the video.
         self.data = data
@@ -26,8 +30,12 @@ class ComputerVisionService:
 
     def start(self):
 
-        # Download video and populate all data fields relating to it.
-        video_cap = self.data_provider.download_video(self.data["url"])
+        # Download video and populate all data fields relating to it. A progressive job starts the analysis while the
+        # video is still downloading, and a replayed job needs no video at all.
+        progressive = bool(self.data.get("progressive", False))
+        replay_path = self.video_manager.get_detection_replay_path()
+        video_cap = (ReplayCapture(replay_path) if replay_path is not None else
+                     self.data_provider.download_video(self.data["url"], progressive))
         self.video_manager.populate_video_data(video_cap, self.data)
 
         # Initialize the counting line.
@@ -36,8 +44,19 @@ class ComputerVisionService:
         line_points = [(int(self.video_manager.get_width()), height),
                        (int(self.video_manager.get_start_x()), height)]
 
+        # A long video that is fully on disk may be split into segments, analyzed in parallel worker processes. A job
+        # that records or replays its detections runs in a single process, so a single record covers the whole video.
+        recorded = self.video_manager.is_recording_detections() or replay_path is not None
+        segments = ([] if progressive or recorded or self.video_manager.get_segment_workers() < 2 else
+                    plan_segments(self.video_manager))
+
         # Set video analyzer
-        self.video_analyzer = VideoAnalyzer(self.data_provider, self.video_manager, region=line_points,
-                                            model=WeightsPath.PERSON_TRACKER, classes=[0])
+        if len(segments) > 1:
+            self.video_analyzer = ParallelVideoAnalyzer(self.data_provider, self.video_manager, self.data, segments,
+                                                        region=line_points, model=WeightsPath.PERSON_TRACKER,
+                                                        classes=[0])
+        else:
+            self.video_analyzer = VideoAnalyzer(self.data_provider, self.video_manager, region=line_points,
+                                                model=WeightsPath.PERSON_TRACKER, classes=[0])
 
         self.video_analyzer.analyze()
@@ -0,0 +1,55 @@
+import math
+
+import cv2
+
+from util import (CROP_FULL_QUALITY_HEIGHT, CROP_SHARPNESS_HEIGHT, CROP_HALF_SHARPNESS, FRONTAL_ASPECT_RATIO,
+                  MIN_CROP_AREA, MIN_CROP_ASPECT_RATIO, MAX_CROP_ASPECT_RATIO, CROP_BORDER_MARGIN, MIN_CROP_SHARPNESS)
+
+
+def crop_sharpness(crop):
+
+    # Variance of the Laplacian, measured at a fixed height so crops of different sizes are comparable.
+    height, width = crop.shape[:2]
+    scale = CROP_SHARPNESS_HEIGHT / height
+    small = cv2.resize(crop, (max(1, round(width * scale)), CROP_SHARPNESS_HEIGHT), interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+    return float(cv2.Laplacian(gray, cv2.CV_32F).var())
+
+
+def box_frontalness(box):
+
+    # A person facing the camera has a wider box than one seen from the side, its aspect ratio is compared to the
+    # ratio of a frontal box.
+    width, height = box[2] - box[0], box[3] - box[1]
+    if height <= 0:
+        return 0.0
+    return max(0.0, 1 - abs(width / height - FRONTAL_ASPECT_RATIO) / FRONTAL_ASPECT_RATIO)
+
+
+def crop_quality(crop, box):
+
+    # Score between 0 and 1 - the mean of the size, sharpness and frontalness scores of the crop.
+    height = box[3] - box[1]
+    if crop.size == 0 or height <= 0:
+        return 0.0
+    size_score = min(1.0, height / CROP_FULL_QUALITY_HEIGHT)
+    sharpness = crop_sharpness(crop)
+    sharpness_score = sharpness / (sharpness + CROP_HALF_SHARPNESS)
+    score = (size_score + sharpness_score + box_frontalness(box)) / 3
+    return score if math.isfinite(score) else 0.0
+
+
+def is_good_crop(crop, box, frame_shape):
+
+    # A crop is good enough to classify when its box is large, shaped like a person, fully inside the frame, and sharp.
+    # The cheap box checks come first, the sharpness is measured only for crops that passed them.
+    width, height = box[2] - box[0], box[3] - box[1]
+    if crop.size == 0 or height <= 0 or width * height < MIN_CROP_AREA:
+        return False
+    if not MIN_CROP_ASPECT_RATIO <= width / height <= MAX_CROP_ASPECT_RATIO:
+        return False
+    frame_height, frame_width = frame_shape[:2]
+    if (box[0] < CROP_BORDER_MARGIN or box[1] < CROP_BORDER_MARGIN or
+            box[2] > frame_width - CROP_BORDER_MARGIN or box[3] > frame_height - CROP_BORDER_MARGIN):
+        return False
+    return crop_sharpness(crop) >= MIN_CROP_SHARPNESS
@@ -1,14 +1,17 @@
+import os
+
 import requests
 from PIL import Image, PngImagePlugin
 import cv2
 from ultralytics.utils import LOGGER
 
-from util import (SERVER_URL, REPORT_ENDPOINT, HeatmapType, DwellTime, make_dirs,
-                  open_csv_file, export_to_local_csv, export_to_local_txt)
+from stage_metrics import STAGE_METRICS
+from util import (SERVER_URL, REPORT_ENDPOINT, DOWNLOADED_VID_PATH, HeatmapType, DwellTime, Stage, make_dirs,
+                  get_local_video_path, open_csv_file, export_to_local_csv, export_to_local_txt)
 
 
 class DataProvider:
-    def __init__(self, cloudinary_service, video_manager):
+    def __init__(self, cloudinary_service, video_manager, job_id=None):
 
         # Local saved reports to be sent to server.
         self.reports = []
@@ -20,7 +23,13 @@ class DataProvider:
         self.cloudinary_service = cloudinary_service
 
         # Initialize base directory for further created outputs of the program.
-        self.base_dir = make_dirs()
+        self.base_dir = make_dirs(job_id)
+
+        # Path of the video file on the local file system, once it was opened or fully downloaded.
+        self.video_path = None
+
+        # Stage timers of the job.
+        self.stage_metrics = STAGE_METRICS.get_job(job_id)
 
         # Open CSV file.
         open_csv_file(self.base_dir)
@@ -41,16 +50,20 @@ class DataProvider:
             age, gender = customer["age"][0], customer["gender"][0]
             total_dwell += customer["dwell"]["dwell"].total_seconds()
 
-            # Increment gender and age group counts
-            gender_counts[gender] += 1
-            age_groups[age] += 1
+            # Increment gender and age group counts. A customer that was never classified only counts in the total.
+            if gender in gender_counts:
+                gender_counts[gender] += 1
+            if age in age_groups:
+                age_groups[age] += 1
 
         # Process current customers from `ages` and `genders`
         for track_id in ages:
-            age_groups[ages[track_id][0]] += 1
+            if ages[track_id][0] in age_groups:
+                age_groups[ages[track_id][0]] += 1
 
         for track_id in genders:
-            gender_counts[genders[track_id][0]] += 1
+            if genders[track_id][0] in gender_counts:
+                gender_counts[genders[track_id][0]] += 1
 
         # Calculate dwell times for ongoing customers
         total_dwell += sum(
@@ -118,19 +131,44 @@ class DataProvider:
             LOGGER.info("Failed to save data")
 
     def local_save(self, count, ages, dwell_times, genders, past_customers):
-        self.local_save_metrics(count, ages, dwell_times, genders, past_customers)
+        with self.stage_metrics.time(Stage.IO):
+            self.local_save_metrics(count, ages, dwell_times, genders, past_customers)
 
     def provide(self, annotated_heatmap, clean_heatmap):
-        self.provide_metrics(SERVER_URL + REPORT_ENDPOINT)
-        self.provide_heatmap(annotated_heatmap, clean_heatmap)
+        with self.stage_metrics.time(Stage.IO):
+            self.provide_metrics(SERVER_URL + REPORT_ENDPOINT)
+        with self.stage_metrics.time(Stage.IO):
+            self.provide_heatmap(annotated_heatmap, clean_heatmap)
 
-    def download_video(self, url):
+    def download_video(self, url, progressive=False):
         try:
 
-            # Calling cloudinary service to download the video.
-            return self.cloudinary_service.download_video(url, self.base_dir)
+            # A video that is already on a mounted file system is opened in place, with no copy - only from the
+            # configured mount roots, any other path is rejected.
+            local_path = get_local_video_path(url)
+            if local_path is not None:
+                self.video_path = local_path
+                return self.open_local_video(local_path)
+
+            # Calling cloudinary service to download the video. A progressive download is not complete yet.
+            video_capture = self.cloudinary_service.download_video(url, self.base_dir, progressive)
+            if not progressive:
+                self.video_path = self.base_dir + "/" + DOWNLOADED_VID_PATH
+            return video_capture
 
         # Raise exception if there was some issue with video download by the service.
         except Exception as e:
             print(e)
             raise
+
+    @staticmethod
+    def open_local_video(path):
+        if not os.path.isfile(path):
+            raise Exception(f"Failed to load video. File not found: {path}")
+
+        video_capture = cv2.VideoCapture(path)
+        if not video_capture.isOpened():
+            raise Exception("Failed to load video. Check the file format or path.")
+
+        LOGGER.info(f"Opened local video {path}")
+        return video_capture
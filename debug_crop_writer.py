@@ -0,0 +1,100 @@
+import itertools
+import os
+import queue
+import threading
+
+import cv2
+from ultralytics.utils import LOGGER
+
+from util import (DebugCropMode, DEBUG_CROP_MODE, DEBUG_CROP_SAMPLE_RATE, DEBUG_CROP_QUOTA, DEBUG_CROP_QUEUE_SIZE,
+                  LOW_CONF)
+
+
+class DebugCropWriter:
+    """
+    Saves classified crops for debugging, on a background thread, so JPEG encoding never blocks the analysis.
+
+    Only a sample of the crops is saved - every N-th classification, or only the low confidence ones - and a job stops
+    saving once it used its disk quota. When the writer falls behind, crops are dropped rather than waited for.
+    """
+
+    def __init__(self, base_dir, mode=DEBUG_CROP_MODE, sample_rate=DEBUG_CROP_SAMPLE_RATE, quota=DEBUG_CROP_QUOTA,
+                 queue_size=DEBUG_CROP_QUEUE_SIZE):
+
+        # Crops are saved under the job's directory, by classification type and predicted label.
+        self.base_dir = base_dir
+
+        # Which crops are saved - none, every sample_rate-th one, or the ones classified with low confidence.
+        self.mode = DebugCropMode(mode)
+        self.sample_rate = max(1, sample_rate)
+
+        # Bytes the job may write, and the bytes written so far.
+        self.quota = quota
+        self.bytes_written = 0
+
+        # Number of classifications seen, used for sampling and for unique file names.
+        self.counter = itertools.count()
+
+        # Number of crops dropped as the queue was full.
+        self.dropped = 0
+
+        # Crops waiting to be written, and the thread writing them - started only when crops may be saved.
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = None
+        if self.mode != DebugCropMode.OFF:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def submit(self, classification_type, label, track_id, conf, crop):
+        if self.thread is None:
+            return
+
+        index = next(self.counter)
+        if self.mode == DebugCropMode.SAMPLE and index % self.sample_rate != 0:
+            return
+        if self.mode == DebugCropMode.LOW_CONF and conf >= LOW_CONF:
+            return
+
+        # Crops are not modified after classification, so they are queued without a copy.
+        try:
+            self.queue.put_nowait((classification_type, label, track_id, index, crop))
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.bytes_written >= self.quota:
+                continue
+            try:
+                self.write(*item)
+            except Exception as e:
+                LOGGER.warning(f"Failed to save a debug crop: {e}")
+
+    def write(self, classification_type, label, track_id, index, crop):
+        ret, encoded = cv2.imencode(".jpg", crop)
+        if not ret:
+            return
+
+        if self.bytes_written + len(encoded) > self.quota:
+            self.bytes_written = self.quota
+            LOGGER.info(f"Debug crops quota of {self.quota} bytes reached, no more crops are saved for this job")
+            return
+
+        directory = f"{self.base_dir}/classifications/{classification_type}/{label}"
+        os.makedirs(directory, exist_ok=True)
+        with open(f"{directory}/{track_id}_{index}.jpg", "wb") as file:
+            file.write(encoded.tobytes())
+        self.bytes_written += len(encoded)
+
+    def close(self):
+
+        # Write the crops that are already queued, then stop the thread.
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.dropped:
+            LOGGER.info(f"Dropped {self.dropped} debug crops, the writer could not keep up")
@@ -0,0 +1,227 @@
+import json
+import os
+
+import cv2
+import numpy as np
+from ultralytics.utils import LOGGER
+
+from detections import Detections
+from util import ClassifierType
+
+# Layout of a recorded detection - the video frame it is on, its track id, class and box.
+DETECTION_RECORD = np.dtype([("frame", "<i4"), ("track_id", "<i4"), ("cls", "<i2"), ("box", "<f4", (4,))])
+
+# Layout of a recorded classification result - the video frame it was given on, the track, the classifier, the index of
+# the label among the labels recorded for that classifier, and the confidence.
+CLASSIFICATION_RECORD = np.dtype([("frame", "<i4"), ("track_id", "<i4"), ("classifier", "<i1"), ("label", "<i2"),
+                                  ("conf", "<f4")])
+
+# Files of a record directory.
+DETECTIONS_FILE = "detections.bin"
+CLASSIFICATIONS_FILE = "classifications.bin"
+METADATA_FILE = "record.json"
+
+# Version of the record layout, a record of another version is not replayed.
+RECORD_VERSION = 2
+
+# Classifiers by their index in the classification records.
+CLASSIFIERS = [classifier_type.value for classifier_type in ClassifierType]
+
+
+class DetectionRecorder:
+    """
+    Records the detections of every analyzed frame, and every classification result, so the job can be analyzed again
+    later with no model - see DetectionReplay.
+
+    The detections are those the analysis got, after the frames between keyframes were interpolated and the static
+    ones skipped, so a replay sees the very same boxes. Each classification result is recorded with the frame it was
+    given on, so a replay gives it on the same frame, with no crop to decide when. Rows are appended to flat binary
+    files as the analysis goes, and read back memory-mapped. The class names, labels, video size and analysis window
+    are written once the analysis is done.
+    """
+
+    def __init__(self, directory, video_manager, names):
+
+        # Directory of the record, and the video manager the analysis window is taken from.
+        self.directory = directory
+        self.video_manager = video_manager
+
+        # Class names of the detector.
+        self.names = names
+
+        # Files the rows are appended to.
+        os.makedirs(directory, exist_ok=True)
+        self.detections_file = open(os.path.join(directory, DETECTIONS_FILE), "wb")
+        self.classifications_file = open(os.path.join(directory, CLASSIFICATIONS_FILE), "wb")
+
+        # Labels of each classifier, in the order they were first given, and the input size of each classifier.
+        self.labels = {classifier: [] for classifier in CLASSIFIERS}
+        self.image_sizes = {}
+
+        # First and last recorded video frames.
+        self.first_frame = None
+        self.last_frame = None
+
+    def set_image_size(self, classification_type, image_size):
+        self.image_sizes[classification_type] = image_size
+
+    def record_detections(self, frame, detections):
+        if self.first_frame is None:
+            self.first_frame = frame
+        self.last_frame = frame
+
+        # A frame with no detections writes no row.
+        rows = np.zeros(len(detections), dtype=DETECTION_RECORD)
+        rows["frame"] = frame
+        rows["track_id"] = detections.track_ids
+        rows["cls"] = detections.clss
+        rows["box"] = detections.boxes
+        self.detections_file.write(rows.tobytes())
+
+    def record_classification(self, classification_type, track_id, label, conf):
+        labels = self.labels[classification_type]
+        if label not in labels:
+            labels.append(label)
+
+        # Results are given while the last recorded frame is analyzed.
+        row = np.zeros(1, dtype=CLASSIFICATION_RECORD)
+        row["frame"] = self.last_frame
+        row["track_id"] = track_id
+        row["classifier"] = CLASSIFIERS.index(classification_type)
+        row["label"] = labels.index(label)
+        row["conf"] = conf
+        self.classifications_file.write(row.tobytes())
+
+    def close(self):
+        self.detections_file.close()
+        self.classifications_file.close()
+
+        metadata = {
+            "version": RECORD_VERSION,
+            "names": {str(cls): name for cls, name in self.names.items()},
+            "labels": self.labels,
+            "imageSizes": self.image_sizes,
+            "firstFrame": self.first_frame,
+            "lastFrame": self.last_frame,
+            "width": self.video_manager.get_width(),
+            "height": self.video_manager.get_height(),
+            "fps": self.video_manager.get_fps(),
+            "frameRate": self.video_manager.frame_rate,
+            "date": self.video_manager.get_date(),
+            "start": self.video_manager.get_analysis_start_time().strftime("%H:%M:%S"),
+            "end": self.video_manager.get_analysis_end_time().strftime("%H:%M:%S"),
+            "videoStart": self.video_manager.get_video_start_time().strftime("%H:%M:%S"),
+        }
+        with open(os.path.join(self.directory, METADATA_FILE), "w") as file:
+            json.dump(metadata, file, indent=2)
+        LOGGER.info(f"Recorded detections of frames {self.first_frame} to {self.last_frame} in {self.directory}")
+
+
+class DetectionReplay:
+    """
+    Detections and classification results of a recorded job, fed back to the analysis in place of the models.
+
+    Each classification result is given on the frame it was recorded on. With the same settings, a replay is the
+    recorded analysis again, and with other counting or timeslice settings it is as close as the record allows.
+    """
+
+    def __init__(self, directory):
+
+        # Directory and metadata of the record.
+        self.directory = directory
+        self.metadata = load_metadata(directory)
+
+        # Class names of the detector - the counts are kept by class name, and the replay stands in for the model.
+        self.names = {int(cls): name for cls, name in self.metadata["names"].items()}
+
+        # Recorded detections and classification results, sorted by frame as they were recorded.
+        self.detections = load_records(os.path.join(directory, DETECTIONS_FILE), DETECTION_RECORD)
+        self.classifications = load_records(os.path.join(directory, CLASSIFICATIONS_FILE), CLASSIFICATION_RECORD)
+
+        # Whether a frame outside the record was already reported.
+        self.warned_outside = False
+
+    def get_detections(self, frame):
+        first_frame, last_frame = self.metadata["firstFrame"], self.metadata["lastFrame"]
+        if (first_frame is None or not first_frame <= frame <= last_frame) and not self.warned_outside:
+            LOGGER.warning(f"Frame {frame} is outside the recorded frames {first_frame} to {last_frame}, "
+                           f"it has no detections")
+            self.warned_outside = True
+
+        rows = get_frame_rows(self.detections, frame)
+        return Detections(np.array(rows["box"], dtype=np.float32), rows["track_id"].tolist(), rows["cls"].tolist())
+
+    def get_image_size(self, classification_type):
+        return self.metadata["imageSizes"].get(classification_type)
+
+    def get_classifications(self, classification_type, frame):
+
+        # Results of a classifier given on the frame, as (track id, label, confidence), in the order they were given.
+        labels = self.metadata["labels"][classification_type]
+        classifier = CLASSIFIERS.index(classification_type)
+        return [(int(row["track_id"]), labels[row["label"]], float(row["conf"]))
+                for row in get_frame_rows(self.classifications, frame) if row["classifier"] == classifier]
+
+
+class ReplayCapture:
+    """
+    Video capture of a replayed job - blank frames of the recorded video size, for the recorded frames, so a record is
+    replayed with no video.
+
+    The analysis of a replay takes the boxes and classification results from the record, and never looks at the pixels.
+    """
+
+    def __init__(self, directory):
+
+        # Metadata of the record.
+        self.metadata = load_metadata(directory)
+
+        # Position of the next frame, and the frame after the last recorded one.
+        self.position = 0
+        last_frame = self.metadata["lastFrame"]
+        self.frame_count = 0 if last_frame is None else last_frame + 1
+
+    def read(self):
+        if self.position >= self.frame_count:
+            return False, None
+        self.position += 1
+        return True, np.zeros((self.metadata["height"], self.metadata["width"], 3), dtype=np.uint8)
+
+    def get(self, prop):
+        return {cv2.CAP_PROP_FRAME_WIDTH: self.metadata["width"], cv2.CAP_PROP_FRAME_HEIGHT: self.metadata["height"],
+                cv2.CAP_PROP_FPS: self.metadata["frameRate"], cv2.CAP_PROP_FRAME_COUNT: self.frame_count,
+                cv2.CAP_PROP_POS_FRAMES: self.position}.get(prop, 0)
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            self.position = int(value)
+            return True
+        return False
+
+    def isOpened(self):
+        return True
+
+    def release(self):
+        pass
+
+
+def load_metadata(directory):
+    with open(os.path.join(directory, METADATA_FILE)) as file:
+        metadata = json.load(file)
+    if metadata["version"] != RECORD_VERSION:
+        raise Exception(f"Record {directory} has version {metadata['version']}, expected {RECORD_VERSION}")
+    return metadata
+
+
+def get_frame_rows(records, frame):
+    start, end = np.searchsorted(records["frame"], (frame, frame + 1))
+    return records[start:end]
+
+
+def load_records(path, dtype):
+
+    # A job that failed may leave a partial row at the end, which is left out.
+    count = os.path.getsize(path) // dtype.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
@@ -0,0 +1,160 @@
+import queue
+import threading
+import time
+
+import torch
+from ultralytics.trackers.track import TRACKER_MAP
+from ultralytics.utils import DEFAULT_CFG_DICT, IterableSimpleNamespace, LOGGER, yaml_load
+from ultralytics.utils.checks import check_yaml
+
+from detections import Detections
+from model_registry import MODEL_REGISTRY
+from util import WeightsPath, DETECTION_BATCH_SIZE, DETECTION_BATCH_WAIT, TRACKER_FRAME_RATE
+
+
+class DetectionRequest:
+
+    def __init__(self, frame, classes, conf):
+
+        # Frame to detect on, and the classes and confidence threshold the stream tracks with.
+        self.frame = frame
+        self.classes = classes
+        self.conf = conf
+
+        # Detection results of the frame, or the error the detection failed with, set once done is.
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class DetectionServer:
+    """
+    Shared detection worker - frames submitted by all streams of the process are detected in batches.
+
+    The first waiting frame opens a batch, which takes the frames submitted within a short wait after it, so streams
+    that submit at about the same time share a single inference call. The server only detects, each stream tracks the
+    results with a tracker of its own.
+    """
+
+    def __init__(self, weights_path=WeightsPath.PERSON_TRACKER, max_batch=DETECTION_BATCH_SIZE,
+                 max_wait=DETECTION_BATCH_WAIT):
+
+        # Weights of the detector, borrowed from the process-wide registry once the server is first used.
+        self.weights_path = weights_path
+        self.model = None
+
+        # Maximal number of frames in a batch, and the seconds a batch waits for more frames after its first one.
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+        # Frames waiting for detection, and the thread detecting them - started on first use.
+        self.requests = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+        # Number of batches and frames detected, to report the average batch size.
+        self.batch_count = 0
+        self.frame_count = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.model = MODEL_REGISTRY.borrow(self.weights_path)
+                self.thread = threading.Thread(target=self.run, name="detection-server", daemon=True)
+                self.thread.start()
+
+    def detect(self, frame, classes=None, conf=None):
+
+        # Blocks until the batch the frame was detected in is done.
+        self.start()
+        request = DetectionRequest(frame, classes, conf)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+
+            # Streams that track different classes or with different thresholds are detected in separate calls.
+            groups = {}
+            for request in batch:
+                key = (None if request.classes is None else tuple(request.classes), request.conf)
+                groups.setdefault(key, []).append(request)
+            for (classes, conf), requests in groups.items():
+                self.detect_batch(requests, classes, conf)
+
+    def detect_batch(self, requests, classes, conf):
+        try:
+
+            # With no threshold set, the low confidence detections the tracker's second association needs are kept, as
+            # model.track keeps them.
+            results = self.model.predict([request.frame for request in requests],
+                                         classes=None if classes is None else list(classes), conf=conf or 0.1,
+                                         verbose=False)
+            for request, result in zip(requests, results):
+                request.result = result
+
+            self.batch_count += 1
+            self.frame_count += len(requests)
+            if self.batch_count % 1000 == 0:
+                LOGGER.info(f"Detection server: {self.frame_count / self.batch_count:.2f} frames per batch on average")
+
+        # A failed batch fails the streams that submitted to it, not the server.
+        except Exception as e:
+            for request in requests:
+                request.error = e
+
+        finally:
+            for request in requests:
+                request.done.set()
+
+
+class StreamTracker:
+    """
+    Tracker state of a single stream that detects on the shared server. Detections are tracked the same way
+    `model.track` tracks them, with a tracker that belongs to this stream only.
+    """
+
+    def __init__(self, detection_server, classes=None, tracker=DEFAULT_CFG_DICT["tracker"], conf=None):
+
+        # Shared detection server, and the classes and confidence threshold this stream tracks with.
+        self.detection_server = detection_server
+        self.classes = classes
+        self.conf = conf
+
+        # Tracker of this stream, configured as the model's own tracker would be.
+        cfg = IterableSimpleNamespace(**yaml_load(check_yaml(tracker)))
+        self.tracker = TRACKER_MAP[cfg.tracker_type](args=cfg, frame_rate=TRACKER_FRAME_RATE)
+
+    def track(self, im0):
+        result = self.detection_server.detect(im0, self.classes, self.conf)
+
+        # Frames with no detections don't update the tracker, as with model.track.
+        det = result.boxes.cpu().numpy()
+        if len(det):
+            tracks = self.tracker.update(det, im0)
+            if len(tracks):
+                result = result[tracks[:, -1].astype(int)]
+                result.update(boxes=torch.as_tensor(tracks[:, :-1]))
+
+        return Detections.from_results(result)
+
+
+# Single detection server of the process, shared by all streams.
+DETECTION_SERVER = DetectionServer()
@@ -0,0 +1,60 @@
+import numpy as np
+
+
+class Detections:
+    """
+    Tracked detections of a single frame - boxes in (x1, y1, x2, y2) format, with their track ids and classes.
+
+    Detections are produced by the detection stage and consumed later by the analysis stage, so they hold plain
+    NumPy/list copies and no reference to the model results.
+    """
+
+    def __init__(self, boxes, track_ids, clss):
+        self.boxes = boxes
+        self.track_ids = track_ids
+        self.clss = clss
+
+    @staticmethod
+    def empty():
+        return Detections(np.zeros((0, 4), dtype=np.float32), [], [])
+
+    @staticmethod
+    def from_results(result):
+
+        # Extract tracks for OBB or object detection
+        track_data = result.obb or result.boxes
+
+        if track_data and track_data.id is not None:
+            return Detections(track_data.xyxy.cpu().numpy().astype(np.float32), track_data.id.int().cpu().tolist(),
+                              track_data.cls.cpu().tolist())
+
+        return Detections.empty()
+
+    @staticmethod
+    def interpolate(start, end, weight):
+
+        # Detections of a frame between two detected keyframes, `weight` of the way from the start keyframe to the end
+        # one. Tracks found in both keyframes move linearly. A track lost by the end keyframe holds its last box until
+        # halfway, and a track that first appears in the end keyframe appears there from halfway on, so tracks start
+        # and end at most half a stride off the frame the detector would have found them on.
+        start_index = {track_id: i for i, track_id in enumerate(start.track_ids)}
+        end_index = {track_id: i for i, track_id in enumerate(end.track_ids)}
+        matched = [(i, end_index[track_id]) for i, track_id in enumerate(start.track_ids) if track_id in end_index]
+        boxes = start.boxes.copy()
+        if matched:
+            start_rows, end_rows = np.array(matched).T
+            boxes[start_rows] += (end.boxes[end_rows] - start.boxes[start_rows]) * weight
+        if weight < 0.5:
+            return Detections(boxes, list(start.track_ids), list(start.clss))
+
+        kept = [i for i, track_id in enumerate(start.track_ids) if track_id in end_index]
+        appeared = [i for i, track_id in enumerate(end.track_ids) if track_id not in start_index]
+        return Detections(np.concatenate([boxes[kept], end.boxes[appeared]]).astype(np.float32),
+                          [start.track_ids[i] for i in kept] + [end.track_ids[i] for i in appeared],
+                          [start.clss[i] for i in kept] + [end.clss[i] for i in appeared])
+
+    def has_tracks(self):
+        return len(self.track_ids) > 0
+
+    def __len__(self):
+        return len(self.track_ids)
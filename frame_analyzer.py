@@ -1,11 +1,12 @@
 from ultralytics.utils import LOGGER
 from ultralytics.utils.plotting import Annotator
-from shapely.geometry import LineString
-from util import annotate_object, RED, GREEN, PURPLE, REEVALUATION_INTERVAL, ClassifierType
+from line_crossing import LineCrossingDetector
+from stage_metrics import StageMetrics
+from util import annotate_object, RED, GREEN, PURPLE, HEATMAP_REFRESH_INTERVAL, ClassifierType, CrossingDirection, Stage
 
 class FrameAnalyzer:
 
-    def __init__(self, object_tracker, CFG, heatmap_manager):
+    def __init__(self, object_tracker, CFG, heatmap_manager, stage_metrics=None):
         self.object_tracker = object_tracker
         self.CFG = CFG
 
@@ -14,23 +15,29 @@ class FrameAnalyzer:
             self.CFG["line_width"] if self.CFG["line_width"] is not None else 2
         )  # Store line_width for usage
 
-        self.LineString = LineString
-        self.r_s = self.LineString(self.region)
+        # Counting line crossing detector - only a region of 2 points is a line that can be crossed.
+        self.line_crossing = LineCrossingDetector(self.region) if len(self.region) < 3 else None
         self.heatmap_manager = heatmap_manager
 
-    def initialize(self, im0):
-        LOGGER.info("Initializing frame analyzer")
+        # Index of the last frame the drawn heatmap was refreshed on - used by the analysis stage.
+        self.last_heatmap_refresh = None
+
+        # Colorized heatmap that is drawn on the frames until the next refresh - used by the rendering stage.
+        self.heatmap_overlay = None
+
+        # Stage timers of the job.
+        self.stage_metrics = stage_metrics if stage_metrics is not None else StageMetrics()
 
-        # Copy of the original image for later classification.
-        original_frame = im0.copy()
+    def detect(self, ctx):
 
-        # Copy for a clean heatmap with no box annotations that will be uploaded eventually to the server.
-        heatmap_copy = im0.copy()
+        # Detection only runs the model, so it can run ahead of the analysis of the previous frames.
+        ctx.detections = self.object_tracker.extract_tracks(ctx.frame)
 
-        # Extract tracks with the use of object_tracker.
-        self.object_tracker.extract_tracks(im0)
+    def initialize(self, ctx):
+        LOGGER.info("Initializing frame analyzer")
 
-        self.annotator = Annotator(im0, line_width=self.line_width)
+        # Set the tracks detected in this frame.
+        self.object_tracker.set_tracks(ctx.detections)
 
         # Go through each detection.
         for box, track_id, cls in zip(self.object_tracker.get_boxes(), self.object_tracker.get_track_ids(),
@@ -42,113 +49,130 @@ class FrameAnalyzer:
             # Store tracking history for each box.
             self.object_tracker.store_tracking_history(track_id, box)
 
-            # Draw the defined region if specified
-            if self.region is not None:
-                self.annotator.draw_region(reg_pts=self.region, color=PURPLE, thickness=self.line_width * 2)
-
             # Skipping analysis as all objects detected in the first frame are counted as clients, therefore we need
             # to count and classify them as they are considered clients already, regardless if they crossed the entrance
-            # line or not.
-            self.object_tracker.add_new_client(original_frame, track_id, cls, box)
+            # line or not. The frame is not annotated yet at this stage, so it is used as is for classification.
+            self.object_tracker.add_new_client(ctx.frame, track_id, cls, box)
 
-            color = RED if track_id not in self.object_tracker.counted_ids else GREEN
+        # Classify all the clients of the first frame in one batch, before their labels are taken.
+        self.object_tracker.classify_pending(force=True)
+        self.object_tracker.save_prev_ids()
 
-            annotate_object(track_id, cls, box,
-                            self.object_tracker.get_track_id_classifier_data(track_id, ClassifierType.AGE),
-                            self.object_tracker.get_track_id_classifier_data(track_id, ClassifierType.GENDER),
-                            self.annotator, color)
+    def analyze(self, ctx):
 
-        # Display counts on the frame if a region is defined
-        if self.region is not None:
-            self.object_tracker.display_counts(im0, self.annotator)
+        # Set the tracks detected in this frame.
+        self.object_tracker.set_tracks(ctx.detections)
+        self.object_tracker.remove_lost_ids()
+
+        with self.stage_metrics.time(Stage.HEATMAP):
+            for box, track_id in zip(self.object_tracker.boxes, self.object_tracker.track_ids):
+                self.heatmap_manager.apply_heatmap_effect(box)
+                self.object_tracker.store_tracking_history(track_id, box)
+
+        # Classify the clients that waited for a good crop, once it shows up or their deadline passed.
+        self.object_tracker.classify_postponed(ctx.frame)
+
+        # Track history and analyse the objects - only those with history, that did not already leave the store.
+        analyzed = [i for i, track_id in enumerate(self.object_tracker.track_ids)
+                    if self.object_tracker.is_object_has_history(track_id)
+                    and not self.object_tracker.is_customer_a_past_customer(track_id)]
+        directions = self.detect_crossings(analyzed)
 
-        if self.object_tracker.track_data.id is not None:
-            heatmap_copy = self.heatmap_manager.normalize_heatmap(heatmap_copy)
-            im0 = self.heatmap_manager.normalize_heatmap(im0)
+        for i, direction in zip(analyzed, directions):
+            self.perform_analysis(self.object_tracker.boxes[i], self.object_tracker.track_ids[i], direction,
+                                  self.object_tracker.clss[i], ctx.frame)
 
+        # Re-evaluate the low confidence classifications, within the per frame budget.
+        self.object_tracker.reevaluate_classifications(ctx.frame)
+
+        # Classify the new and re-evaluated clients of this frame in one batch.
+        self.object_tracker.classify_pending()
         self.object_tracker.save_prev_ids()
-        return im0, heatmap_copy
 
-    def analyze(self, im0, current_timeslice_frame_count):
+    def snapshot(self, ctx):
 
-        # Copy of the original image for later classification.
-        original_frame = im0.copy()
+        # Take everything the rendering stage needs, as the analysis moves on to the next frames meanwhile.
+        # From this line and on, the ID may be popped out of all data structures. Therefor we don't use the
+        # present client ID because this ID may not have entry there, which will make the program collapse.
+        # Instead, we verify it with counted IDs array.
+        ctx.objects = [(track_id, cls, box,
+                        self.object_tracker.get_track_id_classifier_data(track_id, ClassifierType.AGE),
+                        self.object_tracker.get_track_id_classifier_data(track_id, ClassifierType.GENDER),
+                        RED if not self.object_tracker.is_counted(track_id) else GREEN)
+                       for box, track_id, cls in zip(self.object_tracker.get_boxes(),
+                                                     self.object_tracker.get_track_ids(),
+                                                     self.object_tracker.get_classes())]
 
-        # Copy for a clean heatmap with no box annotations that will be uploaded eventually to the server.
-        heatmap_copy = im0.copy()
+        if self.region is not None:
+            ctx.counts = self.object_tracker.get_counts_snapshot()
 
-        # Extract tracks
-        self.object_tracker.extract_tracks(im0)
-        self.object_tracker.remove_lost_ids()
+        # Heatmap is drawn only on frames with tracks, and its values are taken only when the drawn heatmap is due for
+        # a refresh, or for the final upload.
+        ctx.show_heatmap = ctx.detections.has_tracks()
+        if ctx.show_heatmap and (ctx.is_last or self.last_heatmap_refresh is None or
+                                 ctx.index - self.last_heatmap_refresh >= HEATMAP_REFRESH_INTERVAL):
+            ctx.heatmap, ctx.heatmap_max = self.heatmap_manager.snapshot()
+            self.last_heatmap_refresh = ctx.index
 
-        self.annotator = Annotator(im0, line_width=self.line_width)
+    def render(self, ctx):
+        im0 = ctx.frame
 
-        for box, track_id, cls in zip(self.object_tracker.boxes, self.object_tracker.track_ids, self.object_tracker.clss):
-            self.heatmap_manager.apply_heatmap_effect(box)
-            self.object_tracker.store_tracking_history(track_id, box)
+        # Copy for a clean heatmap with no box annotations that will be uploaded eventually to the server. Only the
+        # last frame is uploaded, so it is the only one rendered clean.
+        heatmap_copy = im0.copy() if ctx.is_last else None
+
+        with self.stage_metrics.time(Stage.ANNOTATE):
+            annotator = Annotator(im0, line_width=self.line_width)
+            for track_id, cls, box, age, gender, color in ctx.objects:
 
-            # Draw the defined region if specified
+                # Draw the defined region if specified
+                if self.region is not None:
+                    annotator.draw_region(reg_pts=self.region, color=PURPLE, thickness=self.line_width * 2)
+
+                annotate_object(track_id, cls, box, age, gender, annotator, color)
+
+            # Display counts on the frame if a region is defined, and only for the annotated heatmap.
             if self.region is not None:
-                self.annotator.draw_region(reg_pts=self.region, color=PURPLE, thickness=self.line_width * 2)
-
-            # Track history and analyse the object.
-            prev_position = None
-            if self.object_tracker.is_object_has_history(track_id):
-                prev_position = self.object_tracker.get_prev_position(track_id)
-                if not self.object_tracker.is_customer_a_past_customer(track_id):
-                    self.perform_analysis(box, track_id, prev_position, cls, original_frame)
-
-            # From this line and on, the ID may be popped out of all data structures. Therefor we don't use the
-            # present client ID because this ID may not have entry there, which will make the program collapse.
-            # Instead, we verify it with counted IDs array.
-            color = RED if track_id not in  self.object_tracker.counted_ids else GREEN
-
-            annotate_object(track_id, cls, box,
-                            self.object_tracker.get_track_id_classifier_data(track_id, ClassifierType.AGE),
-                            self.object_tracker.get_track_id_classifier_data(track_id, ClassifierType.GENDER),
-                            self.annotator, color)
-
-            # If its re-evaluating time.
-            if track_id is self.object_tracker.counted_ids:
-                if current_timeslice_frame_count % REEVALUATION_INTERVAL == 0:
-                    self.object_tracker.reevaluate_classification(original_frame, track_id, box)
-
-        # Display counts on the frame if a region is defined, and only for the annotated heatmap.
-        if self.region is not None:
-            self.object_tracker.display_counts(im0, self.annotator)
+                self.display_counts(im0, annotator, ctx.counts)
 
         # If the ID exist (safety check) annotate its heatmap values.
-        if self.object_tracker.track_data.id is not None:
-            heatmap_copy = self.heatmap_manager.normalize_heatmap(heatmap_copy)
-            im0 = self.heatmap_manager.normalize_heatmap(im0)
+        if ctx.show_heatmap:
+            with self.stage_metrics.time(Stage.HEATMAP_RENDER):
+                if ctx.heatmap is not None:
+                    self.heatmap_overlay = self.heatmap_manager.colorize(ctx.heatmap, (im0.shape[1], im0.shape[0]),
+                                                                         ctx.heatmap_max)
+                if heatmap_copy is not None:
+                    heatmap_copy = self.heatmap_manager.blend(heatmap_copy, self.heatmap_overlay)
+                im0 = self.heatmap_manager.blend(im0, self.heatmap_overlay)
 
-        self.object_tracker.save_prev_ids()
+        ctx.annotated, ctx.clean = im0, heatmap_copy
+
+    @staticmethod
+    def display_counts(im0, annotator, labels_dict):
+        annotator.display_analytics(im0, labels_dict, (104, 31, 17), (255, 255, 255), 10)
 
-        return im0, heatmap_copy
+    def detect_crossings(self, indices):
+        if self.line_crossing is None or not indices:
+            return [CrossingDirection.NONE.value] * len(indices)
 
-    def perform_analysis(self, box, track_id, prev_position, cls, original_frame):
-        if prev_position is None:
-            return
+        # Test the moves of all analyzed tracks against the counting line in one pass.
+        prev_positions = self.object_tracker.get_prev_positions([self.object_tracker.track_ids[i] for i in indices])
+        return self.line_crossing.detect(prev_positions, self.object_tracker.boxes[indices]).tolist()
 
-        # Calculate the change in the object's y_axis to determine the direction.
-        dy = ((box[1] + box[3]) / 2) - prev_position[1]
+    def perform_analysis(self, box, track_id, direction, cls, original_frame):
 
-        # If the object path intersect with the defined line region.
-        if len(self.region) < 3 and self.LineString([prev_position, box[:2]]).intersects(self.r_s):
+        # If the object path intersect with the defined line region, moving to the top of the screen.
+        if direction == CrossingDirection.IN.value:
+            if not self.object_tracker.is_current_customer(track_id):
+                self.object_tracker.add_new_client(original_frame, track_id, cls, box)
 
-            # If dy < 0, it means that prev_y > current_y, and therefore client moving to the top of the screen.
-            if dy < 0:
-                if not self.object_tracker.is_current_customer(track_id):
-                    self.object_tracker.add_new_client(original_frame, track_id, cls, box)
-            else:
-                self.object_tracker.remove_client(track_id, cls)
+        # Moving to the bottom of the screen.
+        elif direction == CrossingDirection.OUT.value:
+            self.object_tracker.remove_client(track_id, cls)
 
         else:
 
-            # If object is not already customer, and not already in dirty IDs, and do not have recent history recoreded,
-            # by the tracker, it is a new dirty entrance ID. The recent history part was added because of flapps the
-            # detector has when it misses object for 1-2 frames and then re-track it.
-            if (not self.object_tracker.is_current_customer(track_id) and track_id not in self.object_tracker.dirty_ids
-                    and track_id not in self.object_tracker.track_data):
+            # If object is not already customer, and not already in dirty IDs, it is a new dirty entrance ID.
+            if not self.object_tracker.is_current_customer(track_id) and not self.object_tracker.is_dirty(track_id):
                 LOGGER.info(f"ID: {track_id}, Dirty Entrance")
                 self.object_tracker.count_dirty_id(track_id, cls)
@@ -0,0 +1,157 @@
+import queue
+import threading
+
+from util import PIPELINE_QUEUE_SIZE
+
+# Marks the end of the stream in the stage queues.
+_END = object()
+
+# Seconds a blocked stage waits before checking whether the pipeline was stopped.
+_POLL_INTERVAL = 0.1
+
+
+class FrameContext:
+    """
+    Everything the stages know about a single frame, passed from one stage to the next.
+    """
+
+    def __init__(self, index, frame):
+
+        # Position of the frame in the analyzed stream, and the decoded image itself.
+        self.index = index
+        self.frame = frame
+
+        # Whether this is the last frame of the stream - known to the decoder as it reads one frame ahead.
+        self.is_last = False
+
+        # Tracked detections, filled by the detection stage.
+        self.detections = None
+
+        # Snapshot of the analysis state needed for drawing, filled by the analysis stage: per object
+        # (track_id, cls, box, age, gender, color), the class-wise counts, whether the heatmap is drawn on this frame,
+        # and the heatmap values with their max - only on the frames the drawn heatmap is refreshed.
+        self.objects = []
+        self.counts = None
+        self.show_heatmap = False
+        self.heatmap = None
+        self.heatmap_max = None
+
+        # Rendered images, filled by the rendering stage. The clean heatmap is rendered for the last frame only.
+        self.annotated = None
+        self.clean = None
+
+
+class FramePipeline:
+    """
+    Runs a source and a chain of stages over a stream of frames.
+
+    In pipelined mode every stage runs in its own thread, connected to the next one by a bounded queue. Each stage
+    is a single thread and the queues are FIFO, so the order of the frames is kept, and every stage sees the frames
+    one by one, exactly as in the serial mode, where all stages run in the calling thread.
+
+    A stage is a `process(item, emit)` callable which may emit any number of items to the next stage, and an optional
+    `flush(emit)` callable, called once the stream ended.
+    """
+
+    def __init__(self, pipelined=True, queue_size=PIPELINE_QUEUE_SIZE):
+        self.pipelined = pipelined
+        self.queue_size = queue_size
+
+        # Stages in order, as (name, process, flush) tuples.
+        self.stages = []
+
+        # First error raised by any of the stage threads, re-raised by run().
+        self.error = None
+        self.error_lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def add_stage(self, name, process, flush=None):
+        self.stages.append((name, process, flush))
+        return self
+
+    def run(self, source):
+        if self.pipelined:
+            self.run_pipelined(source)
+        else:
+            self.run_serial(source)
+
+    def run_serial(self, source):
+
+        # Chain the stages from the last one backwards, so each emit calls straight into the next stage.
+        emits = [lambda item: None]
+        for name, process, flush in reversed(self.stages):
+            next_emit = emits[0]
+            emits.insert(0, lambda item, process=process, next_emit=next_emit: process(item, next_emit))
+
+        source(emits[0])
+        for i, (name, process, flush) in enumerate(self.stages):
+            if flush is not None:
+                flush(emits[i + 1])
+
+    def run_pipelined(self, source):
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+
+        threads = [threading.Thread(target=self.run_source, args=(source, queues[0]), name="pipeline-source",
+                                    daemon=True)]
+        for i, (name, process, flush) in enumerate(self.stages):
+            out_queue = queues[i + 1] if i + 1 < len(queues) else None
+            threads.append(threading.Thread(target=self.run_stage, args=(process, flush, queues[i], out_queue),
+                                            name=f"pipeline-{name}", daemon=True))
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def run_source(self, source, out_queue):
+        try:
+            source(lambda item: self.put(out_queue, item))
+            self.put(out_queue, _END)
+        except Exception as e:
+            self.fail(e)
+
+    def run_stage(self, process, flush, in_queue, out_queue):
+        emit = (lambda item: self.put(out_queue, item)) if out_queue is not None else (lambda item: None)
+        try:
+            while True:
+                item = self.get(in_queue)
+                if item is _END:
+                    if flush is not None:
+                        flush(emit)
+                    emit(_END)
+                    return
+                process(item, emit)
+        except Exception as e:
+            self.fail(e)
+
+    def put(self, out_queue, item):
+        while not self.stop_event.is_set():
+            try:
+                out_queue.put(item, timeout=_POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+        raise _Stopped()
+
+    def get(self, in_queue):
+        while not self.stop_event.is_set():
+            try:
+                return in_queue.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        raise _Stopped()
+
+    def fail(self, error):
+
+        # Keep the first error only - the rest are the other stages being stopped because of it.
+        with self.error_lock:
+            if not isinstance(error, _Stopped) and self.error is None:
+                self.error = error
+        self.stop_event.set()
+
+
+class _Stopped(Exception):
+    pass
@@ -1,11 +1,28 @@
+from functools import lru_cache
+
 import numpy as np
 import cv2
 
+from util import HEATMAP_SCALE, HEATMAP_INCREMENT, HEATMAP_KERNEL_CACHE_SIZE
+
+
+@lru_cache(maxsize=HEATMAP_KERNEL_CACHE_SIZE)
+def disk_kernel(width, height):
+
+    # Disk inscribed in a box of the given size, centered in it. Kernels are shared by all jobs and never modified.
+    radius_squared = (min(width, height) // 2) ** 2
+    yv, xv = np.ogrid[0:height, 0:width]
+    within_radius = (xv - width // 2) ** 2 + (yv - height // 2) ** 2 <= radius_squared
+    kernel = within_radius.astype(np.float32) * HEATMAP_INCREMENT
+    kernel.setflags(write=False)
+    return kernel
+
+
 class HeatmapManager:
 
     def __init__(self, CFG):
 
-        # Will store heatmap values.
+        # Will store heatmap values - a single channel accumulator, downscaled relative to the frame.
         self.heatmap = None
 
         # Configuration file.
@@ -14,36 +31,56 @@ class HeatmapManager:
         # Colormap of the heatmap.
         self.colormap = cv2.COLORMAP_PARULA if self.CFG["colormap"] is None else self.CFG["colormap"]
 
-    def initialize_heatmap(self, frame):
-        self.heatmap = np.zeros_like(frame, dtype=np.float32)
-
-
-    def apply_heatmap_effect(self, box):
-        x0, y0, x1, y1 = map(int, box)
-        radius_squared = (min(x1 - x0, y1 - y0) // 2) ** 2
-
-        # Create a meshgrid with region of interest (ROI) for vectorized distance calculations
-        xv, yv = np.meshgrid(np.arange(x0, x1), np.arange(y0, y1))
-
-        # Calculate squared distances from the center
-        dist_squared = (xv - ((x0 + x1) // 2)) ** 2 + (yv - ((y0 + y1) // 2)) ** 2
-
-        # Create a mask of points within the radius
-        within_radius = dist_squared <= radius_squared
-
-        # Update only the values within the bounding box in a single vectorized operation
-        self.heatmap[y0:y1, x0:x1][within_radius] += 2
-
-    def normalize_heatmap(self, im0):
-        return cv2.addWeighted(
-            im0,
-            0.5,
-            cv2.applyColorMap(
-                cv2.normalize(self.heatmap, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8), self.colormap
-            ),
-            0.5,
-            0,
-        )
+        # Scale of the accumulator relative to the frame. The heatmap is upsampled only when it is displayed.
+        self.scale = HEATMAP_SCALE
 
+        # Running max of the heatmap values. Values only grow, so it replaces a full min/max pass when colorizing.
+        self.max_value = 0.0
 
+    def initialize_heatmap(self, frame):
+        height, width = frame.shape[:2]
+        self.heatmap = np.zeros((max(1, round(height * self.scale)), max(1, round(width * self.scale))),
+                                dtype=np.float32)
 
+    def apply_heatmap_effect(self, box):
+        x0, y0, x1, y1 = (int(coordinate * self.scale) for coordinate in box)
+        if x1 <= x0 or y1 <= y0:
+            return
+
+        # Clip the box to the heatmap, boxes of objects at the edge may extend beyond the frame.
+        height, width = self.heatmap.shape
+        cx0, cy0, cx1, cy1 = max(x0, 0), max(y0, 0), min(x1, width), min(y1, height)
+        if cx1 <= cx0 or cy1 <= cy0:
+            return
+
+        # Add the cached disk of this box size, only the part of it that falls inside the heatmap.
+        kernel = disk_kernel(x1 - x0, y1 - y0)
+        region = self.heatmap[cy0:cy1, cx0:cx1]
+        region += kernel[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0]
+        self.max_value = max(self.max_value, float(region.max()))
+
+    def snapshot(self):
+        return self.heatmap.copy(), self.max_value
+
+    def colorize(self, heatmap, size, max_value=None):
+
+        # The heatmap starts at zero and only grows, so scaling by the running max gives the same result as a min/max
+        # normalization, without the extra pass over the values.
+        if max_value is None:
+            normalized = cv2.normalize(heatmap, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+        else:
+            normalized = cv2.convertScaleAbs(heatmap, alpha=255.0 / max_value if max_value > 0 else 0)
+
+        # Colorize at the accumulator resolution, and only then upsample to the size of the displayed frame.
+        colored = cv2.applyColorMap(normalized, self.colormap)
+        if colored.shape[1::-1] != size:
+            colored = cv2.resize(colored, size, interpolation=cv2.INTER_LINEAR)
+        return colored
+
+    @staticmethod
+    def blend(im0, colored_heatmap):
+        return cv2.addWeighted(im0, 0.5, colored_heatmap, 0.5, 0)
+
+    def normalize_heatmap(self, im0, heatmap=None):
+        heatmap = self.heatmap if heatmap is None else heatmap
+        return self.blend(im0, self.colorize(heatmap, (im0.shape[1], im0.shape[0])))
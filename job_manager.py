@@ -0,0 +1,181 @@
+import queue
+import threading
+import time
+from collections import deque
+
+from ultralytics.utils import LOGGER
+
+from computer_vision_service import ComputerVisionService
+from stage_metrics import STAGE_METRICS, escape_label
+from util import JobStatus, MAX_CONCURRENT_JOBS, MAX_QUEUED_JOBS, MAX_FINISHED_JOBS
+
+
+class JobQueueFullError(Exception):
+    pass
+
+
+class DuplicateJobError(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, data):
+
+        # Data given by the server through the API call. Consist of jobId and a download link for the video.
+        self.data = data
+        self.job_id = str(data["jobId"])
+
+        # Lifecycle of the job, as reported by the status endpoint.
+        self.status = JobStatus.QUEUED
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+        # Computer vision service that runs the analysis. Created only once a worker picks the job up, so queued jobs
+        # hold no models or video captures.
+        self.cv_service = None
+
+        # Last (time, frames) sample used to measure the current processing rate.
+        self.fps_sample = None
+        self.fps = 0.0
+
+    def run(self):
+        self.status = JobStatus.RUNNING
+        self.started_at = time.time()
+        self.fps_sample = (self.started_at, 0)
+        LOGGER.info(f"Job {self.job_id} started")
+
+        try:
+            self.cv_service = ComputerVisionService(self.data)
+            self.cv_service.start()
+            self.status = JobStatus.DONE
+            LOGGER.info(f"Job {self.job_id} done")
+
+        # A failing job must not take its worker down with it.
+        except Exception as e:
+            self.error = str(e)
+            self.status = JobStatus.FAILED
+            LOGGER.error(f"Job {self.job_id} failed: {e}")
+
+        finally:
+            self.finished_at = time.time()
+
+    def get_frames_processed(self):
+        if self.cv_service is None:
+            return 0
+        return self.cv_service.video_manager.get_processed_frame_count()
+
+    def get_frames_gated(self):
+        if self.cv_service is None:
+            return 0
+        return self.cv_service.video_manager.get_gated_frame_count()
+
+    def update_fps(self):
+
+        # The rate is measured between two consecutive status requests, so it reflects the current speed of the job
+        # rather than its average since the start.
+        if self.status != JobStatus.RUNNING:
+            self.fps = 0.0
+            return
+
+        now, frames = time.time(), self.get_frames_processed()
+        prev_time, prev_frames = self.fps_sample
+        if now - prev_time >= 1:
+            self.fps = (frames - prev_frames) / (now - prev_time)
+            self.fps_sample = (now, frames)
+
+    def is_active(self):
+        return self.status in (JobStatus.QUEUED, JobStatus.RUNNING)
+
+    def to_dict(self):
+        self.update_fps()
+        return {
+            "jobId": self.job_id,
+            "status": self.status.value,
+            "framesProcessed": self.get_frames_processed(),
+            "framesGated": self.get_frames_gated(),
+            "fps": round(self.fps, 2),
+            "error": self.error,
+        }
+
+
+class JobManager:
+    def __init__(self, max_workers=MAX_CONCURRENT_JOBS, max_queued=MAX_QUEUED_JOBS):
+
+        # All known jobs by their id - queued, running and recently finished ones.
+        self.jobs = {}
+
+        # Ids of finished jobs in finishing order, so the oldest can be forgotten.
+        self.finished_job_ids = deque()
+
+        # Bounded queue of jobs waiting for a free worker.
+        self.queue = queue.Queue(maxsize=max_queued)
+
+        self.lock = threading.Lock()
+
+        # Worker pool that drains the queue. Each worker analyzes a single video at a time.
+        self.workers = [threading.Thread(target=self.work, name=f"job-worker-{i}", daemon=True)
+                        for i in range(max_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, data):
+        job = Job(data)
+
+        with self.lock:
+            existing = self.jobs.get(job.job_id)
+            if existing is not None and existing.is_active():
+                raise DuplicateJobError(f"Job {job.job_id} is already {existing.status.value}")
+
+            try:
+                self.queue.put_nowait(job)
+            except queue.Full:
+                raise JobQueueFullError("Too many videos are waiting for analysis, try again later")
+
+            self.jobs[job.job_id] = job
+
+        LOGGER.info(f"Job {job.job_id} queued")
+        return job
+
+    def get_job(self, job_id):
+        with self.lock:
+            return self.jobs.get(str(job_id))
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                job.run()
+            finally:
+                self.forget_old_jobs(job)
+                self.queue.task_done()
+
+    def forget_old_jobs(self, job):
+        with self.lock:
+            self.finished_job_ids.append(job.job_id)
+            while len(self.finished_job_ids) > MAX_FINISHED_JOBS:
+                job_id = self.finished_job_ids.popleft()
+
+                # The id may have been re-submitted since, only drop it if that job is also finished.
+                if job_id in self.jobs and not self.jobs[job_id].is_active():
+                    self.jobs.pop(job_id)
+                    STAGE_METRICS.forget(job_id)
+
+    def render_metrics(self):
+        with self.lock:
+            jobs = [job for job in self.jobs.values() if job.status == JobStatus.RUNNING]
+
+        # Current processing rate of the running jobs, to alert on a camera that falls behind.
+        lines = ["# HELP store_analysis_job_fps Frames analyzed per second by each running job.",
+                 "# TYPE store_analysis_job_fps gauge"]
+        for job in jobs:
+            job.update_fps()
+            lines.append(f'store_analysis_job_fps{{job="{escape_label(job.job_id)}"}} {job.fps}')
+
+        lines += ["# HELP store_analysis_job_frames_processed Frames analyzed so far by each running job.",
+                  "# TYPE store_analysis_job_frames_processed counter"]
+        for job in jobs:
+            lines.append(f'store_analysis_job_frames_processed{{job="{escape_label(job.job_id)}"}} '
+                         f'{job.get_frames_processed()}')
+        return lines
@@ -0,0 +1,68 @@
+import numpy as np
+
+from util import CrossingDirection
+
+
+def _orientation(origin, direction, points):
+
+    # Sign of the cross product of `direction` with (`points` - `origin`): 1 for left, -1 for right, 0 for collinear.
+    return np.sign(direction[..., 0] * (points[..., 1] - origin[..., 1]) -
+                   direction[..., 1] * (points[..., 0] - origin[..., 0]))
+
+
+def _within_bounds(start, end, points):
+
+    # Whether collinear `points` lie between `start` and `end`.
+    return ((np.minimum(start[..., 0], end[..., 0]) <= points[..., 0]) &
+            (points[..., 0] <= np.maximum(start[..., 0], end[..., 0])) &
+            (np.minimum(start[..., 1], end[..., 1]) <= points[..., 1]) &
+            (points[..., 1] <= np.maximum(start[..., 1], end[..., 1])))
+
+
+class LineCrossingDetector:
+    """
+    Tests the moves of all tracks of a frame against the counting line at once.
+
+    A track crosses the line when the segment from its previous position to its current position intersects the line,
+    touching included. The direction is taken from the change in the y coordinate of the box center: moving to the top
+    of the screen is an entrance, anything else is an exit.
+    """
+
+    def __init__(self, region):
+        self.start = np.asarray(region[0], dtype=np.float64)
+        self.end = np.asarray(region[1], dtype=np.float64)
+
+    def intersects(self, prev_positions, positions):
+        prev_positions = np.asarray(prev_positions, dtype=np.float64).reshape(-1, 2)
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        line_direction = self.end - self.start
+        moves = positions - prev_positions
+
+        # Orientation of the track's end points relative to the line, and of the line's end points relative to the
+        # track's move.
+        d1 = _orientation(self.start, line_direction, prev_positions)
+        d2 = _orientation(self.start, line_direction, positions)
+        d3 = _orientation(prev_positions, moves, self.start)
+        d4 = _orientation(prev_positions, moves, self.end)
+
+        # Proper crossing, or an end point lying on the other segment. A track that did not move has no path, and
+        # never crosses.
+        return (np.any(moves != 0, axis=1) &
+                (((d1 * d2 < 0) & (d3 * d4 < 0)) |
+                 ((d1 == 0) & _within_bounds(self.start, self.end, prev_positions)) |
+                 ((d2 == 0) & _within_bounds(self.start, self.end, positions)) |
+                 ((d3 == 0) & _within_bounds(prev_positions, positions, self.start)) |
+                 ((d4 == 0) & _within_bounds(prev_positions, positions, self.end))))
+
+    def detect(self, prev_positions, boxes):
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        prev_positions = np.asarray(prev_positions, dtype=np.float64).reshape(-1, 2)
+
+        # The move ends at the top-left corner of the current box, while the direction is measured on box centers.
+        crossed = self.intersects(prev_positions, boxes[:, :2])
+        dy = (boxes[:, 1] + boxes[:, 3]) / 2 - prev_positions[:, 1]
+
+        directions = np.full(len(boxes), CrossingDirection.NONE.value, dtype=np.int8)
+        directions[crossed & (dy < 0)] = CrossingDirection.IN.value
+        directions[crossed & (dy >= 0)] = CrossingDirection.OUT.value
+        return directions
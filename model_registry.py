@@ -0,0 +1,175 @@
+import ast
+import copy
+import hashlib
+import os
+import shutil
+import threading
+
+import numpy as np
+from ultralytics import YOLO
+from ultralytics.utils import LOGGER
+
+from util import WeightsPath, InferenceBackend, INFERENCE_BACKEND, QUANTIZED_CLASSIFIERS, WARM_UP_IMAGE_SIZE
+
+
+def file_digest(path):
+
+    # Hash of the weights file, so an export is redone whenever the weights are replaced.
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def get_export_path(weights, backend, digest):
+
+    # Exports are cached next to the weights, e.g. weights/yolo11n-<digest>.onnx. These are the names Ultralytics gives
+    # the exports of a weights file named <stem>-<digest>.pt.
+    stem = os.path.splitext(weights)[0]
+    if backend == InferenceBackend.OPENVINO:
+        return f"{stem}-{digest}_openvino_model"
+    return f"{stem}-{digest}.{backend.value}"
+
+
+def get_quantized_path(weights, digest):
+
+    # INT8 classifiers are built offline from a calibration set (scripts/quantize_classifiers.py), and are stored next
+    # to the weights they were built from.
+    return f"{os.path.splitext(weights)[0]}-{digest}-int8.onnx"
+
+
+def load_model(weights, backend=InferenceBackend.PYTORCH, quantized=False):
+    source = YOLO(weights)
+
+    # The quantized version of a classifier is used when it was built for the current weights.
+    if quantized and source.task == "classify":
+        quantized_path = get_quantized_path(weights, file_digest(weights))
+        if os.path.exists(quantized_path):
+            return set_image_size(YOLO(quantized_path, task=source.task), get_onnx_image_size(quantized_path))
+        LOGGER.warning(f"No INT8 model for {weights} at {quantized_path}, using {backend.value}")
+
+    if backend == InferenceBackend.PYTORCH:
+        return source
+
+    digest = file_digest(weights)
+    export_path = get_export_path(weights, backend, digest)
+    if not os.path.exists(export_path):
+        LOGGER.info(f"Exporting {weights} to {backend.value}")
+
+        # The export is made from a copy of the weights named by their digest, so all the files it writes (e.g. the
+        # external data of a large ONNX model) are named by the digest as well, and never overwrite an older export.
+        stem, extension = os.path.splitext(weights)
+        staged_weights = f"{stem}-{digest}{extension}"
+        shutil.copyfile(weights, staged_weights)
+        try:
+
+            # Batch size is left dynamic, as the classifiers run on batches of crops, and so is the image size, so
+            # frames are letterboxed the same way as with PyTorch.
+            YOLO(staged_weights).export(format=backend.value, dynamic=True)
+        finally:
+            os.remove(staged_weights)
+
+    # The task is not stored in a way Ultralytics can tell from the export's file name, so it is taken from the source,
+    # and so is the input size, which the predictor of an exported model would otherwise take from the defaults.
+    return set_image_size(YOLO(export_path, task=source.task), source.overrides.get("imgsz"))
+
+
+def get_onnx_image_size(path):
+
+    # ONNX is only needed with the quantized classifiers, so the default PyTorch backend runs without it installed.
+    import onnx
+
+    # Input size Ultralytics stored in the metadata of the ONNX model, e.g. "[224, 224]".
+    metadata = {prop.key: prop.value for prop in onnx.load(path, load_external_data=False).metadata_props}
+    return max(ast.literal_eval(metadata["imgsz"])) if "imgsz" in metadata else None
+
+
+def set_image_size(model, image_size):
+    if image_size is not None:
+        model.overrides["imgsz"] = image_size
+    return model
+
+
+class ModelRegistry:
+    """
+    Process-wide store of loaded YOLO models.
+
+    Each set of weights is loaded and warmed up once per process. Jobs never use the loaded models directly, they
+    borrow a view of them instead: the view shares the network weights, but owns its predictor, and with it the
+    tracker state that `model.track(persist=True)` keeps between frames.
+
+    With an exported backend, the registry holds a model over the cached export, and each view opens its own runtime
+    session on first use.
+    """
+
+    def __init__(self, backend=INFERENCE_BACKEND, quantized_classifiers=QUANTIZED_CLASSIFIERS):
+
+        # Loaded models by their weights path.
+        self.models = {}
+
+        # Runtime the models are run with, and whether the classifiers run their INT8 versions.
+        self.backend = InferenceBackend(backend)
+        self.quantized_classifiers = quantized_classifiers
+
+        # Guards loading, so two jobs that start together won't load the same weights twice.
+        self.lock = threading.Lock()
+
+    def load(self, weights_path):
+        with self.lock:
+            model = self.models.get(weights_path)
+            if model is None:
+                LOGGER.info(f"Loading model {weights_path.value} with {self.backend.value}")
+                model = self.load_with_fallback(weights_path.value)
+                self.warm_up_model(model)
+                self.models[weights_path] = model
+            return model
+
+    def load_with_fallback(self, weights):
+        try:
+            return load_model(weights, self.backend, self.quantized_classifiers)
+
+        # A failed export should not stop the analysis, the weights still run with PyTorch.
+        except Exception as e:
+            if self.backend == InferenceBackend.PYTORCH:
+                raise
+            LOGGER.warning(f"Failed to load {weights} with {self.backend.value}, falling back to PyTorch: {e}")
+            return load_model(weights)
+
+    def warm_up(self):
+
+        # Load all the models the analysis uses ahead of the first job.
+        for weights_path in WeightsPath:
+            self.load(weights_path)
+
+    def borrow(self, weights_path):
+        model = self.load(weights_path)
+
+        # Shallow copy shares the underlying network, while the predictor is dropped so the view builds its own on
+        # first use. Callbacks are copied as well, as tracking registers its per-stream callbacks on the model.
+        view = copy.copy(model)
+        view.predictor = None
+        view.callbacks = {event: list(funcs) for event, funcs in model.callbacks.items()}
+        view.overrides = dict(model.overrides)
+        return view
+
+    def get_image_size(self, weights_path):
+        model = self.load(weights_path)
+
+        # Input size of the model - taken from the weights' training arguments, or from the metadata of an export. The
+        # predictor resolves both, so it is read from the predictor once there is one.
+        if model.predictor is None:
+            self.warm_up_model(model)
+        image_size = model.predictor.args.imgsz
+        return int(max(image_size)) if isinstance(image_size, (list, tuple)) else int(image_size)
+
+    @staticmethod
+    def warm_up_model(model):
+
+        # A first inference on a blank image fuses the layers and allocates the inference buffers, so the first job
+        # doesn't pay for it.
+        model.predict(np.zeros((WARM_UP_IMAGE_SIZE, WARM_UP_IMAGE_SIZE, 3), dtype=np.uint8), verbose=False)
+
+
+# Single registry of the process, shared by all jobs.
+MODEL_REGISTRY = ModelRegistry()
@@ -0,0 +1,44 @@
+import cv2
+import numpy as np
+
+from util import MOTION_GATE_WIDTH, MOTION_PIXEL_THRESHOLD, MOTION_AREA_THRESHOLD
+
+
+class MotionGate:
+    """
+    Cheap test of whether anything moved since the last frame the detector ran on.
+
+    Frames are compared downscaled, in grayscale and slightly blurred, so sensor noise and compression artifacts don't
+    count as motion. Frames are compared with the last detected frame rather than with the previous one, so a slow
+    change still adds up until it opens the gate.
+    """
+
+    def __init__(self, width=MOTION_GATE_WIDTH, pixel_threshold=MOTION_PIXEL_THRESHOLD,
+                 area_threshold=MOTION_AREA_THRESHOLD):
+
+        # Width the frames are downscaled to before they are compared.
+        self.width = width
+
+        # Change of a pixel value that counts as a changed pixel, and the fraction of changed pixels that is motion.
+        self.pixel_threshold = pixel_threshold
+        self.area_threshold = area_threshold
+
+        # Downscaled last detected frame.
+        self.reference = None
+
+    def downscale(self, frame):
+        height, width = frame.shape[:2]
+        size = (self.width, max(1, round(height * self.width / width)))
+        small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(small, (3, 3), 0)
+
+    def set_reference(self, frame):
+        self.reference = self.downscale(frame)
+
+    def is_static(self, frame):
+        if self.reference is None:
+            return False
+        changed = cv2.absdiff(self.downscale(frame), self.reference) > self.pixel_threshold
+        return np.count_nonzero(changed) < self.area_threshold * changed.size
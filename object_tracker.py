@@ -1,18 +1,37 @@
-from collections import defaultdict
-from util import ExitType, EntranceType, PastCustomer, DwellTime, CountType, ClassifierType, LOW_CONF
+import copy
+from detections import Detections
+from track_state_store import TrackStateStore
+from track_history import TrackHistory
+from reclassification_scheduler import ReclassificationScheduler
+from classification_gate import ClassificationGate
+from stage_metrics import StageMetrics
+from util import (ExitType, EntranceType, DwellTime, CountType, ClassifierType, Stage, crop_to_image,
+                  CLASSIFICATION_BATCH_WINDOW, NOT_DETECTED)
 from ultralytics.utils import LOGGER
 from classifiers.age_classifier import AgeClassifier
 from classifiers.gender_classifier import GenderClassifier
+from classifiers.replay_classifier import ReplayClassifier
 
 
 class ObjectTracker:
 
     #TODO:Add support in past_dirty_ids -> the tracker acount flap in dirty IDS as new dirty ID. Need to add mechanism for detecting previous dirty IDs
-    def __init__(self, object_counter, video_manager, model, CFG):
+    def __init__(self, object_counter, video_manager, model, CFG, debug_crop_writer=None, detection_server=None,
+                 stage_metrics=None, detection_recorder=None, detection_replay=None):
 
         # YOLO Model that will be used in order to track customers.
         self.model = model
 
+        # Stage timers of the job.
+        self.stage_metrics = stage_metrics if stage_metrics is not None else StageMetrics()
+
+        # Tracker of this stream when detection runs on the shared detection server, None when the model detects and
+        # tracks on its own. Imported only then, as it pulls in the Ultralytics trackers.
+        self.stream_tracker = None
+        if detection_server is not None:
+            from detection_server import StreamTracker
+            self.stream_tracker = StreamTracker(detection_server, CFG["classes"], CFG["tracker"], CFG["conf"])
+
         # Configuration structure.
         self.CFG = CFG
 
@@ -22,18 +41,30 @@ class ObjectTracker:
         # Object Counter - its responsibility is to handle the counting logic in the program.
         self.object_counter = object_counter
 
-        # Classifiers for demographic analysis.
-        self.age_classifier = AgeClassifier()
-        self.gender_classifier = GenderClassifier()
+        # Classifiers for demographic analysis. A replayed job gives each track its recorded results on the frames they
+        # were recorded on, with no model and no crop.
+        self.detection_replay = detection_replay
+        if detection_replay is not None:
+            self.age_classifier = ReplayClassifier(detection_replay, ClassifierType.AGE.value, debug_crop_writer,
+                                                   detection_recorder)
+            self.gender_classifier = ReplayClassifier(detection_replay, ClassifierType.GENDER.value, debug_crop_writer,
+                                                      detection_recorder)
+        else:
+            self.age_classifier = AgeClassifier(debug_crop_writer, detection_recorder)
+            self.gender_classifier = GenderClassifier(debug_crop_writer, detection_recorder)
 
-        # Track the history of each detected ID (up to 30 frames).
-        self.track_history = defaultdict(list)
+        # Re-classifies low confidence tracks from their best crops, within a fixed number of crops per frame.
+        self.reclassification = ReclassificationScheduler([self.age_classifier, self.gender_classifier],
+                                                          stage_metrics=self.stage_metrics)
 
-        # Holds the raw tracking info fo each detection.
-        self.tracks = None
+        # Postpones the classification of new clients until a crop good enough to classify shows up.
+        self.classification_gate = ClassificationGate()
 
-        # Holds the boxes of each track object.
-        self.track_data = None
+        # Track the history of each detected ID (up to 30 frames).
+        self.track_history = TrackHistory()
+
+        # Holds the tracked detections of the current frame.
+        self.detections = None
 
         # Holds the unique ids detected in the current frame.
         self.track_ids = None
@@ -48,62 +79,57 @@ class ObjectTracker:
         # Clients from previous frame.
         self.prev_track_ids = None
 
-        # Dirty IDs - Clients who entered the frame not through the entrance line.
-        self.dirty_ids = []
-
-        # Counted IDs - representing the real clients in the store who entered cleanly through the entrance.
-        self.counted_ids = []
-
-        # Data structure that assign each client all the information needed to count his dwell time in the store.
-        self.dwell_times = defaultdict()
-
-        # Boolean array that is used to distinguish between dirty clients and real clients.
-        self.present_clients = defaultdict()
-
-        # Past customers - global array that won't be reset until the termination of the program.
-        self.past_customers = []
-
-        # Past customers in current timeslice - will be reseated with each new timeslice.
-        self.past_customers_in_timeslice = []
+        # Track state store - presence, dirty/clean state and dwell time of each track, and the past customers, all
+        # indexed by track id.
+        self.track_state = TrackStateStore()
 
+        # Frames since the pending classification requests were last run as a batch.
+        self.frames_since_classification = 0
 
     def extract_tracks(self, im0):
 
-        self.tracks = self.model.track(source=im0, persist=True, classes=self.CFG["classes"])
-        LOGGER.info("Extracting tracks")
+        # Only runs the model - the tracker state is updated later by set_tracks, so detection can run ahead of the
+        # analysis of previous frames.
+        if self.stream_tracker is not None:
+            detections = self.stream_tracker.track(im0)
+        else:
+            results = self.model.track(source=im0, persist=True, classes=self.CFG["classes"],
+                                       tracker=self.CFG["tracker"], conf=self.CFG["conf"])
+            detections = Detections.from_results(results[0])
+        LOGGER.debug("Extracting tracks")
+
+        return detections
 
-        # Extract tracks for OBB or object detection
-        self.track_data = self.tracks[0].obb or self.tracks[0].boxes
+    def set_tracks(self, detections):
+        self.detections = detections
+        self.boxes, self.clss, self.track_ids = detections.boxes, detections.clss, detections.track_ids
+        self.track_history.advance()
 
-        if self.track_data and self.track_data.id is not None:
-            self.boxes = self.track_data.xyxy.cpu()
-            self.clss = self.track_data.cls.cpu().tolist()
-            self.track_ids = self.track_data.id.int().cpu().tolist()
+        if detections.has_tracks():
 
             # Still don't know if this person is dirty or not, but he is present in the frame. This will be determined
             # later on.
             for track_id in self.track_ids:
-                if track_id not in self.present_clients:
-                    self.present_clients[track_id] = False
+                self.track_state.get_record(track_id)
 
         else:
             LOGGER.warning("WARNING ⚠️ no tracks found!")
-            self.boxes, self.clss, self.track_ids = [], [], []
 
     def remove_lost_ids(self):
 
         # Extract lost Ids using comparison to previous ids.
-        lost_ids = [track_id for track_id in self.prev_track_ids if track_id not in self.track_ids]
+        current_ids = set(self.track_ids)
+        lost_ids = [track_id for track_id in self.prev_track_ids if track_id not in current_ids]
 
         for track_id in lost_ids:
 
             # If this is a counted client, and he exited the current camera frame.
-            if track_id not in self.dirty_ids:
-                if self.present_clients[track_id]:
+            if not self.track_state.is_dirty(track_id):
+                if self.track_state.is_present(track_id):
 
                     # Mark client exit as true and count him as "dirty out".
-                    self.present_clients[track_id] = False
-                    self.object_counter.count_client_dirty_exit(self.dwell_times, track_id)
+                    self.track_state.set_present(track_id, False)
+                    self.object_counter.count_client_dirty_exit(self.track_state.dwell_times, track_id)
 
                     # Append him to past customers and pop from all data structures.
                     self.add_to_past_customers(track_id)
@@ -116,67 +142,68 @@ class ObjectTracker:
 
             # Else this is a client that was entered the video "dirty" and exiting "dirty".
             else:
-                self.dirty_ids.remove(track_id)
+                self.track_state.set_dirty(track_id, False)
                 self.object_counter.count_dirty_and_dirty_exit()
 
     def pop_from_data_structures(self, track_id):
-        self.dwell_times.pop(track_id, None)
         self.age_classifier.remove_id(track_id)
         self.gender_classifier.remove_id(track_id)
-        self.counted_ids.remove(track_id)
-        self.present_clients.pop(track_id, None)
+        self.reclassification.forget(track_id)
+        self.classification_gate.forget(track_id)
+        self.track_state.forget(track_id)
 
     def store_tracking_history(self, track_id, box):
-        self.track_line = self.track_history[track_id]
-        self.track_line.append(((box[0] + box[2]) / 2, (box[1] + box[3]) / 2))
-        if len(self.track_line) > 30:
-            self.track_line.pop(0)
+        self.track_history.append(track_id, ((box[0] + box[2]) / 2, (box[1] + box[3]) / 2))
 
     def close_dwell_time(self, track_id):
+        dwell = self.track_state.get_dwell(track_id)
 
         # Set exit to the current time.
-        self.dwell_times[track_id][DwellTime.EXIT.value] = self.video_manager.get_current_time()
+        dwell[DwellTime.EXIT.value] = self.video_manager.get_current_time()
 
         # Calculate dwell time
-        self.dwell_times[track_id][DwellTime.DWELL.value] = (self.dwell_times[track_id][DwellTime.EXIT.value] -
-                                               self.dwell_times[track_id][DwellTime.ENTRANCE.value])
+        dwell[DwellTime.DWELL.value] = dwell[DwellTime.EXIT.value] - dwell[DwellTime.ENTRANCE.value]
 
         # Mark as a clean exit, as only clean exit clients will be called with this function.
-        self.dwell_times[track_id][DwellTime.EXIT_TYPE.value] = ExitType.CLEAN.value
+        dwell[DwellTime.EXIT_TYPE.value] = ExitType.CLEAN.value
 
     def add_to_past_customers(self, track_id):
-        # Add customers to past customer as it left the frame.
-        self.past_customers_in_timeslice.append({
-            PastCustomer.TRACK_ID.value: track_id,
-            PastCustomer.DWELL.value: self.dwell_times[track_id],
-            PastCustomer.AGE.value: self.age_classifier.data[track_id],
-            PastCustomer.GENDER.value: self.gender_classifier.data[track_id],
-        })
-
-        self.past_customers.append({
-            PastCustomer.TRACK_ID.value: track_id,
-            PastCustomer.DWELL.value: self.dwell_times[track_id],
-            PastCustomer.AGE.value: self.age_classifier.data[track_id],
-            PastCustomer.GENDER.value: self.gender_classifier.data[track_id],
-        })
+
+        # The customer may leave before a good crop of him showed up, so classify his best crop so far.
+        if self.classification_gate.is_postponed(track_id):
+            crop = self.classification_gate.release(track_id)
+            if crop is not None:
+                self.classify_crop(track_id, crop)
+
+        # The customer may leave before his batch was classified, so run it now.
+        if self.age_classifier.has_pending(track_id) or self.gender_classifier.has_pending(track_id):
+            self.classify_pending(force=True)
+
+        # Add customers to past customer as it left the frame. A customer whose crops were all empty was never
+        # classified.
+        self.track_state.add_past_customer(track_id, self.age_classifier.data.get(track_id, (NOT_DETECTED, 0.0)),
+                                           self.gender_classifier.data.get(track_id, (NOT_DETECTED, 0.0)))
 
     def get_prev_position(self, track_id):
-        return self.track_history[track_id][-2]
+        return self.track_history.get_prev_position(track_id)
+
+    def get_prev_positions(self, track_ids):
+        return self.track_history.get_prev_positions(track_ids)
 
     def is_customer_a_past_customer(self, track_id):
-        return any(customer['track_id'] == track_id for customer in self.past_customers)
+        return self.track_state.is_past_customer(track_id)
 
     def is_object_has_history(self, track_id):
-        return len(self.track_history[track_id]) > 1
+        return self.track_history.has_history(track_id)
 
     def add_new_client(self, frame, track_id, cls, box):
 
         # Add to counted IDs
-        self.counted_ids.append(track_id)
+        self.track_state.set_counted(track_id)
         LOGGER.info(f"ID: {track_id} Clean Enter")
 
         # Mark it as client in the boolean array.
-        self.present_clients[track_id] = True
+        self.track_state.set_present(track_id, True)
 
         # Call object counter to count it in.
         self.object_counter.count_in(cls)
@@ -185,67 +212,127 @@ class ObjectTracker:
         self.classify(frame, track_id, box)
 
         # If the ID performed a "dirty enter", its no longer dirty.
-        if track_id is self.dirty_ids:
-            self.dirty_ids.remove(track_id)
+        if self.track_state.is_dirty(track_id):
+            self.track_state.set_dirty(track_id, False)
             self.object_counter.decrement_count(CountType.DIRTY_IN.value)
             LOGGER.info(f"ID: {track_id} Removed from dirty list")
 
         # Dwell time initialization for a new client
-        self.dwell_times[track_id] = {DwellTime.ENTRANCE.value: None, DwellTime.EXIT.value: None,
-                                      DwellTime.DWELL.value: None, DwellTime.EXIT_TYPE.value: None}
-        self.dwell_times[track_id][DwellTime.ENTRANCE_TYPE.value] = EntranceType.CLEAN.value
-        self.dwell_times[track_id][DwellTime.ENTRANCE.value] = self.video_manager.get_current_time()
+        dwell = {DwellTime.ENTRANCE.value: None, DwellTime.EXIT.value: None,
+                 DwellTime.DWELL.value: None, DwellTime.EXIT_TYPE.value: None}
+        dwell[DwellTime.ENTRANCE_TYPE.value] = EntranceType.CLEAN.value
+        dwell[DwellTime.ENTRANCE.value] = self.video_manager.get_current_time()
+        self.track_state.open_dwell(track_id, dwell)
 
     def is_current_customer(self, track_id):
-        return self.present_clients[track_id]
+        return self.track_state.is_present(track_id)
+
+    def is_counted(self, track_id):
+        return self.track_state.is_counted(track_id)
+
+    def is_dirty(self, track_id):
+        return self.track_state.is_dirty(track_id)
 
     def remove_client(self, track_id, cls):
 
         # Track_id is a present client and not dirty:
-        if track_id in self.counted_ids:
-            if track_id not in self.dirty_ids:
+        if self.track_state.is_counted(track_id):
+            if not self.track_state.is_dirty(track_id):
                 LOGGER.info(f"ID: {track_id} clean exit")
-                self.present_clients[track_id] = False
+                self.track_state.set_present(track_id, False)
                 self.object_counter.count_out(cls)
 
                 # Close dwell time.
-                if track_id in self.dwell_times:
+                if self.track_state.has_dwell(track_id):
                     self.close_dwell_time(track_id)
                     self.add_to_past_customers(track_id)
                     self.pop_from_data_structures(track_id)
 
     def count_dirty_id(self, track_id, cls):
         self.object_counter.count_dirty_entrance(cls)
-        self.dirty_ids.append(track_id)
+        self.track_state.set_dirty(track_id, True)
 
     def classify(self, im0, track_id, box):
-        LOGGER.info("Classifying object")
-        self.age_classifier.classify(im0, track_id, box, ClassifierType.AGE.value)
-        self.gender_classifier.classify(im0, track_id, box, ClassifierType.GENDER.value)
-
-    def reevaluate_classification(self, im0, track_id, box):
-        age_conf = self.age_classifier.get_track_id_conf(track_id)
-        gender_conf = self.gender_classifier.get_track_id_conf(track_id)
-
-        if age_conf != "Not Detected" and age_conf < LOW_CONF:
-            LOGGER.info(f"ID: {track_id} has low confidence age prediction of: {age_conf}."
-                        f"Triggering classification again.")
-            self.age_classifier.classify(im0, track_id, box, ClassifierType.AGE.value)
-        if gender_conf != "Not Detected" and gender_conf < LOW_CONF:
-            LOGGER.info(f"ID: {track_id} has low confidence gender prediction of: {gender_conf}."
-                        f"Triggering classification again.")
-            self.gender_classifier.classify(im0, track_id, box, ClassifierType.GENDER.value)
-
-    def display_counts(self, im0, annotator):
-        labels_dict = self.object_counter.display_counts()
-        annotator.display_analytics(im0, labels_dict, (104, 31, 17), (255, 255, 255), 10)
+
+        # A replayed job cuts no crop, the recorded results are given on the frames they were given on.
+        if self.detection_replay is not None:
+            return
+
+        # The crop is classified only if it is good enough, otherwise the client waits for a better one.
+        crop = self.classification_gate.offer(track_id, im0, box)
+        if crop is None:
+            LOGGER.info(f"ID: {track_id} classification postponed, waiting for a better crop")
+            return
+        self.classify_crop(track_id, crop)
+
+    def classify_crop(self, track_id, crop):
+        LOGGER.debug("Classifying object")
+
+        # Queue the crop for both classifiers, it will be classified with the rest of the batch. The resized crop is
+        # shared when both classifiers take the same input size.
+        age_crop = crop_to_image(crop, self.age_classifier.image_size)
+        self.age_classifier.request_classification(track_id, age_crop)
+        if self.gender_classifier.image_size != self.age_classifier.image_size:
+            crop = crop_to_image(crop, self.gender_classifier.image_size)
+        else:
+            crop = age_crop
+        self.gender_classifier.request_classification(track_id, crop)
+
+    def classify_remaining(self):
+
+        # Classify the clients still waiting for a good crop with their best crop so far, and all pending requests.
+        for track_id in list(self.classification_gate.postponed):
+            crop = self.classification_gate.release(track_id)
+            if crop is not None:
+                self.classify_crop(track_id, crop)
+        self.classify_pending(force=True)
+
+    def classify_postponed(self, im0):
+        if self.detection_replay is not None:
+            return
+
+        # Offer the current crops of the clients still waiting for a good one.
+        for box, track_id in zip(self.boxes, self.track_ids):
+            if self.classification_gate.is_postponed(track_id):
+                crop = self.classification_gate.offer(track_id, im0, box)
+                if crop is not None:
+                    self.classify_crop(track_id, crop)
+
+    def reevaluate_classifications(self, im0):
+        if self.detection_replay is not None:
+            return
+
+        # Offer the crops of the counted clients classified with low confidence, the scheduler keeps the best ones, and
+        # re-classifies them within its budget.
+        for box, track_id in zip(self.boxes, self.track_ids):
+            if self.track_state.is_counted(track_id) and self.reclassification.needs_reclassification(track_id):
+                self.reclassification.offer(track_id, im0, box)
+        self.reclassification.run()
+
+    def replay_classifications(self, frame):
+
+        # Give the results recorded on this frame, before it is analyzed - the exits of the frame then see them, as they
+        # saw them in the recorded job.
+        self.age_classifier.replay(frame)
+        self.gender_classifier.replay(frame)
+
+    def classify_pending(self, force=False):
+
+        # Run the requests collected over the last frames as one batch per classifier.
+        self.frames_since_classification += 1
+        if force or self.frames_since_classification >= CLASSIFICATION_BATCH_WINDOW:
+            if self.age_classifier.pending or self.gender_classifier.pending:
+                with self.stage_metrics.time(Stage.CLASSIFY):
+                    self.age_classifier.classify_pending()
+                    self.gender_classifier.classify_pending()
+            self.frames_since_classification = 0
+
+    def get_counts_snapshot(self):
+        return copy.deepcopy(self.object_counter.display_counts())
 
     def set_prev_track_ids(self, current_ids):
         self.prev_track_ids = current_ids.copy()
 
-    def get_tracks(self):
-        return self.tracks
-
     def get_boxes(self):
         return self.boxes
 
@@ -262,7 +349,16 @@ class ObjectTracker:
             return self.gender_classifier.get_track_id_data(track_id)
 
     def save_prev_ids(self):
-        self.prev_track_ids = self.counted_ids.copy()
+        self.prev_track_ids = self.track_state.get_counted_ids()
+
+    def get_dwell_times(self):
+        return self.track_state.dwell_times
+
+    def get_past_customers_in_timeslice(self):
+        return self.track_state.past_customers_in_timeslice
+
+    def reset_timeslice(self):
+        self.track_state.reset_timeslice()
 
     def calculate_current_count(self):
         return self.object_counter.calculate_current_count()
\ No newline at end of file
@@ -0,0 +1,128 @@
+import threading
+
+import cv2
+from ultralytics.utils import LOGGER
+
+from util import PROGRESSIVE_POLL_INTERVAL
+
+
+class ProgressiveCapture:
+    """
+    Video capture over a file that is still being written, so decoding starts before the download finishes.
+
+    The file is written by `write_file` on a background thread. When the decoder catches up with the written data, the
+    read waits for more data, reopens the file and seeks back to the next frame. A frame is returned only once the frame
+    after it was decoded as well, as the last frame before the end of the written data may be only partially written.
+    Only a video whose index is at its start (e.g. a "faststart" or fragmented mp4) can be opened before it is complete -
+    otherwise the capture opens once the download finishes, and behaves as a regular download.
+    """
+
+    def __init__(self, path, write_file, poll_interval=PROGRESSIVE_POLL_INTERVAL):
+
+        # Path of the growing video file.
+        self.path = path
+
+        # Seconds to wait for more data whenever the decoder catches up with the download.
+        self.poll_interval = poll_interval
+
+        # Set when the download is over, successfully or not, and the error that stopped it if any.
+        self.done = threading.Event()
+        self.error = None
+
+        # Set when the capture is released, to stop a download that is no longer needed.
+        self.stop_event = threading.Event()
+
+        # Index of the next frame to be returned, to resume from after reopening the file, and the frame itself once
+        # decoded - held until the frame after it is decoded too.
+        self.position = 0
+        self.pending = None
+
+        # Underlying capture, reopened whenever the decoder reached the end of the written data, and whether it was
+        # opened over the complete file.
+        self.cap = None
+        self.final = False
+
+        self.writer = threading.Thread(target=self.write, args=(write_file,), daemon=True)
+        self.writer.start()
+        self.open()
+
+    def write(self, write_file):
+        try:
+            write_file(self.stop_event)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+    def open(self):
+
+        # Wait for the written part of the file to be enough for the decoder to read the video metadata.
+        while True:
+            self.reopen()
+            if self.cap.isOpened():
+                LOGGER.info("Progressive capture opened after the download finished" if self.final else
+                            "Progressive capture opened, download still in progress")
+                return
+            if self.final:
+                self.raise_download_error()
+                raise Exception("Failed to load video. Check the file format or path.")
+            self.done.wait(self.poll_interval)
+
+    def reopen(self):
+        self.final = self.done.is_set()
+        self.pending = None
+        if self.cap is not None:
+            self.cap.release()
+        self.cap = cv2.VideoCapture(self.path)
+        if self.position and self.cap.isOpened():
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.position)
+
+    def raise_download_error(self):
+        if self.error is not None:
+            raise Exception(f"Video download failed: {self.error}")
+
+    def read(self):
+        while True:
+            ret, frame = self.cap.read()
+            if ret:
+                if self.pending is None:
+                    self.pending = frame
+                    continue
+                frame, self.pending = self.pending, frame
+                self.position += 1
+                return True, frame
+
+            # End of the complete file - the held frame is the last one.
+            if self.final:
+                self.raise_download_error()
+                if self.pending is None:
+                    return False, None
+                frame, self.pending = self.pending, None
+                self.position += 1
+                return True, frame
+
+            # The decoder reached the end of the written data. The held frame is dropped, and decoded again from the
+            # reopened file, once more data was written or the download is over.
+            if not self.done.is_set():
+                self.done.wait(self.poll_interval)
+            self.reopen()
+
+    def get(self, prop):
+        return self.cap.get(prop)
+
+    def set(self, prop, value):
+
+        # Seeking is done by position, so it is kept over reopening the file.
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            self.position = int(value)
+            self.reopen()
+            return True
+        return self.cap.set(prop, value)
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def release(self):
+        self.stop_event.set()
+        self.cap.release()
+        self.writer.join()
@@ -0,0 +1,103 @@
+import heapq
+import itertools
+from collections import defaultdict
+
+from ultralytics.utils import LOGGER
+
+from crop_quality import crop_quality
+from stage_metrics import StageMetrics
+from util import crop_box, Stage, REEVALUATION_BUDGET, REEVALUATION_TOP_K, REEVALUATION_INTERVAL
+
+
+class ReclassificationScheduler:
+    """
+    Re-classifies the tracks classified with low confidence, within a fixed number of classified crops per frame.
+
+    The best crops of each such track - scored by size, sharpness and how frontal the box is - are kept as the track is
+    seen. A track is due for re-classification once a better crop replaced one of its kept crops. Due tracks are served
+    in the order they were last re-classified, as long as the frame's budget allows, and the results of all kept crops
+    of a track are voted on.
+    """
+
+    def __init__(self, classifiers, budget=REEVALUATION_BUDGET, top_k=REEVALUATION_TOP_K,
+                 interval=REEVALUATION_INTERVAL, stage_metrics=None):
+
+        # Classifiers whose low confidence results are re-evaluated.
+        self.classifiers = classifiers
+
+        # Crops classified per frame, over all tracks and classifiers, and the number of best crops kept per track.
+        self.budget = budget
+        self.top_k = max(1, min(top_k, budget))
+
+        # Minimal number of frames between two re-classifications of a track.
+        self.interval = interval
+
+        # Best crops of each track, as a min-heap of (score, sequence, crop) - the worst kept crop is replaced first.
+        self.best_crops = {}
+        self.sequence = itertools.count()
+
+        # Tracks that got a better crop since they were last re-classified, and the frame they were last re-classified.
+        self.fresh = set()
+        self.last_run = {}
+
+        # Current frame number.
+        self.frame = 0
+
+        # Stage timers of the job.
+        self.stage_metrics = stage_metrics if stage_metrics is not None else StageMetrics()
+
+    def needs_reclassification(self, track_id):
+        return any(classifier.is_low_confidence(track_id) for classifier in self.classifiers)
+
+    def offer(self, track_id, im0, box):
+        crop = crop_box(im0, box)
+        if crop.size == 0:
+            return
+
+        # The crop is kept only if it is better than the worst kept one, and copied only then.
+        score = crop_quality(crop, box)
+        heap = self.best_crops.setdefault(track_id, [])
+        if len(heap) < self.top_k:
+            heapq.heappush(heap, (score, next(self.sequence), crop.copy()))
+        elif score > heap[0][0]:
+            heapq.heapreplace(heap, (score, next(self.sequence), crop.copy()))
+        else:
+            return
+        self.fresh.add(track_id)
+
+    def run(self):
+        self.frame += 1
+        due = sorted((track_id for track_id in self.fresh
+                      if self.frame - self.last_run.get(track_id, -self.interval) >= self.interval),
+                     key=lambda track_id: self.last_run.get(track_id, -self.interval))
+
+        requests, used = defaultdict(dict), 0
+        for track_id in due:
+            classifiers = [classifier for classifier in self.classifiers if classifier.is_low_confidence(track_id)]
+            if not classifiers:
+                self.fresh.discard(track_id)
+                continue
+
+            # The best crops first, as many as the rest of the budget allows.
+            crops_per_classifier = min(len(self.best_crops[track_id]), (self.budget - used) // len(classifiers))
+            if crops_per_classifier == 0:
+                break
+            crops = [crop for _, _, crop in sorted(self.best_crops[track_id], reverse=True)[:crops_per_classifier]]
+            for classifier in classifiers:
+                requests[classifier][track_id] = crops
+            used += crops_per_classifier * len(classifiers)
+
+            LOGGER.info(f"ID: {track_id} has low confidence prediction. Re-classifying its {len(crops)} best crops.")
+            self.fresh.discard(track_id)
+            self.last_run[track_id] = self.frame
+
+        if not requests:
+            return
+        with self.stage_metrics.time(Stage.CLASSIFY):
+            for classifier, classifier_requests in requests.items():
+                classifier.classify_votes(classifier_requests)
+
+    def forget(self, track_id):
+        self.best_crops.pop(track_id, None)
+        self.fresh.discard(track_id)
+        self.last_run.pop(track_id, None)
@@ -0,0 +1,105 @@
+"""
+Checks that an exported inference backend gives the same outputs as the PyTorch weights.
+
+Runs the detector and the classifiers with both runtimes over frames of a video, and compares the detections (matched
+by IoU) and the top class and probabilities of each classification. Run from the repository root, the same way the
+server runs, so the weights paths resolve:
+
+    python scripts/check_backend_parity.py --backend onnx --video store.mp4
+"""
+import argparse
+import os
+import sys
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model_registry import load_model
+from util import WeightsPath, InferenceBackend, box_iou
+
+
+def read_frames(video, count):
+    if video is None:
+
+        # No video given - random frames still exercise the whole network, though the detector may find nothing.
+        rng = np.random.default_rng(0)
+        return [rng.integers(0, 256, (480, 640, 3), dtype=np.uint8) for _ in range(count)]
+
+    cap = cv2.VideoCapture(video)
+    frames = []
+    while len(frames) < count:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+
+def compare_detections(reference, candidate, frames, iou_threshold):
+    mismatches = 0
+    for frame in frames:
+        expected = reference.predict(frame, verbose=False)[0].boxes
+        actual = candidate.predict(frame, verbose=False)[0].boxes
+        if len(expected) != len(actual):
+            mismatches += 1
+            continue
+        if len(expected) == 0:
+            continue
+
+        # Every reference box needs a box of the same class that overlaps it almost entirely.
+        iou = box_iou(expected.xyxy.cpu().numpy(), actual.xyxy.cpu().numpy())
+        same_class = expected.cls.cpu().numpy()[:, None] == actual.cls.cpu().numpy()[None, :]
+        if not np.all(np.max(np.where(same_class, iou, 0), axis=1) >= iou_threshold):
+            mismatches += 1
+    return mismatches
+
+
+def compare_classifications(reference, candidate, frames, tolerance):
+    mismatches, max_difference = 0, 0.0
+    for frame in frames:
+        expected = reference.predict(frame, verbose=False)[0].probs
+        actual = candidate.predict(frame, verbose=False)[0].probs
+        max_difference = max(max_difference, float(np.abs(expected.data.cpu().numpy() -
+                                                          actual.data.cpu().numpy()).max()))
+        if expected.top1 != actual.top1:
+            mismatches += 1
+    return mismatches, max_difference, max_difference <= tolerance
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", default=InferenceBackend.ONNX.value,
+                        choices=[backend.value for backend in InferenceBackend if backend != InferenceBackend.PYTORCH])
+    parser.add_argument("--video", default=None, help="Video to take the frames from, random frames if not given.")
+    parser.add_argument("--frames", type=int, default=20, help="Number of frames to compare on.")
+    parser.add_argument("--iou", type=float, default=0.95, help="Minimal IoU of matching detections.")
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="Maximal difference of class probabilities.")
+    args = parser.parse_args()
+
+    backend = InferenceBackend(args.backend)
+    frames = read_frames(args.video, args.frames)
+    passed = True
+
+    for weights_path in WeightsPath:
+        reference = load_model(weights_path.value)
+        candidate = load_model(weights_path.value, backend)
+        if reference.task == "classify":
+            mismatches, max_difference, within_tolerance = compare_classifications(reference, candidate, frames,
+                                                                                   args.tolerance)
+            print(f"{weights_path.value}: {mismatches}/{len(frames)} top class mismatches, "
+                  f"max probability difference {max_difference:.2e}")
+            passed &= mismatches == 0 and within_tolerance
+        else:
+            mismatches = compare_detections(reference, candidate, frames, args.iou)
+            print(f"{weights_path.value}: {mismatches}/{len(frames)} frames with mismatching detections")
+            passed &= mismatches == 0
+
+    print("PASSED" if passed else "FAILED")
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""
+Checks the chunked and progressive video downloads against a local, throttled HTTP server.
+
+A synthetic video is written twice - with its index (the mp4 "moov" atom) at the start, as a faststart video, and at
+the end, as OpenCV writes it - and served by a threaded http.server that sends it a chunk at a time, so the downloaded
+file grows while it is decoded. The downloads go through CloudinaryService.download_video, as a job's do:
+
+- a full download is saved chunk by chunk, and must be the served file byte for byte
+- a progressive download must decode the very frames of the local file, the faststart one before the download is over
+- a progressive download released halfway must stop writing the file
+- a missing video must fail the download
+
+The served download has to last well over PROGRESSIVE_POLL_INTERVAL, or it is over before the capture looks at the
+file again. While a decoder catches up with the written data, FFmpeg logs warnings about the partial file - those are
+expected. Nothing is uploaded, and no credentials are needed. Run from the repository root:
+
+    python scripts/check_progressive_download.py
+    python scripts/check_progressive_download.py --frames 600 --size 640x360 --chunk 65536 --delay 0.05
+"""
+import argparse
+import http.server
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cloudinary_service import CloudinaryService
+from progressive_capture import ProgressiveCapture
+from util import DOWNLOADED_VID_PATH
+
+# Atoms of an mp4 index that hold other atoms, down to the chunk offset tables.
+CONTAINER_ATOMS = (b"trak", b"mdia", b"minf", b"stbl")
+
+
+def write_video(path, frames, width, height, fps):
+
+    # Every frame has its own brightness and index drawn on it, so a skipped or repeated frame does not go unnoticed.
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    for index in range(frames):
+        frame = np.full((height, width, 3), index % 256, dtype=np.uint8)
+        cv2.putText(frame, str(index), (width // 8, height // 2), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255), 3)
+        writer.write(frame)
+    writer.release()
+
+
+def read_atoms(data, start, end):
+    atoms, position = [], start
+    while position < end:
+        size, kind = struct.unpack(">I4s", data[position:position + 8])
+        if size < 8:
+            raise Exception(f"Unsupported mp4 atom {kind} of size {size}")
+        atoms.append((kind, position, size))
+        position += size
+    return atoms
+
+
+def shift_chunk_offsets(moov, start, end, shift):
+    for kind, position, size in read_atoms(moov, start, end):
+        if kind in CONTAINER_ATOMS:
+            shift_chunk_offsets(moov, position + 8, position + size, shift)
+        elif kind in (b"stco", b"co64"):
+            width = 4 if kind == b"stco" else 8
+            code = ">I" if kind == b"stco" else ">Q"
+            count = struct.unpack(">I", moov[position + 12:position + 16])[0]
+            for offset in range(position + 16, position + 16 + count * width, width):
+                value = struct.unpack(code, moov[offset:offset + width])[0]
+                moov[offset:offset + width] = struct.pack(code, value + shift)
+
+
+def move_index_to_start(path, faststart_path):
+
+    # The index moves before the media data, so the chunk offsets it holds grow by its size.
+    with open(path, "rb") as file:
+        data = file.read()
+    atoms = read_atoms(data, 0, len(data))
+    kind, position, size = next(atom for atom in atoms if atom[0] == b"moov")
+    moov = bytearray(data[position:position + size])
+    shift_chunk_offsets(moov, 8, len(moov), len(moov))
+
+    with open(faststart_path, "wb") as file:
+        for atom_kind, atom_position, atom_size in atoms:
+            if atom_kind == b"ftyp":
+                file.write(data[atom_position:atom_position + atom_size])
+        file.write(moov)
+        for atom_kind, atom_position, atom_size in atoms:
+            if atom_kind not in (b"ftyp", b"moov"):
+                file.write(data[atom_position:atom_position + atom_size])
+
+
+def read_frames(capture, start=None):
+
+    # All frames of the capture, the seconds from the start - the download's when given - to the first one, and whether
+    # a progressive download was still going on then.
+    start = time.perf_counter() if start is None else start
+    frames, first_frame_time, downloading = [], None, False
+    while True:
+        ret, frame = capture.read()
+        if not ret:
+            break
+        if first_frame_time is None:
+            first_frame_time = time.perf_counter() - start
+            downloading = isinstance(capture, ProgressiveCapture) and not capture.done.is_set()
+        frames.append(frame)
+    capture.release()
+    return frames, first_frame_time, downloading
+
+
+def download(service, url, directory, progressive=False):
+
+    # Each download has a directory of its own, as each job has.
+    download_dir = tempfile.mkdtemp(dir=directory)
+    return service.download_video(url, download_dir, progressive), os.path.join(download_dir, DOWNLOADED_VID_PATH)
+
+
+def serve(files, chunk, delay):
+
+    # Each file is sent a chunk at a time, as a slow connection would, on its own thread per request.
+    class ThrottledHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            data = files.get(self.path)
+            if data is None:
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            try:
+                for start in range(0, len(data), chunk):
+                    self.wfile.write(data[start:start + chunk])
+                    self.wfile.flush()
+                    time.sleep(delay)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ThrottledHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=300, help="Frames of the served video")
+    parser.add_argument("--size", default="320x240", help="WxH size of the served video")
+    parser.add_argument("--chunk", type=int, default=16384, help="Bytes the server sends at a time")
+    parser.add_argument("--delay", type=float, default=0.02, help="Seconds the server waits after each chunk")
+    args = parser.parse_args()
+    width, height = (int(side) for side in args.size.lower().split("x"))
+
+    with tempfile.TemporaryDirectory() as directory:
+        index_at_end = os.path.join(directory, "index_at_end.mp4")
+        faststart = os.path.join(directory, "faststart.mp4")
+        write_video(index_at_end, args.frames, width, height, 15)
+        move_index_to_start(index_at_end, faststart)
+
+        files = {}
+        for path in (index_at_end, faststart):
+            with open(path, "rb") as file:
+                files["/" + os.path.basename(path)] = file.read()
+        expected = {name: read_frames(cv2.VideoCapture(os.path.join(directory, name[1:])))[0] for name in files}
+        server, url = serve(files, args.chunk, args.delay)
+
+        service, checks = CloudinaryService(), []
+
+        # Full download, saved chunk by chunk.
+        capture, saved_path = download(service, url + "/faststart.mp4", directory)
+        frames = read_frames(capture)[0]
+        with open(saved_path, "rb") as file:
+            saved = file.read()
+        checks.append(("full download is the served file", saved == files["/faststart.mp4"] and
+                       len(frames) == args.frames))
+
+        # Progressive downloads, decoded while the file grows. Only the faststart video can be opened before it is
+        # complete.
+        for name in files:
+            start = time.perf_counter()
+            capture, _ = download(service, url + name, directory, progressive=True)
+            frames, first_frame_time, downloading = read_frames(capture, start)
+            same = len(frames) == len(expected[name]) and all(np.array_equal(frame, expected_frame)
+                                                              for frame, expected_frame in zip(frames, expected[name]))
+            print(f"{name[1:]}: {len(frames)} frames, the first after {first_frame_time:.2f}s "
+                  f"{'while downloading' if downloading else 'once downloaded'}, "
+                  f"all after {time.perf_counter() - start:.2f}s")
+            checks.append((f"progressive {name[1:]} decodes the local frames", same))
+            if name == "/faststart.mp4":
+                checks.append(("progressive faststart video decodes before the download is over", downloading))
+
+        # A progressive download released after its first frame stops writing.
+        capture, saved_path = download(service, url + "/faststart.mp4", directory, progressive=True)
+        capture.read()
+        downloading = not capture.done.is_set()
+        capture.release()
+        stopped_size = os.path.getsize(saved_path)
+        time.sleep(5 * args.delay)
+        checks.append(("released progressive download stops writing",
+                       downloading and not capture.writer.is_alive() and os.path.getsize(saved_path) == stopped_size
+                       and stopped_size < len(files["/faststart.mp4"])))
+
+        # A missing video fails the download.
+        try:
+            download(service, url + "/missing.mp4", directory)
+            checks.append(("missing video fails the download", False))
+        except Exception:
+            checks.append(("missing video fails the download", True))
+
+        server.shutdown()
+
+    for name, passed in checks:
+        print(f"{'PASSED' if passed else 'FAILED'}: {name}")
+    sys.exit(0 if all(passed for _, passed in checks) else 1)
+
+
+if __name__ == "__main__":
+    main()
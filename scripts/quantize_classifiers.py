@@ -0,0 +1,180 @@
+"""
+Builds INT8 versions of the age and gender classifiers, and reports their accuracy and latency against full precision.
+
+The classifiers are exported to ONNX and statically quantized with ONNX Runtime, calibrated on crops saved by the
+analysis under <crops>/**/classifications/<age|gender>/<label>/. Part of the crops is held out, and the INT8 model is
+compared on them with the PyTorch and the ONNX full precision models: agreement of the top class with PyTorch, accuracy
+against the label folders (the labels the crops were saved under - hand-sorted or predicted), and latency per crop when
+classifying batches the way the analysis does.
+
+The INT8 model is saved next to the weights, keyed by their digest, and is used by the server when run with
+QUANTIZED_CLASSIFIERS=1. Run from the repository root:
+
+    python scripts/quantize_classifiers.py --crops ./logs --imgsz 224
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import onnx
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+from PIL import Image
+from ultralytics import YOLO
+from ultralytics.data.augment import classify_transforms
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model_registry import file_digest, get_quantized_path
+from util import WeightsPath, ClassifierType, MAX_CLASSIFICATION_BATCH
+
+CLASSIFIERS = {ClassifierType.AGE: WeightsPath.AGE_CLASSIFIER, ClassifierType.GENDER: WeightsPath.GENDER_CLASSIFIER}
+
+
+class CropCalibrationReader(CalibrationDataReader):
+
+    def __init__(self, paths, input_name, image_size):
+
+        # Crops are preprocessed exactly as the Ultralytics classification predictor does before inference.
+        self.paths = iter(paths)
+        self.input_name = input_name
+        self.transforms = classify_transforms(image_size)
+
+    def get_next(self):
+        path = next(self.paths, None)
+        if path is None:
+            return None
+        image = Image.fromarray(cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB))
+        return {self.input_name: self.transforms(image).numpy()[None]}
+
+
+def find_crops(root, classification_type):
+    paths = []
+    for extension in ("jpg", "png"):
+        paths += glob.glob(os.path.join(root, "**", "classifications", classification_type, "*", f"*.{extension}"),
+                           recursive=True)
+    return sorted(paths)
+
+
+def export_full_precision(weights, image_size, directory):
+
+    # Exported from a copy, so the export is written to the temporary directory rather than next to the weights.
+    staged_weights = os.path.join(directory, os.path.basename(weights))
+    shutil.copyfile(weights, staged_weights)
+    return str(YOLO(staged_weights).export(format="onnx", imgsz=image_size, dynamic=True))
+
+
+def quantize(full_precision_path, quantized_path, calibration_paths, image_size):
+    model = onnx.load(full_precision_path, load_external_data=False)
+    reader = CropCalibrationReader(calibration_paths, model.graph.input[0].name, image_size)
+    quantize_static(full_precision_path, quantized_path, reader, quant_format=QuantFormat.QDQ, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+
+    # Ultralytics reads the class names and the input size from the model metadata, which quantization does not keep.
+    quantized = onnx.load(quantized_path)
+    del quantized.metadata_props[:]
+    quantized.metadata_props.extend(model.metadata_props)
+    onnx.save(quantized, quantized_path)
+
+
+def evaluate(model, paths, image_size):
+
+    # Crops are resized to the model's input size, as the analysis does when it cuts them out of the frame.
+    crops = [cv2.resize(cv2.imread(path), (image_size, image_size)) for path in paths]
+    model(crops[:1], imgsz=image_size, verbose=False)
+
+    predictions, start = [], time.perf_counter()
+    for batch_start in range(0, len(crops), MAX_CLASSIFICATION_BATCH):
+        results = model(crops[batch_start:batch_start + MAX_CLASSIFICATION_BATCH], imgsz=image_size, verbose=False)
+        predictions += [result.names[result.probs.top1].lower() for result in results]
+    latency = (time.perf_counter() - start) * 1000 / max(1, len(crops))
+    return predictions, latency
+
+
+def report_model(predictions, latency, reference, labels):
+    labeled = [(prediction, label) for prediction, label in zip(predictions, labels) if label is not None]
+    return {
+        "msPerCrop": round(latency, 3),
+        "agreementWithPytorch": round(float(np.mean([a == b for a, b in zip(predictions, reference)])), 4),
+        "labelAccuracy": round(float(np.mean([a == b for a, b in labeled])), 4) if labeled else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--crops", default="./logs", help="Directory the classification crops were saved under.")
+    parser.add_argument("--imgsz", type=int, default=None, help="Input size of the INT8 models, native if not given.")
+    parser.add_argument("--calibration-size", type=int, default=300, help="Number of crops to calibrate on.")
+    parser.add_argument("--eval-size", type=int, default=300, help="Number of held out crops to evaluate on.")
+    parser.add_argument("--report", default=None, help="Path to write the JSON report to.")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    report = {}
+    for classifier_type, weights_path in CLASSIFIERS.items():
+        weights = weights_path.value
+        paths = find_crops(args.crops, classifier_type.value)
+        if not paths:
+            print(f"No {classifier_type.value} crops found under {args.crops}, skipping")
+            continue
+
+        # Calibration and evaluation crops don't overlap. With fewer crops than both sets take, they are shared in the
+        # ratio of the two sizes, so neither set is empty. A single crop can't be split - the INT8 model is then
+        # evaluated on the crop it was calibrated on, and the report says so.
+        paths = [paths[i] for i in rng.permutation(len(paths))]
+        calibration_size = args.calibration_size
+        if len(paths) < args.calibration_size + args.eval_size:
+            share = round(len(paths) * args.calibration_size / (args.calibration_size + args.eval_size))
+            calibration_size = min(max(1, share), len(paths) - 1)
+        calibration_paths = paths[:max(1, calibration_size)]
+        evaluation_paths = paths[calibration_size:calibration_size + args.eval_size]
+        evaluated_on_calibration_crops = not evaluation_paths
+        if evaluated_on_calibration_crops:
+            evaluation_paths = calibration_paths
+            print(f"WARNING: only {len(paths)} {classifier_type.value} crop found, the INT8 model is evaluated on the "
+                  f"crop it was calibrated on")
+
+        reference_model = YOLO(weights)
+        native_size = int(reference_model.overrides.get("imgsz", 640))
+        image_size = args.imgsz or native_size
+        quantized_path = get_quantized_path(weights, file_digest(weights))
+
+        with tempfile.TemporaryDirectory() as directory:
+            full_precision_path = export_full_precision(weights, image_size, directory)
+            quantize(full_precision_path, quantized_path, calibration_paths, image_size)
+            print(f"Saved {quantized_path}, calibrated on {len(calibration_paths)} crops")
+
+            names = {name.lower() for name in reference_model.names.values()}
+            labels = [os.path.basename(os.path.dirname(path)).lower() for path in evaluation_paths]
+            labels = [label if label in names else None for label in labels]
+
+            reference, reference_latency = evaluate(reference_model, evaluation_paths, native_size)
+            models = {
+                f"pytorch-fp32@{native_size}": (reference, reference_latency),
+                f"onnx-fp32@{image_size}": evaluate(YOLO(full_precision_path, task="classify"), evaluation_paths,
+                                                     image_size),
+                f"onnx-int8@{image_size}": evaluate(YOLO(quantized_path, task="classify"), evaluation_paths,
+                                                     image_size),
+            }
+
+        report[classifier_type.value] = {
+            "evaluatedCrops": len(evaluation_paths),
+            "evaluatedOnCalibrationCrops": evaluated_on_calibration_crops,
+            "models": {name: report_model(predictions, latency, reference, labels)
+                       for name, (predictions, latency) in models.items()},
+        }
+
+    print(json.dumps(report, indent=2))
+    if args.report is not None:
+        with open(args.report, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Analyzes a video again from the detections recorded by an earlier job, with no model loaded and no video decoded.
+
+A job records its detections and classification results when its payload has "recordDetections": true and the server
+runs with RECORD_DETECTIONS=1, under the detections/ directory of the job. Replaying them takes the counting logic, the
+timeslices and the reports through the same code as the job, in a fraction of its time - to try a change of the
+counting rules, or to check that a change keeps the reports of a recorded job. Nothing is sent to the server, the
+reports are printed or written as JSON. Run from the repository root, the same way the server runs:
+
+    python scripts/replay_detections.py --record logs/<job>/detections --output reports.json
+    python scripts/replay_detections.py --record logs/<job>/detections --expect reports.json
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import computer_vision_service
+from data_provider import DataProvider
+from detection_record import load_metadata
+from util import export_to_local_csv, export_to_local_txt
+
+
+class LocalDataProvider(DataProvider):
+    """
+    Data provider of a replay - the reports are exported locally, and nothing is uploaded or sent.
+    """
+
+    def provide(self, annotated_heatmap, clean_heatmap):
+        export_to_local_csv(self.reports, self.base_dir)
+        export_to_local_txt(self.reports, self.base_dir)
+
+
+def replay(record, payload):
+
+    # The analysis window of the recorded job, unless the payload sets another one.
+    metadata = load_metadata(record)
+    data = {"jobId": "replay", "date": metadata["date"], "start": metadata["start"], "end": metadata["end"],
+            "videoStart": metadata["videoStart"], "length": 0, "headless": True, **payload}
+    service = computer_vision_service.ComputerVisionService(data, detection_replay_path=record)
+    service.start()
+
+    counts = service.video_analyzer.object_tracker.object_counter.classwise_counts
+    return {"counts": counts, "reports": service.data_provider.reports}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--record", required=True, help="Detections directory of the recorded job.")
+    parser.add_argument("--payload", default="{}", help="JSON of more job payload fields, e.g. '{\"headless\": false}'")
+    parser.add_argument("--output", help="JSON file the counts and reports are written to.")
+    parser.add_argument("--expect", help="JSON file of earlier counts and reports the replay must match.")
+    args = parser.parse_args()
+
+    # Reports are kept locally only.
+    computer_vision_service.DataProvider = LocalDataProvider
+
+    results = json.loads(json.dumps(replay(args.record, json.loads(args.payload)), default=str))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Results written to {args.output}")
+    elif not args.expect:
+        print(json.dumps(results, indent=2))
+
+    if args.expect:
+        with open(args.expect) as file:
+            expected = json.load(file)
+        passed = expected == results
+        if expected["counts"] != results["counts"]:
+            print(f"Counts differ: expected {expected['counts']}, replayed {results['counts']}")
+        for index, (expected_report, report) in enumerate(zip(expected["reports"], results["reports"])):
+            if expected_report != report:
+                print(f"Report {index} differs: expected {expected_report}, replayed {report}")
+                break
+        if len(expected["reports"]) != len(results["reports"]):
+            print(f"Expected {len(expected['reports'])} reports, replayed {len(results['reports'])}")
+        print("PASSED" if passed else "FAILED")
+        sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
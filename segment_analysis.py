@@ -0,0 +1,444 @@
+import concurrent.futures
+import multiprocessing
+
+import numpy as np
+from ultralytics.utils import DEFAULT_CFG_DICT, DEFAULT_SOL_DICT, LOGGER
+
+from data_provider import DataProvider
+from frame_analyzer import FrameAnalyzer
+from heatmap_manager import HeatmapManager
+from stage_metrics import STAGE_METRICS
+from video_analyzer import VideoAnalyzer
+from video_manager import VideoManager
+from util import DwellTime, ExitType, PastCustomer, CountType, box_iou, MIN_SEGMENT_LENGTH, SEGMENT_MATCH_IOU, \
+    SEGMENT_PROGRESS_INTERVAL
+
+# Frames processed so far by each segment, by segment index - shared with the job's process, which reports them as the
+# job's progress. Set in the worker processes by init_segment_worker, None when segments are analyzed in process.
+SEGMENT_PROGRESS = None
+
+
+class Segment:
+    """
+    Part of the analysis window that is analyzed by a single worker process, in frame positions of the video.
+
+    The worker starts at first_frame, but only the frames from start_frame on are its own. The frames before it are the
+    end of the previous segment, analyzed again so the tracks are settled by the time the segment's own part starts.
+    """
+
+    def __init__(self, index, first_frame, start_frame, end_frame):
+        self.index = index
+        self.first_frame = first_frame
+        self.start_frame = start_frame
+
+        # Frame after the last one of the segment, None for a segment analyzed to the end of the video.
+        self.end_frame = end_frame
+
+
+def plan_segments(video_manager):
+
+    # Equal parts of the analysis window, one per worker, but no shorter than the minimal segment length.
+    first_frame, end_frame = video_manager.get_analysis_frame_range()
+    length = end_frame - first_frame
+    min_length = max(1, round(MIN_SEGMENT_LENGTH * video_manager.frame_rate))
+    count = max(1, min(video_manager.get_segment_workers(), length // min_length))
+    bounds = [first_frame + round(i * length / count) for i in range(count + 1)]
+
+    overlap = video_manager.get_segment_overlap_frames()
+    segments = [Segment(i, max(first_frame, bounds[i] - overlap) if i else first_frame, bounds[i], bounds[i + 1])
+                for i in range(count)]
+
+    # An open analysis window is analyzed to the end of the video, whatever its frame count says.
+    if video_manager.analysis_end_time <= video_manager.analysis_start_time:
+        segments[-1].end_frame = None
+    return segments
+
+
+def get_tracks(object_tracker):
+    if object_tracker.get_track_ids() is None:
+        return {}
+    return {int(track_id): [float(coordinate) for coordinate in box]
+            for track_id, box in zip(object_tracker.get_track_ids(), object_tracker.get_boxes())}
+
+
+def get_label(data):
+    return None if data is None else (data[0], float(data[1]))
+
+
+def label_at(labels, position):
+
+    # Age and gender a track had on the given frame, from the (position, age, gender) changes of its labels.
+    age, gender = None, None
+    for label_position, label_age, label_gender in labels:
+        if label_position > position:
+            break
+        age, gender = label_age, label_gender
+    return age, gender
+
+
+def match_tracks(tracks, previous_tracks, min_iou=SEGMENT_MATCH_IOU):
+
+    # Greedy matching of the boxes of two segments on the frame they share, the most overlapping pairs first.
+    if not tracks or not previous_tracks:
+        return {}
+
+    track_ids, previous_ids = list(tracks), list(previous_tracks)
+    iou = box_iou(np.array([tracks[track_id] for track_id in track_ids]),
+                  np.array([previous_tracks[track_id] for track_id in previous_ids]))
+    matches, matched_previous = {}, set()
+    for flat_index in np.argsort(iou, axis=None)[::-1]:
+        row, col = divmod(int(flat_index), len(previous_ids))
+        if iou[row, col] < min_iou:
+            break
+        if track_ids[row] in matches or previous_ids[col] in matched_previous:
+            continue
+        matches[track_ids[row]] = previous_ids[col]
+        matched_previous.add(previous_ids[col])
+    return matches
+
+
+class SegmentAnalyzer(VideoAnalyzer):
+    """
+    Analysis of a single segment, in a worker process.
+
+    Nothing is uploaded - the segment keeps what the merge needs: its customers with their entrance and exit times,
+    its tracks on the last frame of the previous segment and on its own last frame, and the heatmap and counts of its
+    own frames only.
+    """
+
+    def __init__(self, data_provider, video_manager, segment, is_last_segment, progress=None, **kwargs):
+        super().__init__(data_provider, video_manager, **kwargs)
+
+        # Part of the video analyzed, and whether it is the end of the analysis window, which renders the heatmap.
+        self.segment = segment
+        self.is_last_segment = is_last_segment
+
+        # Frames processed by each segment, shared with the job's process, or None when no one follows the progress.
+        self.progress = progress
+
+        # Tracks on the last frame of the previous segment, and the heatmap and counts once it was analyzed - only
+        # what comes after belongs to this segment.
+        self.boundary_tracks = {}
+        self.boundary_heatmap = None
+        self.boundary_counts = {}
+
+        # Frame position each track was last seen at, and the name of its class.
+        self.last_seen = {}
+        self.track_names = {}
+
+        # Changes of the labels of each customer in the store, as (position, age, gender), so every timeslice is
+        # reported with the labels the customers had at its end.
+        self.labels = {}
+
+        # Everything the merge needs, filled once the segment was analyzed.
+        self.result = None
+
+    def analyze_stage(self, ctx, emit):
+        super().analyze_stage(ctx, emit)
+        if self.progress is not None:
+            self.progress[self.segment.index] = self.video_manager.get_processed_frame_count()
+
+        position = self.segment.first_frame + ctx.index
+        for track_id, cls in zip(self.object_tracker.get_track_ids(), self.object_tracker.get_classes()):
+            self.last_seen[int(track_id)] = position
+            self.track_names[int(track_id)] = self.model.names[int(cls)]
+
+        for track_id in self.object_tracker.get_dwell_times():
+            label = (get_label(self.object_tracker.age_classifier.data.get(track_id)),
+                     get_label(self.object_tracker.gender_classifier.data.get(track_id)))
+            labels = self.labels.setdefault(int(track_id), [])
+            if not labels or labels[-1][1:] != label:
+                labels.append((position, *label))
+
+        if position == self.segment.start_frame - 1:
+            self.boundary_tracks = get_tracks(self.object_tracker)
+            self.boundary_heatmap = self.heatmap_manager.heatmap.copy()
+            self.boundary_counts = self.object_tracker.get_counts_snapshot()
+
+    def provide_results(self):
+
+        # Customers still in the store are reported with their labels, so the ones still waiting are classified now.
+        self.object_tracker.classify_remaining()
+        customers = [{
+            "track_id": int(customer[PastCustomer.TRACK_ID.value]),
+            "name": self.track_names.get(int(customer[PastCustomer.TRACK_ID.value])),
+            "entrance": customer[PastCustomer.DWELL.value][DwellTime.ENTRANCE.value],
+            "exit": customer[PastCustomer.DWELL.value][DwellTime.EXIT.value],
+            "exit_type": customer[PastCustomer.DWELL.value][DwellTime.EXIT_TYPE.value],
+            "age": get_label(customer[PastCustomer.AGE.value]),
+            "gender": get_label(customer[PastCustomer.GENDER.value]),
+            "labels": self.labels.get(int(customer[PastCustomer.TRACK_ID.value]), []),
+        } for customer in self.object_tracker.track_state.past_customers]
+        customers += [{
+            "track_id": int(track_id),
+            "name": self.track_names.get(int(track_id)),
+            "entrance": dwell[DwellTime.ENTRANCE.value],
+            "exit": None,
+            "exit_type": None,
+            "age": get_label(self.object_tracker.age_classifier.data.get(track_id)),
+            "gender": get_label(self.object_tracker.gender_classifier.data.get(track_id)),
+            "labels": self.labels.get(int(track_id), []),
+        } for track_id, dwell in self.object_tracker.get_dwell_times().items()]
+
+        heatmap = self.heatmap_manager.heatmap
+        if heatmap is not None and self.boundary_heatmap is not None:
+            heatmap = heatmap - self.boundary_heatmap
+
+        counts = self.object_tracker.get_counts_snapshot()
+        for name, class_counts in self.boundary_counts.items():
+            for count_type, value in class_counts.items():
+                counts[name][count_type] -= value
+
+        # The last frame of the analysis window is rendered by the merge, over the heatmap of all segments.
+        last_ctx = None
+        if self.is_last_segment and self.last_ctx is not None:
+            last_ctx = self.last_ctx
+            last_ctx.is_last = True
+            self.frame_analyzer.snapshot(last_ctx)
+
+        self.result = {
+            "customers": customers,
+            "boundary_tracks": self.boundary_tracks,
+            "end_tracks": get_tracks(self.object_tracker),
+            "last_seen": self.last_seen,
+            "heatmap": heatmap,
+            "counts": counts,
+            "processed_frames": self.video_manager.get_processed_frame_count(),
+            "gated_frames": self.video_manager.get_gated_frame_count(),
+            "last_ctx": last_ctx,
+        }
+
+
+def init_segment_worker(progress):
+    global SEGMENT_PROGRESS
+    SEGMENT_PROGRESS = progress
+
+
+def analyze_segment(data, video_path, segment, is_last_segment, kwargs):
+
+    # Entry point of the worker processes. Each worker opens the video on its own, and seeks to its segment.
+    video_manager = VideoManager()
+    video_manager.populate_video_data(DataProvider.open_local_video(video_path), {**data, "headless": True})
+    video_manager.set_analysis_frames(segment.first_frame, segment.end_frame)
+
+    data_provider = DataProvider(None, video_manager, f"{data.get('jobId')}_segment_{segment.index}")
+    analyzer = SegmentAnalyzer(data_provider, video_manager, segment, is_last_segment, SEGMENT_PROGRESS, **kwargs)
+    analyzer.analyze()
+
+    # The stage timers of the segment are merged into the job's by its process. They are dropped from the worker's
+    # registry, which may time another segment next.
+    stage_metrics = [analyzer.stage_metrics, data_provider.stage_metrics]
+    analyzer.result["stage_metrics"] = [metrics.snapshot() for metrics in stage_metrics]
+    for metrics in stage_metrics:
+        STAGE_METRICS.forget(metrics.job_id)
+    return analyzer.result
+
+
+class ParallelVideoAnalyzer:
+    """
+    Analyzes the segments of a video in parallel worker processes, and merges their results.
+
+    Each segment has its own tracker, counter and heatmap. Customers that are in the store when a segment ends are
+    stitched to the tracks of the next segment by the IoU of their boxes on the frame both analyzed. Crossings in the
+    overlap belong to the previous segment, so the next one only reports what happened in its own part. The heatmaps
+    are added up, and the timeslice reports are rebuilt from the entrance and exit times of the merged customers. Each
+    customer is reported with the labels it had at the end of the timeslice, or when it left, as the serial analysis
+    reports them - the segments keep the changes of the labels of their customers for it. Segments are analyzed
+    headless, so no annotated output video is written - only the final heatmap is rendered. The job's progress follows
+    the frames the workers processed while they run, and their stage timers are added to the job's once they are done.
+    """
+
+    def __init__(self, data_provider, video_manager, data, segments, **kwargs):
+
+        # Load Ultralytics config and update with args, as the video analyzers of the segments do.
+        self.kwargs = kwargs
+        self.CFG = {**DEFAULT_SOL_DICT, **DEFAULT_CFG_DICT, **kwargs}
+
+        # Data Provider - will handle data flow in the program, from local saving to triggering API calls.
+        self.data_provider = data_provider
+
+        # Video Manager of the whole analysis window - its frame clock is shared by all segments.
+        self.video_manager = video_manager
+
+        # Data given by the server through the API call, passed on to the segments.
+        self.data = data
+
+        # Segments of the analysis window, one per worker process.
+        self.segments = segments
+
+        # Frames of the segments already added to the processed frames of the video manager.
+        self.reported_frames = 0
+
+        # Renders the final heatmap, with no tracker of its own.
+        self.heatmap_manager = HeatmapManager(self.CFG)
+        self.frame_analyzer = FrameAnalyzer(None, self.CFG, self.heatmap_manager)
+
+    def analyze(self):
+        LOGGER.info(f"Analyzing frames {self.segments[0].first_frame}-{self.segments[-1].end_frame} in "
+                    f"{len(self.segments)} segments")
+
+        # Workers are spawned rather than forked, as the job runs next to other threads. They count their processed
+        # frames in shared memory, which is read into the job's progress while they run.
+        try:
+            context = multiprocessing.get_context("spawn")
+            progress = context.Array("q", len(self.segments))
+            with concurrent.futures.ProcessPoolExecutor(len(self.segments), mp_context=context,
+                                                        initializer=init_segment_worker,
+                                                        initargs=(progress,)) as executor:
+                futures = [executor.submit(analyze_segment, self.data, self.data_provider.video_path, segment,
+                                           segment is self.segments[-1], self.kwargs)
+                           for segment in self.segments]
+                while concurrent.futures.wait(futures, SEGMENT_PROGRESS_INTERVAL).not_done:
+                    self.report_progress(sum(progress))
+                results = [future.result() for future in futures]
+            self.merge(results)
+
+        finally:
+            self.video_manager.cap_release()
+
+    def report_progress(self, processed_frames):
+
+        # Only the frames processed since the last report are added.
+        self.video_manager.increment_processed_frame_count(processed_frames - self.reported_frames)
+        self.reported_frames = processed_frames
+
+    def merge(self, results):
+        self.report_progress(sum(result["processed_frames"] for result in results))
+        stage_metrics = STAGE_METRICS.get_job(self.video_manager.get_job_id())
+        for result in results:
+            self.video_manager.increment_gated_frame_count(result["gated_frames"])
+            for snapshot in result["stage_metrics"]:
+                stage_metrics.merge(snapshot)
+
+        # The analysis ended after the last frame of the last segment.
+        last_segment = self.segments[-1]
+        end_position = last_segment.first_frame + results[-1]["processed_frames"]
+        customers, phantom_exits = self.stitch_customers(results)
+        self.build_reports(customers, end_position)
+        self.video_manager.set_frame_position(end_position)
+
+        heatmaps = [result["heatmap"] for result in results if result["heatmap"] is not None]
+        heatmap = np.sum(heatmaps, axis=0) if heatmaps else None
+
+        counts = {}
+        for result in results:
+            for name, class_counts in result["counts"].items():
+                merged_counts = counts.setdefault(name, dict.fromkeys(class_counts, 0))
+                for count_type, value in class_counts.items():
+                    merged_counts[count_type] += value
+
+        # Exits of the customers a segment counted in its overlap, that the previous segment never counted.
+        for customer in phantom_exits:
+            count_type = (CountType.CLEAN_OUT if customer["exit_type"] == ExitType.CLEAN.value else
+                          CountType.DIRTY_OUT)
+            if customer["name"] in counts:
+                counts[customer["name"]][count_type.value] -= 1
+
+        ctx = results[-1]["last_ctx"]
+        if ctx is not None:
+            ctx.counts = counts
+            ctx.show_heatmap = ctx.show_heatmap and heatmap is not None
+            if ctx.show_heatmap:
+                ctx.heatmap, ctx.heatmap_max = heatmap, float(heatmap.max())
+            self.frame_analyzer.render(ctx)
+            self.data_provider.provide(ctx.annotated, ctx.clean)
+
+    def stitch_customers(self, results):
+        customers, phantom_exits, open_customers, previous = [], [], {}, None
+        for segment, result in zip(self.segments, results):
+            start_time = self.video_manager.get_frame_time(segment.start_frame)
+            matches = match_tracks(result["boundary_tracks"], previous["end_tracks"]) if previous else {}
+
+            # Customers of this segment still in the store at its end, by their track id in this segment.
+            carried = {}
+            for customer in result["customers"]:
+
+                # Left during the overlap - the previous segment already reported it.
+                if customer["exit"] is not None and customer["exit"] < start_time:
+                    continue
+
+                # Entered in this segment's own part.
+                if customer["entrance"] >= start_time:
+                    customers.append(customer)
+                    if customer["exit"] is None:
+                        carried[customer["track_id"]] = customer
+                    continue
+
+                # Was already in the store at the start of this segment's part - the same customer as the one the
+                # previous segment counted, if it counted him at all.
+                stitched = open_customers.pop(matches.get(customer["track_id"]), None)
+                if stitched is not None:
+                    stitched["exit"], stitched["exit_type"] = customer["exit"], customer["exit_type"]
+
+                    # Labels keep their history from the previous segment, then change as this segment saw them change
+                    # in its own part. A customer the previous segment never classified takes this segment's labels.
+                    own_labels = [label for label in customer["labels"] if label[0] >= segment.start_frame]
+                    if label_at(stitched["labels"], segment.start_frame - 1) == (None, None):
+                        age, gender = label_at(customer["labels"], segment.start_frame - 1)
+                        if (age, gender) != (None, None):
+                            own_labels.insert(0, (segment.start_frame, age, gender))
+                    stitched["labels"] = stitched["labels"] + own_labels
+                    if own_labels:
+                        stitched["age"], stitched["gender"] = customer["age"], customer["gender"]
+                    else:
+                        stitched["age"] = stitched["age"] or customer["age"]
+                        stitched["gender"] = stitched["gender"] or customer["gender"]
+                    if stitched["exit"] is None:
+                        carried[customer["track_id"]] = stitched
+                elif customer["exit"] is not None:
+                    phantom_exits.append(customer)
+
+            # Customers of the previous segment this segment did not count - carried on while it still tracks them,
+            # and otherwise left the way lost tracks do, on the frame after they were last seen.
+            previous_to_current = {previous_id: track_id for track_id, previous_id in matches.items()}
+            for previous_id, customer in open_customers.items():
+                track_id = previous_to_current.get(previous_id)
+                if track_id is not None and track_id in result["end_tracks"]:
+                    carried[track_id] = customer
+                    continue
+                last_seen = result["last_seen"].get(track_id, segment.start_frame - 1)
+                customer["exit"] = self.video_manager.get_frame_time(last_seen + 1)
+                customer["exit_type"] = ExitType.DIRTY.value
+
+            open_customers, previous = carried, result
+        return customers, phantom_exits
+
+    def build_reports(self, customers, end_position):
+
+        # The timeslices are the ones the serial analysis saves - every saving interval of frames after the first one,
+        # and only complete ones.
+        first_frame, interval = self.segments[0].first_frame, max(1, self.video_manager.get_fps())
+
+        # In the order the serial analysis adds the customers up - those in the store by entrance, those that left by
+        # exit - so the average dwell times are the same to the last digit.
+        customers = sorted(customers, key=lambda customer: customer["entrance"])
+        exits = sorted((customer for customer in customers if customer["exit"] is not None),
+                       key=lambda customer: customer["exit"])
+        for slice_index in range((end_position - first_frame - 1) // interval):
+            slice_start = first_frame + 1 + slice_index * interval
+            start_time = self.video_manager.get_frame_time(slice_start)
+            end_time = self.video_manager.get_frame_time(slice_start + interval)
+
+            # Left during this timeslice.
+            past_customers = [{
+                PastCustomer.AGE.value: customer["age"],
+                PastCustomer.GENDER.value: customer["gender"],
+                PastCustomer.DWELL.value: {DwellTime.DWELL.value: customer["exit"] - customer["entrance"]},
+            } for customer in exits
+                if start_time <= customer["exit"] < end_time and customer["age"] and customer["gender"]]
+
+            # Still in the store at the end of this timeslice, with the labels they had then.
+            ages, genders, dwell_times = {}, {}, {}
+            for index, customer in enumerate(customers):
+                if customer["entrance"] >= end_time or customer["exit"] is not None and customer["exit"] < end_time:
+                    continue
+                dwell_times[index] = {DwellTime.ENTRANCE.value: customer["entrance"]}
+                age, gender = label_at(customer["labels"], slice_start + interval - 1)
+                if age:
+                    ages[index] = age
+                if gender:
+                    genders[index] = gender
+
+            self.video_manager.set_current_timeslice_start(start_time)
+            self.video_manager.set_frame_position(slice_start + interval)
+            self.data_provider.local_save(len(dwell_times), ages, dwell_times, genders, past_customers)
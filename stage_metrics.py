@@ -0,0 +1,139 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from util import STAGE_TIMER_BUCKETS
+
+
+class Histogram:
+    """
+    Durations observed by a single timer, counted in fixed buckets - the count of each bucket is kept on its own, and
+    made cumulative only when exported.
+    """
+    __slots__ = ("bucket_counts", "sum", "count")
+
+    def __init__(self, bucket_count):
+        self.bucket_counts = [0] * (bucket_count + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class StageMetrics:
+    """
+    Timers of the analysis stages of a single job, aggregated as histograms of their durations.
+
+    A timer costs two clock reads and a short locked update, so it can wrap per-frame work. The stages run in different
+    threads, and are read by the metrics endpoint meanwhile, so the histograms are guarded by a lock.
+    """
+
+    def __init__(self, job_id=None, buckets=STAGE_TIMER_BUCKETS):
+
+        # Job the timers belong to, used as the job label of the exported metrics.
+        self.job_id = job_id
+
+        # Upper bounds, in seconds, of the histogram buckets.
+        self.buckets = tuple(buckets)
+
+        # Histograms by stage name.
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage.value)
+            if histogram is None:
+                histogram = self.histograms[stage.value] = Histogram(len(self.buckets))
+            histogram.bucket_counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram.sum += seconds
+            histogram.count += 1
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def snapshot(self):
+
+        # Bucket counts, sum and count of each histogram, as plain values that can be sent to another process.
+        with self.lock:
+            return {stage: (list(histogram.bucket_counts), histogram.sum, histogram.count)
+                    for stage, histogram in self.histograms.items()}
+
+    def merge(self, snapshot):
+
+        # Adds the histograms of a snapshot, timed with the same buckets - a part of the job analyzed elsewhere.
+        with self.lock:
+            for stage, (bucket_counts, total, count) in snapshot.items():
+                histogram = self.histograms.get(stage)
+                if histogram is None:
+                    histogram = self.histograms[stage] = Histogram(len(self.buckets))
+                for index, bucket_count in enumerate(bucket_counts):
+                    histogram.bucket_counts[index] += bucket_count
+                histogram.sum += total
+                histogram.count += count
+
+    def render(self, name):
+
+        # Histograms in the Prometheus text format, with cumulative buckets.
+        lines = []
+        for stage, (bucket_counts, total, count) in sorted(self.snapshot().items()):
+            labels = f'job="{escape_label(self.job_id)}",stage="{stage}"'
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{{labels},le="{format_bound(bound)}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{labels}}} {total}")
+            lines.append(f"{name}_count{{{labels}}} {count}")
+        return lines
+
+
+class StageMetricsRegistry:
+    """
+    Stage timers of all jobs of the process, by job id, exported together by the metrics endpoint.
+    """
+
+    # Name of the exported histogram.
+    METRIC_NAME = "store_analysis_stage_seconds"
+
+    def __init__(self):
+
+        # Stage timers by job id.
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def get_job(self, job_id):
+        with self.lock:
+            metrics = self.jobs.get(str(job_id))
+            if metrics is None:
+                metrics = self.jobs[str(job_id)] = StageMetrics(str(job_id))
+            return metrics
+
+    def forget(self, job_id):
+        with self.lock:
+            self.jobs.pop(str(job_id), None)
+
+    def render(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+
+        lines = [f"# HELP {self.METRIC_NAME} Time spent in each analysis stage, per call.",
+                 f"# TYPE {self.METRIC_NAME} histogram"]
+        for metrics in jobs:
+            lines += metrics.render(self.METRIC_NAME)
+        return lines
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+# Single registry of the process, shared by all jobs.
+STAGE_METRICS = StageMetricsRegistry()
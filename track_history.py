@@ -0,0 +1,89 @@
+import numpy as np
+
+from util import TRACK_HISTORY_CAPACITY, TRACK_HISTORY_LENGTH, TRACK_HISTORY_TTL
+
+
+class TrackHistory:
+    """
+    Recent center positions of each track, held in a preallocated (slots, length, 2) ring buffer.
+
+    Each track id is mapped to a slot. A slot is recycled once its track was not seen for `ttl` frames, so short
+    detector flaps keep their history, while tracks that left the scene don't hold memory for the rest of the video.
+    The buffer only grows when more tracks are alive at once than there are slots.
+    """
+
+    def __init__(self, capacity=TRACK_HISTORY_CAPACITY, length=TRACK_HISTORY_LENGTH, ttl=TRACK_HISTORY_TTL):
+        self.length = length
+        self.ttl = ttl
+
+        # Ring buffer of positions per slot, the index the next position is written to, and the number of positions
+        # stored (up to length).
+        self.positions = np.zeros((capacity, length, 2), dtype=np.float32)
+        self.heads = np.zeros(capacity, dtype=np.int32)
+        self.counts = np.zeros(capacity, dtype=np.int32)
+
+        # Frame each slot was last written in, and the track id that owns it (-1 for a free slot).
+        self.last_seen = np.zeros(capacity, dtype=np.int64)
+        self.slot_ids = np.full(capacity, -1, dtype=np.int64)
+
+        # Slot of each track id, and the free slots - popped from the end, so lower slots are used first.
+        self.slots = {}
+        self.free_slots = list(range(capacity - 1, -1, -1))
+
+        # Current frame number.
+        self.frame = 0
+
+    def advance(self):
+
+        # Move to the next frame, and recycle the slots of tracks that were not seen for too long.
+        self.frame += 1
+        stale = np.nonzero((self.slot_ids >= 0) & (self.last_seen < self.frame - self.ttl))[0]
+        for slot in stale.tolist():
+            self.slots.pop(int(self.slot_ids[slot]), None)
+            self.slot_ids[slot] = -1
+            self.free_slots.append(slot)
+
+    def get_slot(self, track_id):
+        slot = self.slots.get(track_id)
+        if slot is None:
+            if not self.free_slots:
+                self.grow()
+            slot = self.free_slots.pop()
+            self.slots[track_id] = slot
+            self.slot_ids[slot] = track_id
+            self.heads[slot] = 0
+            self.counts[slot] = 0
+        return slot
+
+    def grow(self):
+        capacity = len(self.slot_ids)
+        self.positions = np.concatenate([self.positions, np.zeros_like(self.positions)])
+        self.heads = np.concatenate([self.heads, np.zeros(capacity, dtype=np.int32)])
+        self.counts = np.concatenate([self.counts, np.zeros(capacity, dtype=np.int32)])
+        self.last_seen = np.concatenate([self.last_seen, np.zeros(capacity, dtype=np.int64)])
+        self.slot_ids = np.concatenate([self.slot_ids, np.full(capacity, -1, dtype=np.int64)])
+        self.free_slots.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def append(self, track_id, position):
+        slot = self.get_slot(track_id)
+        self.positions[slot, self.heads[slot]] = position
+        self.heads[slot] = (self.heads[slot] + 1) % self.length
+        self.counts[slot] = min(self.counts[slot] + 1, self.length)
+        self.last_seen[slot] = self.frame
+
+    def has_history(self, track_id):
+        slot = self.slots.get(track_id)
+        return slot is not None and self.counts[slot] > 1
+
+    def get_prev_position(self, track_id):
+
+        # Position before the last one appended.
+        slot = self.slots[track_id]
+        return self.positions[slot, (self.heads[slot] - 2) % self.length]
+
+    def get_prev_positions(self, track_ids):
+        slots = np.fromiter((self.slots[track_id] for track_id in track_ids), dtype=np.int64, count=len(track_ids))
+        return self.positions[slots, (self.heads[slots] - 2) % self.length]
+
+    def __len__(self):
+        return len(self.slots)
@@ -0,0 +1,115 @@
+from util import PastCustomer
+
+
+class TrackRecord:
+    """
+    State of a single track. Slotted, as a record is kept for every track seen during the video.
+    """
+    __slots__ = ("track_id", "present", "dirty", "counted", "dwell")
+
+    def __init__(self, track_id):
+        self.track_id = track_id
+
+        # Whether the track is a client currently in the store.
+        self.present = False
+
+        # Whether the track entered the frame not through the entrance line.
+        self.dirty = False
+
+        # Whether the track entered cleanly and is counted as a client.
+        self.counted = False
+
+        # Dwell time record of a counted client - entrance, exit and their types.
+        self.dwell = None
+
+
+class TrackStateStore:
+    """
+    Indexed state of all tracks - presence, dirty/clean state, dwell records and past customers, with O(1) lookups by
+    track id. Classification results stay in the classifiers, which already keep them by track id.
+    """
+
+    def __init__(self):
+
+        # Records of the known tracks, by track id.
+        self.records = {}
+
+        # Ids of the counted clients, in the order they entered. A dict is used as an insertion ordered set.
+        self.counted_ids = {}
+
+        # Dwell records of the counted clients, by track id - the shape the data provider reports from.
+        self.dwell_times = {}
+
+        # Past customers - global list that won't be reset until the termination of the program, and its id index.
+        self.past_customers = []
+        self.past_customer_ids = set()
+
+        # Past customers in current timeslice - will be reseated with each new timeslice.
+        self.past_customers_in_timeslice = []
+
+    def get_record(self, track_id):
+        record = self.records.get(track_id)
+        if record is None:
+            record = self.records[track_id] = TrackRecord(track_id)
+        return record
+
+    def forget(self, track_id):
+        self.records.pop(track_id, None)
+        self.counted_ids.pop(track_id, None)
+        self.dwell_times.pop(track_id, None)
+
+# ----------------------Presence--------------------------
+    def is_present(self, track_id):
+        record = self.records.get(track_id)
+        return record is not None and record.present
+
+    def set_present(self, track_id, present):
+        self.get_record(track_id).present = present
+
+# ----------------------Dirty/clean--------------------------
+    def is_dirty(self, track_id):
+        record = self.records.get(track_id)
+        return record is not None and record.dirty
+
+    def set_dirty(self, track_id, dirty):
+        self.get_record(track_id).dirty = dirty
+
+    def is_counted(self, track_id):
+        record = self.records.get(track_id)
+        return record is not None and record.counted
+
+    def set_counted(self, track_id):
+        self.get_record(track_id).counted = True
+        self.counted_ids[track_id] = None
+
+    def get_counted_ids(self):
+        return list(self.counted_ids)
+
+# ----------------------Dwell--------------------------
+    def open_dwell(self, track_id, dwell):
+        self.get_record(track_id).dwell = dwell
+        self.dwell_times[track_id] = dwell
+
+    def get_dwell(self, track_id):
+        return self.dwell_times.get(track_id)
+
+    def has_dwell(self, track_id):
+        return track_id in self.dwell_times
+
+# ----------------------Past customers--------------------------
+    def add_past_customer(self, track_id, age, gender):
+        customer = {
+            PastCustomer.TRACK_ID.value: track_id,
+            PastCustomer.DWELL.value: self.dwell_times[track_id],
+            PastCustomer.AGE.value: age,
+            PastCustomer.GENDER.value: gender,
+        }
+        self.past_customers_in_timeslice.append(dict(customer))
+        self.past_customers.append(customer)
+        self.past_customer_ids.add(track_id)
+
+    def is_past_customer(self, track_id):
+        return track_id in self.past_customer_ids
+
+    def reset_timeslice(self):
+        self.past_customers_in_timeslice = []
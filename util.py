@@ -8,6 +8,9 @@ from enum import Enum
 import cv2
 import numpy as np
 import csv
+import re
+from urllib.parse import urlparse
+from urllib.request import url2pathname
 
 
 # ENUMS
@@ -26,6 +29,16 @@ class ResponseStatus(Enum):
     OK = 200
     ERROR = 500
     PROCESSING = 202
+    NOT_FOUND = 404
+    CONFLICT = 409
+    UNAVAILABLE = 503
+
+
+class JobStatus(Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
 
 
 class WeightsPath(Enum):
@@ -34,6 +47,18 @@ class WeightsPath(Enum):
     GENDER_CLASSIFIER = 'weights/cctv-gender-classifier.pt'
 
 
+class InferenceBackend(Enum):
+    PYTORCH = "pytorch"  # The .pt weights as they are.
+    ONNX = "onnx"  # ONNX Runtime, exported from the .pt weights on first use.
+    OPENVINO = "openvino"  # OpenVINO, exported from the .pt weights on first use.
+
+
+class DebugCropMode(Enum):
+    OFF = "off"  # No classified crops are saved.
+    SAMPLE = "sample"  # Every N-th classified crop is saved.
+    LOW_CONF = "low_conf"  # Only crops classified with low confidence are saved.
+
+
 class CountType(Enum):
     DIRTY_IN = "DIRTY_IN"
     DIRTY_OUT = "DIRTY_OUT"
@@ -56,21 +81,92 @@ class DwellTime(Enum):
     EXIT_TYPE = "exit_type"
 
 
+class CrossingDirection(Enum):
+    NONE = 0  # Did not cross the counting line.
+    IN = 1  # Crossed the counting line towards the top of the screen.
+    OUT = 2  # Crossed the counting line towards the bottom of the screen.
+
+
 class ClassifierType(Enum):
     AGE = "age"
     GENDER = "gender"
 
 
+class Stage(Enum):
+    DECODE = "decode"  # Reading and decoding a frame of the video.
+    TRACK = "track"  # Detecting and tracking the objects of a frame.
+    CLASSIFY = "classify"  # Classifying a batch of crops with the age and gender classifiers.
+    HEATMAP = "heatmap"  # Accumulating the boxes of a frame into the heatmap.
+    HEATMAP_RENDER = "heatmap_render"  # Colorizing the heatmap and blending it into a frame.
+    ANNOTATE = "annotate"  # Drawing the boxes, labels and counts on a frame.
+    ENCODE = "encode"  # Encoding a frame into the output video.
+    IO = "io"  # Saving the reports and heatmaps, and sending them to the server.
+
+
 class HeatmapType(Enum):
     ANNOTATED = "annotated"
     CLEAN = "clean"
 
 
 # CONSTANTS
-REEVALUATION_INTERVAL = 5  # Frames interval for re-evaluating predictions.
+REEVALUATION_INTERVAL = 5  # Minimal frames interval between re-evaluations of the predictions of a track.
+REEVALUATION_BUDGET = 4  # Crops re-classified per frame, over all tracks and classifiers.
+REEVALUATION_TOP_K = 3  # Best crops kept for each track, and voted over when it is re-classified.
+CROP_FULL_QUALITY_HEIGHT = 256  # Height of a box from which a crop is not considered better for its size.
+CROP_SHARPNESS_HEIGHT = 64  # Height crops are downscaled to before their sharpness is measured.
+CROP_HALF_SHARPNESS = 100.0  # Laplacian variance that scores half of the sharpness score.
+FRONTAL_ASPECT_RATIO = 0.45  # Width to height ratio of the box of a person facing the camera.
+MIN_CROP_AREA = 2500  # Minimal box area, in pixels, of a crop good enough to classify.
+MIN_CROP_ASPECT_RATIO = 0.2  # Minimal width to height ratio of a crop good enough to classify.
+MAX_CROP_ASPECT_RATIO = 1.0  # Maximal width to height ratio of a crop good enough to classify.
+CROP_BORDER_MARGIN = 5  # Minimal distance, in pixels, of a crop good enough to classify from the frame border.
+MIN_CROP_SHARPNESS = 20.0  # Minimal Laplacian variance of a crop good enough to classify.
+CLASSIFICATION_DEADLINE = 15  # Frames a new client waits for a good crop, before its best crop so far is classified.
 LOW_CONF = 0.75  # Confidence threshold for predictions.
+CLASSIFICATION_BATCH_WINDOW = 1  # Frames over which classification requests are collected into a single batch.
+MAX_CLASSIFICATION_BATCH = 32  # Maximal number of crops classified in a single inference call.
 SAVING_INTERVAL = 5  # Number of frames between saving data.
 NOT_DETECTED = "Not Detected"
+MAX_CONCURRENT_JOBS = 2  # Number of videos that are analyzed at the same time.
+MAX_QUEUED_JOBS = 32  # Number of uploaded videos that may wait for a free worker.
+MAX_FINISHED_JOBS = 256  # Number of finished jobs whose status is kept for the status endpoint.
+PIPELINED_ANALYSIS = True  # Run decoding, detection, analysis, rendering and encoding as concurrent stages.
+PIPELINE_QUEUE_SIZE = 8  # Number of frames that may wait between two pipeline stages.
+DETECTION_STRIDE = 1  # Detection runs every this number of frames, boxes are interpolated in the frames between.
+MOTION_GATE = True  # Skip detection on frames where nothing moved, while no one is tracked.
+MOTION_GATE_WIDTH = 160  # Width frames are downscaled to for motion detection.
+MOTION_PIXEL_THRESHOLD = 15  # Change of a downscaled pixel value that counts as motion.
+MOTION_AREA_THRESHOLD = 0.001  # Fraction of changed downscaled pixels that opens the motion gate.
+HEATMAP_SCALE = 0.25  # Resolution of the heatmap accumulator relative to the frame.
+HEATMAP_INCREMENT = 2  # Value added to the heatmap for every pixel covered by an object in a frame.
+HEATMAP_KERNEL_CACHE_SIZE = 4096  # Number of disk kernels, one per box size, kept in memory.
+HEATMAP_REFRESH_INTERVAL = 5  # Frames between refreshes of the heatmap overlay drawn on the output video.
+LOCAL_VIDEO_ROOTS = [root for root in os.getenv("LOCAL_VIDEO_ROOTS", "").split(os.pathsep) if root]  # Mounted directories videos may be opened from in place, none by default.
+DOWNLOAD_CHUNK_SIZE = 1 << 16  # Bytes of the downloaded video held in memory at once.
+DOWNLOAD_TIMEOUT = 30  # Seconds to wait for the video server to connect or send data.
+PROGRESSIVE_POLL_INTERVAL = 0.5  # Seconds to wait for more data when decoding catches up with a progressive download.
+TRACK_HISTORY_LENGTH = 30  # Number of recent positions kept for each track.
+TRACK_HISTORY_CAPACITY = 256  # Number of tracks the history is preallocated for, grows if more are alive at once.
+TRACK_HISTORY_TTL = 30  # Frames a lost track keeps its history, in case the detector re-tracks it.
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", InferenceBackend.PYTORCH.value)  # Runtime all models are run with.
+QUANTIZED_CLASSIFIERS = os.getenv("QUANTIZED_CLASSIFIERS", "0") == "1"  # Run the INT8 classifiers where they were built.
+DEBUG_CROP_MODE = DebugCropMode.SAMPLE.value  # Which classified crops are saved for debugging.
+DEBUG_CROP_SAMPLE_RATE = 10  # One in this number of classified crops is saved, in sample mode.
+DEBUG_CROP_QUOTA = 256 * 1024 * 1024  # Bytes of debug crops a single job may save.
+DEBUG_CROP_QUEUE_SIZE = 256  # Number of crops that may wait to be saved, more are dropped.
+SHARED_DETECTION = os.getenv("SHARED_DETECTION", "0") == "1"  # Detect the frames of all jobs on a shared, batching server.
+DETECTION_BATCH_SIZE = 16  # Maximal number of frames, from all streams, detected in a single inference call.
+DETECTION_BATCH_WAIT = 0.005  # Seconds a detection batch waits for frames of other streams after its first frame.
+TRACKER_FRAME_RATE = 30  # Frame rate the trackers are configured for, the same one model.track uses.
+STAGE_TIMER_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)  # Seconds.
+SEGMENT_WORKERS = 1  # Worker processes a single video is split between, 1 analyzes it in the job's own process.
+SEGMENT_OVERLAP = 2.0  # Seconds each segment starts before its part, so its tracks are settled when its part starts.
+SEGMENT_PROGRESS_INTERVAL = 1.0  # Seconds between updates of the job's processed frames from the counts of its segment workers.
+MIN_SEGMENT_LENGTH = 60  # Minimal length, in seconds, of a segment - shorter videos are split between fewer workers.
+SEGMENT_MATCH_IOU = 0.5  # Minimal IoU of the boxes of the same person in two segments, on the frame they share.
+WARM_UP_IMAGE_SIZE = 640  # Size of the blank image used to warm up the models when they are loaded.
+RECORD_DETECTIONS = os.getenv("RECORD_DETECTIONS", "0") == "1"  # Let jobs record their detections and classifications, so they can be replayed with no model.
+DETECTION_RECORD_DIR = "detections"  # Directory, under the job's directory, the detections are recorded to.
 
 RED = (0, 0, 255)
 GREEN = (0, 255, 0)
@@ -101,17 +197,8 @@ def normalize_heatmap(im0, heatmap, colormap):
     )
 
 
-def box_to_image(image, bounding_box):
-    """
-    Extracts a bounding box region from an image and returns it as a YOLO-compatible input.
-
-    Parameters:
-        image (np.ndarray): The original image (in NumPy array format, e.g., read by OpenCV).
-        bounding_box (tuple): The bounding box coordinates in the format (x1, y1, x2, y2).
+def crop_box(image, bounding_box):
 
-    Returns:
-        np.ndarray: The extracted region as a YOLO-compatible image with uint8 data type.
-    """
     # Unpack bounding box coordinates
     x1, y1, x2, y2 = bounding_box
 
@@ -122,11 +209,30 @@ def box_to_image(image, bounding_box):
     x2 = min(image.shape[1], x2)
     y2 = min(image.shape[0], y2)
 
+    # A view of the region - copy it to keep it beyond the frame
+    return image[y1:y2, x1:x2]
+
+
+def box_to_image(image, bounding_box, size=640):
+    """
+    Extracts a bounding box region from an image and returns it as a YOLO-compatible input.
+
+    Parameters:
+        image (np.ndarray): The original image (in NumPy array format, e.g., read by OpenCV).
+        bounding_box (tuple): The bounding box coordinates in the format (x1, y1, x2, y2).
+        size (int): Input size of the model the region is given to.
+
+    Returns:
+        np.ndarray: The extracted region as a YOLO-compatible image with uint8 data type.
+    """
     # Crop the region of interest (ROI) from the image
-    cropped_image = image[y1:y2, x1:x2]
+    return crop_to_image(crop_box(image, bounding_box), size)
+
+
+def crop_to_image(cropped_image, size=640):
 
-    # Resize to YOLO's input size (e.g., 640x640, adjust as needed)
-    resized_image = cv2.resize(cropped_image, (640, 640))
+    # Resize to the model's input size, so it is not resized again by the model
+    resized_image = cv2.resize(cropped_image, (size, size))
 
     # Convert to uint8 (YOLO requires this)
     resized_image_uint8 = (resized_image * 255).astype(
@@ -135,6 +241,19 @@ def box_to_image(image, bounding_box):
     return resized_image_uint8
 
 
+def box_iou(boxes1, boxes2):
+
+    # IoU of every box of the first (N, 4) array with every box of the second (M, 4) array, in xyxy format.
+    x1 = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    y1 = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    x2 = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+    y2 = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    return intersection / (area1[:, None] + area2[None, :] - intersection + 1e-9)
+
+
 def annotate_object(track_id, cls, box, age, gender, annotator, color):
     label = f"{cls} id:{track_id} age:{age} gender: {gender}"  # Label includes class name and track ID
     annotator.box_label(box, label, color=color)  # Red bounding box for better visibility
@@ -190,9 +309,11 @@ def export_to_local_txt(reports, base_dir):
             file.write(line + "\n")
 
 
-def make_dirs():
+def make_dirs(job_id=None):
     current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-    base_dir = f"./logs/{current_time}"
+
+    # Jobs may start in the same second, so the job id keeps their outputs apart.
+    base_dir = f"./logs/{current_time}" if job_id is None else f"./logs/{current_time}_{job_id}"
     dirs = [f"{base_dir}/classifications/gender/female", f"{base_dir}/classifications/gender/male",
             f"{base_dir}/classifications/age/adult", f"{base_dir}/classifications/age/children",
             f"{base_dir}/classifications/age/elder", f"{base_dir}/classifications/age/young",
@@ -202,3 +323,35 @@ def make_dirs():
         os.makedirs(directory, exist_ok=True)
 
     return base_dir
+
+
+def get_local_video_path(url):
+
+    # Path of a video that is already on a local or mounted file system - a file:// URL, or a path with no URL scheme.
+    # Any other URL has to be downloaded, so None is returned. A Windows drive letter is not a URL scheme.
+    if re.match(r"^[A-Za-z]:[\\/]", url):
+        path = url
+    else:
+        parsed = urlparse(url)
+        if parsed.scheme == "file" and parsed.netloc in ("", "localhost"):
+            path = url2pathname(parsed.path)
+        elif parsed.scheme == "":
+            path = url
+        elif parsed.scheme in ("http", "https"):
+            return None
+        else:
+            raise Exception(f"Failed to load video. Unsupported URL: {url}")
+
+    # Only videos under the configured mount roots are opened, wherever links point - the job URL comes from the
+    # request, and must not reach any other file of the machine.
+    real_path = os.path.realpath(path)
+    for root in LOCAL_VIDEO_ROOTS:
+        real_root = os.path.realpath(root)
+        try:
+            if os.path.commonpath([real_path, real_root]) == real_root:
+                return real_path
+        except ValueError:
+
+            # Paths on different drives have no common path.
+            continue
+    raise Exception(f"Failed to load video. {path} is not in an allowed video directory.")
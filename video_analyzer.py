@@ -1,23 +1,35 @@
 from object_tracker import ObjectTracker
-from util import init_writer, OUTPUT_VID_PATH
+from model_registry import MODEL_REGISTRY
+from util import (init_writer, OUTPUT_VID_PATH, WeightsPath, Stage, PIPELINED_ANALYSIS, SHARED_DETECTION,
+                  DETECTION_RECORD_DIR)
 from frame_analyzer import FrameAnalyzer
+from frame_pipeline import FramePipeline, FrameContext
+from detections import Detections
+from motion_gate import MotionGate
+from debug_crop_writer import DebugCropWriter
+from detection_record import DetectionRecorder, DetectionReplay
+from stage_metrics import STAGE_METRICS
 from heatmap_manager import HeatmapManager
 from object_counter import ObjectCounter
 from ultralytics.utils import DEFAULT_CFG_DICT, DEFAULT_SOL_DICT, LOGGER
-from ultralytics import YOLO
+
+
+def get_shared_detection_server():
+
+    # The server pulls in the Ultralytics trackers, so it is only imported when shared detection is on.
+    if not SHARED_DETECTION:
+        return None
+    from detection_server import DETECTION_SERVER
+    return DETECTION_SERVER
+
 
 class VideoAnalyzer:
     def __init__(self, data_provider, video_manager, **kwargs):
 
-        # Load Ultralytics config and update with args
-        DEFAULT_SOL_DICT.update(kwargs)
-        DEFAULT_CFG_DICT.update(kwargs)
-        self.CFG = {**DEFAULT_SOL_DICT, **DEFAULT_CFG_DICT}
-        LOGGER.info(f"Ultralytics Solutions: ✅ {DEFAULT_SOL_DICT}")
-
-        # YOLO Model that will be used in order to track customers - Only Video Analyzer will create a new instance.
-        # All other classes will receive references of this one - Singleton.
-        self.model = YOLO(self.CFG["model"].value if self.CFG["model"] else "yolov8n.pt")
+        # Load Ultralytics config and update with args. The defaults are copied rather than updated in place, as
+        # several jobs may run in the same process, each with its own region.
+        self.CFG = {**DEFAULT_SOL_DICT, **DEFAULT_CFG_DICT, **kwargs}
+        LOGGER.info(f"Ultralytics Solutions: ✅ {self.CFG}")
 
         # Data Provider - will handle data flow in the program, from local saving to triggering API calls.
         self.data_provider = data_provider
@@ -25,83 +37,243 @@ class VideoAnalyzer:
         # Video Manager - will be responsible to handle all metadata regarding the video.
         self.video_manager = video_manager
 
+        # Detections and classifications of an earlier job, replayed instead of running the models.
+        replay_path = self.video_manager.get_detection_replay_path()
+        self.detection_replay = DetectionReplay(replay_path) if replay_path else None
+
+        # YOLO Model that will be used in order to track customers - borrowed from the process-wide registry, so the
+        # weights are loaded once per process while the tracker state stays private to this job. All other classes
+        # will receive references of this one. A replayed job loads no model, the replay provides the class names.
+        self.model = (self.detection_replay if self.detection_replay is not None else
+                      MODEL_REGISTRY.borrow(self.CFG["model"] or WeightsPath.PERSON_TRACKER))
+
+        # Records the detections and classifications of this job, so it can be analyzed again with no model.
+        self.detection_recorder = (DetectionRecorder(self.data_provider.base_dir + "/" + DETECTION_RECORD_DIR,
+                                                     self.video_manager, self.model.names)
+                                   if self.video_manager.is_recording_detections() else None)
+
+        # Stage timers of this job, exported by the metrics endpoint.
+        self.stage_metrics = STAGE_METRICS.get_job(self.video_manager.get_job_id())
+
         # Heatmap Manager - will handle all operations related heatmap.
         self.heatmap_manager = HeatmapManager(self.CFG)
 
+        # Debug Crop Writer - saves a sample of the classified crops under the job directory, in the background.
+        self.debug_crop_writer = DebugCropWriter(self.data_provider.base_dir, self.video_manager.get_debug_crop_mode())
+
         # Object Tracker - will handle all the tracking logic. All relevant data structures that are used for the logic
         # of tracking will live in its scope. It is using also Object Counter who's single responsibility is to handle
         # the counting logic in the program. Notice that ObjectCounter is dynamically injected into Object Tracker,
         # which will allows us to change counter with no need to change code while they will implement the same
-        # interface.
+        # interface. With shared detection, the frames are detected in batches with the frames of the other jobs, and
+        # only tracked by this job.
         self.object_tracker = ObjectTracker(ObjectCounter(self.model, self.video_manager),
-                                            self.video_manager, self.model, self.CFG)
+                                            self.video_manager, self.model, self.CFG, self.debug_crop_writer,
+                                            get_shared_detection_server(), self.stage_metrics,
+                                            self.detection_recorder, self.detection_replay)
 
         # Frame Analyzer -
-        self.frame_analyzer = FrameAnalyzer(self.object_tracker, self.CFG, self.heatmap_manager)
+        self.frame_analyzer = FrameAnalyzer(self.object_tracker, self.CFG, self.heatmap_manager, self.stage_metrics)
 
-        self.video_writer = init_writer(self.data_provider.base_dir + "/" + OUTPUT_VID_PATH, video_manager)
-        self.annotator = None
+        # Headless jobs skip the rendering and encoding of every frame, only the final heatmap is rendered.
+        self.headless = self.video_manager.is_headless()
+        self.video_writer = (None if self.headless else
+                             init_writer(self.data_provider.base_dir + "/" + OUTPUT_VID_PATH, video_manager))
 
         # Set saving interval to number of frames per second.
         self.saving_interval = self.video_manager.get_fps()
 
-    def initialize(self, first_frame):
+        # Last rendered images, uploaded once the whole video was analyzed.
+        self.last_annotated_heatmap_image = None
+        self.last_clean_heatmap_image = None
+
+        # Last analyzed frame, rendered at the end of a headless job.
+        self.last_ctx = None
+
+        # Detection runs on every detection_stride-th frame only. The frames in between wait for the next detected
+        # keyframe, and their boxes are interpolated between the two keyframes around them.
+        self.detection_stride = self.video_manager.get_detection_stride()
+        self.stride_frames = []
+        self.last_keyframe = None
+
+        # Motion gate - skips the detection on keyframes where nothing moved since the last detection found no one.
+        self.motion_gate = MotionGate() if self.video_manager.is_motion_gated() else None
+
+    def initialize(self, ctx):
 
         # Initialize heatmap
-        self.heatmap_manager.initialize_heatmap(first_frame.copy())
-        return self.frame_analyzer.initialize(first_frame)
+        self.heatmap_manager.initialize_heatmap(ctx.frame.copy())
+        self.frame_analyzer.initialize(ctx)
 
     def analyze(self):
 
-        ret, frame = self.video_manager.read_frame()
-        heatmap_image = None
-        prev_annotated_heatmap_image = None
-        prev_clean_heatmap_image = None
+        # Decoding, detection, analysis, rendering and encoding run as separate stages. The analysis stage is the only
+        # one that touches the time and timeslice bookkeeping, and it sees the frames in order, one by one.
+        pipeline = FramePipeline(pipelined=PIPELINED_ANALYSIS)
+        pipeline.add_stage("detect", self.detect_stage, self.flush_detect_stage)
+        pipeline.add_stage("analyze", self.analyze_stage)
+        if not self.headless:
+            pipeline.add_stage("render", self.render_stage)
+            pipeline.add_stage("encode", self.encode_stage)
 
-        if ret:
-            im0, heatmap_copy = self.initialize(frame)
-            self.video_manager.increment_current_time()
+        try:
+            pipeline.run(self.decode_stage)
+            self.provide_results()
+
+        finally:
+
+            # Release resources
+            self.video_manager.cap_release()
+            self.debug_crop_writer.close()
+            if self.video_writer is not None:
+                self.video_writer.release()
+            if self.detection_recorder is not None:
+                self.detection_recorder.close()
+
+    def provide_results(self):
+
+        # The analysis is done, so the state of the tracker is the one of the last frame.
+        if self.headless and self.last_ctx is not None:
+            self.last_ctx.is_last = True
+            self.frame_analyzer.snapshot(self.last_ctx)
+            self.render_stage(self.last_ctx, lambda ctx: None)
+
+        if self.last_annotated_heatmap_image is not None:
+            self.data_provider.provide(self.last_annotated_heatmap_image, self.last_clean_heatmap_image)
 
-        while self.video_manager.has_frames_left():
-            ret, frame = self.video_manager.read_frame()
-            if not ret:
-                self.data_provider.provide(prev_annotated_heatmap_image, prev_clean_heatmap_image)
-                break
+    def decode_stage(self, emit):
 
-            # If this is the 1st frame analyzed in this timeslice, set its local start time to the current time.
-            if self.video_manager.get_current_timeslice_frame_count() == 0:
-                self.video_manager.set_current_timeslice_start(self.video_manager.get_current_time())
+        # Start from the analysis window, and read one frame ahead, so the last frame is known as such when it is
+        # emitted. No frame past the end of the window is decoded.
+        self.video_manager.seek_to_analysis_window()
+        ret, frame = self.read_frame()
+        index = 0
+        while ret and self.video_manager.has_frames_left(index):
+            ctx = FrameContext(index, frame)
+            index += 1
+            ret, frame = self.read_frame() if self.video_manager.has_frames_left(index) else (False, None)
+            ctx.is_last = not ret
+            emit(ctx)
 
-            # Run frame analysis
-            annotated_heatmap_image, clean_heatmap_image = (
-                self.frame_analyzer.analyze(frame, self.video_manager.get_current_timeslice_frame_count()))
+    def read_frame(self):
+        with self.stage_metrics.time(Stage.DECODE):
+            return self.video_manager.read_frame()
 
-            # Save prev heatmap image for saving.
-            prev_annotated_heatmap_image = annotated_heatmap_image
-            prev_clean_heatmap_image = clean_heatmap_image
+    def detect_stage(self, ctx, emit):
 
-            # Write frame
-            self.video_writer.write(annotated_heatmap_image)
+        # A replayed frame gets the detections the recorded analysis got, with nothing skipped or interpolated.
+        if self.detection_replay is not None:
+            ctx.detections = self.detection_replay.get_detections(self.video_manager.get_video_frame(ctx.index))
+            emit(ctx)
+            return
 
-            # Increment number of counted frames.
-            self.video_manager.increment_frame_count()
+        # The first and the last frames are always detected, so no frame waits for a keyframe that never comes.
+        if ctx.index % self.detection_stride != 0 and not ctx.is_last:
+            self.stride_frames.append(ctx)
+            return
 
-            # Increment time slice time
+        self.detect_keyframe(ctx)
+
+        # All frames are still analyzed one by one, so line crossings and timing stay per frame.
+        if self.stride_frames:
+            start_index, start_detections = self.last_keyframe
+            span = ctx.index - start_index
+            for stride_ctx in self.stride_frames:
+                stride_ctx.detections = Detections.interpolate(start_detections, ctx.detections,
+                                                               (stride_ctx.index - start_index) / span)
+                emit(stride_ctx)
+            self.stride_frames = []
+
+        self.last_keyframe = (ctx.index, ctx.detections)
+        emit(ctx)
+
+    def detect_keyframe(self, ctx):
+
+        # Nothing moved since the last detection, and it found no one - the detector would find no one again. The
+        # tracker is not called at all, so its state stays as it was, the same as after a detection with no results.
+        if (self.motion_gate is not None and self.last_keyframe is not None and
+                not self.last_keyframe[1].has_tracks() and self.motion_gate.is_static(ctx.frame)):
+            ctx.detections = Detections.empty()
+            self.video_manager.increment_gated_frame_count()
+            return
+
+        with self.stage_metrics.time(Stage.TRACK):
+            self.frame_analyzer.detect(ctx)
+        if self.motion_gate is not None:
+            self.motion_gate.set_reference(ctx.frame)
+
+    def flush_detect_stage(self, emit):
+
+        # The stream ended with no last frame, the waiting frames keep the boxes of the last keyframe.
+        for stride_ctx in self.stride_frames:
+            stride_ctx.detections = self.last_keyframe[1]
+            emit(stride_ctx)
+        self.stride_frames = []
+
+    def analyze_stage(self, ctx, emit):
+        if self.detection_recorder is not None:
+            self.detection_recorder.record_detections(self.video_manager.get_video_frame(ctx.index), ctx.detections)
+        if self.detection_replay is not None:
+            self.object_tracker.replay_classifications(self.video_manager.get_video_frame(ctx.index))
+
+        # All objects detected in the first frame are counted as clients.
+        if ctx.index == 0:
+            self.initialize(ctx)
             self.video_manager.increment_current_time()
+            self.video_manager.increment_processed_frame_count()
+            self.finish_frame(ctx, emit)
+            return
+
+        # If this is the 1st frame analyzed in this timeslice, set its local start time to the current time.
+        if self.video_manager.get_current_timeslice_frame_count() == 0:
+            self.video_manager.set_current_timeslice_start(self.video_manager.get_current_time())
 
-            if self.video_manager.get_current_timeslice_frame_count() % self.saving_interval == 0:
-                self.save_and_reset()
+        # Run frame analysis
+        self.frame_analyzer.analyze(ctx)
 
-        # Release resources
-        self.video_manager.cap_release()
-        self.video_writer.release()
+        # Increment number of counted frames.
+        self.video_manager.increment_frame_count()
 
+        # Increment time slice time
+        self.video_manager.increment_current_time()
+        self.video_manager.increment_processed_frame_count()
+
+        self.finish_frame(ctx, emit)
+
+        if self.video_manager.get_current_timeslice_frame_count() % self.saving_interval == 0:
+            self.save_and_reset()
+
+    def finish_frame(self, ctx, emit):
+        self.last_ctx = ctx
+
+        # Take the state needed for drawing, unless nothing is drawn.
+        if not self.headless:
+            self.frame_analyzer.snapshot(ctx)
+            emit(ctx)
+
+    def render_stage(self, ctx, emit):
+        self.frame_analyzer.render(ctx)
+
+        # Save heatmap images of the last frame for uploading.
+        if ctx.is_last:
+            self.last_annotated_heatmap_image = ctx.annotated
+            self.last_clean_heatmap_image = ctx.clean
+        emit(ctx)
+
+    def encode_stage(self, ctx, emit):
+
+        # Write frame
+        with self.stage_metrics.time(Stage.ENCODE):
+            self.video_writer.write(ctx.annotated)
 
     def save_and_reset(self):
+
+        # Make sure the customers in the report are classified.
+        self.object_tracker.classify_pending(force=True)
         self.data_provider.local_save(
             self.object_tracker.calculate_current_count(),
-            self.object_tracker.age_classifier.data, self.object_tracker.dwell_times,
-            self.object_tracker.gender_classifier.data, self.object_tracker.past_customers_in_timeslice
+            self.object_tracker.age_classifier.data, self.object_tracker.get_dwell_times(),
+            self.object_tracker.gender_classifier.data, self.object_tracker.get_past_customers_in_timeslice()
         )
         self.video_manager.set_new_time_slice()
-        self.object_tracker.past_customers_in_timeslice = []
+        self.object_tracker.reset_timeslice()
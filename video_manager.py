@@ -1,5 +1,9 @@
 import datetime
+import math
 import cv2
+from ultralytics.utils import LOGGER
+
+from util import DETECTION_STRIDE, MOTION_GATE, DEBUG_CROP_MODE, SEGMENT_WORKERS, SEGMENT_OVERLAP, RECORD_DETECTIONS
 
 
 class VideoManager:
@@ -15,8 +19,22 @@ class VideoManager:
         self.current_timeslice_start = None
         self.current_timeslice_frame_count = 0
 
+        # Number of frames analyzed so far in the whole job, reported by the job status endpoint.
+        self.processed_frame_count = 0
+
+        # Number of frames the detection was skipped on as nothing moved, reported by the job status endpoint.
+        self.gated_frame_count = 0
+
+        # Wall-clock time of the first frame of the video - the analysis window may start later in the recording.
+        self.video_start_time = None
+
+        # Position of the next analyzed frame in the video, the current time is derived from it.
+        self.start_frame = 0
+        self.frame_position = 0
+
         # Video meta-data
         self.fps = None
+        self.frame_rate = None
         self.h = None
         self.w = None
         self.length = None
@@ -27,6 +45,27 @@ class VideoManager:
         # JobID that is used by the server to recognize this analysis process.
         self.jobId = None
 
+        # Headless jobs only produce the metrics reports and the final heatmap, with no annotated output video.
+        self.headless = False
+
+        # Number of frames between two frames the detection runs on.
+        self.detection_stride = DETECTION_STRIDE
+
+        # Whether detection is skipped on static frames with no one tracked.
+        self.motion_gate = MOTION_GATE
+
+        # Which classified crops are saved for debugging.
+        self.debug_crop_mode = DEBUG_CROP_MODE
+
+        # Number of worker processes the video is split between, and the seconds each segment starts before its part.
+        self.segment_workers = SEGMENT_WORKERS
+        self.segment_overlap = SEGMENT_OVERLAP
+
+        # Whether the detections are recorded, and the directory of an earlier record they are replayed from instead of
+        # being detected - set by the replay tool, never by the job payload.
+        self.record_detections = False
+        self.detection_replay_path = None
+
     def populate_video_data(self, video_cap, data):
 
         # Global time related population
@@ -35,6 +74,11 @@ class VideoManager:
         self.analysis_end_time = datetime.datetime.strptime(f"{data['date']} {data['end']}", "%Y-%m-%d %H:%M:%S")
         self.current_time = self.analysis_start_time
 
+        # A recording that started before the analysis window has its own start time, otherwise the video starts with
+        # the window.
+        self.video_start_time = (datetime.datetime.strptime(f"{data['date']} {data['videoStart']}", "%Y-%m-%d %H:%M:%S")
+                                 if data.get("videoStart") else self.analysis_start_time)
+
         # Video Capture object that is already initialized by the data provider.
         self.cap = video_cap
 
@@ -43,16 +87,59 @@ class VideoManager:
         self.w, self.h, self.fps = (int(self.cap.get(x)) for x in (cv2.CAP_PROP_FRAME_WIDTH,
                                                                    cv2.CAP_PROP_FRAME_HEIGHT,
                                                                    cv2.CAP_PROP_FPS))
+        self.frame_rate = self.cap.get(cv2.CAP_PROP_FPS)
         # JobID
         self.jobId = data["jobId"]
 
+        # Analysis mode
+        self.headless = bool(data.get("headless", False))
+        self.detection_stride = max(1, int(data.get("detectionStride", DETECTION_STRIDE)))
+        self.motion_gate = bool(data.get("motionGate", MOTION_GATE))
+        self.debug_crop_mode = data.get("debugCrops", DEBUG_CROP_MODE)
+        self.segment_workers = max(1, int(data.get("segmentWorkers", SEGMENT_WORKERS)))
+        self.segment_overlap = max(0.0, float(data.get("segmentOverlap", SEGMENT_OVERLAP)))
+
+        # A job records its detections only where the server lets jobs record.
+        self.record_detections = RECORD_DETECTIONS and bool(data.get("recordDetections", False))
+
+    def set_analysis_frames(self, first_frame, end_frame=None):
+
+        # Narrow the analysis window to the frames [first_frame, end_frame) of the video, an end of None leaves the
+        # window open. Times are taken from the frame clock, so the window holds exactly these frames.
+        self.analysis_start_time = self.get_frame_time(first_frame)
+        self.analysis_end_time = self.analysis_start_time if end_frame is None else self.get_frame_time(end_frame)
+        self.current_time = self.analysis_start_time
+
+    def seek_to_analysis_window(self):
+
+        # Skip the part of the recording before the analysis window, without decoding it.
+        self.start_frame = self.get_first_frame()
+        if self.start_frame:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.start_frame)
+            LOGGER.info(f"Seeked to frame {self.start_frame} of the video, the start of the analysis window")
+        self.frame_position = self.start_frame
+
+    def get_frame_time(self, frame_position):
+
+        # Time is derived from the frame position, so no error accumulates over long videos.
+        return self.video_start_time + datetime.timedelta(seconds=frame_position / self.frame_rate)
+
     def increment_current_time(self):
-        time_increment = 1 / self.fps  # Duration of a single frame in seconds
-        self.current_time += datetime.timedelta(seconds=time_increment)
+        self.set_frame_position(self.frame_position + 1)
+
+    def set_frame_position(self, frame_position):
+        self.frame_position = frame_position
+        self.current_time = self.get_frame_time(self.frame_position)
 
     def increment_frame_count(self):
         self.current_timeslice_frame_count += 1
 
+    def increment_processed_frame_count(self, count=1):
+        self.processed_frame_count += count
+
+    def increment_gated_frame_count(self, count=1):
+        self.gated_frame_count += count
+
     def read_frame(self):
         return self.cap.read()
 
@@ -81,6 +168,12 @@ class VideoManager:
     def get_analysis_start_time(self):
         return self.analysis_start_time
 
+    def get_analysis_end_time(self):
+        return self.analysis_end_time
+
+    def get_video_start_time(self):
+        return self.video_start_time
+
     def get_length(self):
         return self.length
 
@@ -90,6 +183,59 @@ class VideoManager:
     def get_current_timeslice_frame_count(self):
         return self.current_timeslice_frame_count
 
+    def get_processed_frame_count(self):
+        return self.processed_frame_count
+
+    def get_gated_frame_count(self):
+        return self.gated_frame_count
+
+    def is_headless(self):
+        return self.headless
+
+    def get_detection_stride(self):
+        return self.detection_stride
+
+    def is_motion_gated(self):
+        return self.motion_gate
+
+    def get_debug_crop_mode(self):
+        return self.debug_crop_mode
+
+    def get_segment_workers(self):
+        return self.segment_workers
+
+    def get_segment_overlap_frames(self):
+
+        # At least one frame, the segments are stitched on the last frame of the previous one.
+        return max(1, round(self.segment_overlap * self.frame_rate))
+
+    def is_recording_detections(self):
+        return self.record_detections
+
+    def get_detection_replay_path(self):
+        return self.detection_replay_path
+
+    def get_video_frame(self, index):
+
+        # Position in the video of the index-th analyzed frame.
+        return self.start_frame + index
+
+    def get_first_frame(self):
+        offset = (self.analysis_start_time - self.video_start_time).total_seconds()
+        return max(0, round(offset * self.frame_rate))
+
+    def get_analysis_frame_range(self):
+
+        # First frame of the analysis window and the frame after its last one, by the same rule as has_frames_left.
+        first_frame = self.get_first_frame()
+        end_frame = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if self.analysis_end_time > self.analysis_start_time:
+            offset = (self.analysis_end_time - self.video_start_time).total_seconds()
+            end_frame = min(end_frame, math.ceil(offset * self.frame_rate))
+            while end_frame > first_frame and self.get_frame_time(end_frame - 1) >= self.analysis_end_time:
+                end_frame -= 1
+        return first_frame, max(first_frame, end_frame)
+
     def get_start_y(self):
         return 0
     def get_start_x(self):
@@ -105,6 +251,16 @@ class VideoManager:
     def set_current_timeslice_start(self, time):
         self.current_timeslice_start = time
 
+    def set_detection_replay_path(self, path):
+        self.detection_replay_path = path
+
 # ----------------------Booleans--------------------------
-    def has_frames_left(self):
-        return self.cap.isOpened()
\ No newline at end of file
+    def has_frames_left(self, index=None):
+
+        # A frame is analyzed if it starts before the end of the analysis window. An end that is not after the start
+        # leaves the window open, and the video is analyzed to its end.
+        if not self.cap.isOpened():
+            return False
+        if index is None or self.analysis_end_time <= self.analysis_start_time:
+            return True
+        return self.get_frame_time(self.start_frame + index) < self.analysis_end_time
\ No newline at end of file